@@ -0,0 +1,175 @@
+import asyncio
+import collections
+import math
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+import numpy as np
+from loguru import logger
+
+from bounded_queue import BoundedQueue
+from server_metrics import LatencyHistogram
+from wav_recorder import WavRecorder
+
+
+@dataclass(slots=True, frozen=True)
+class AudioPacket:
+    # 16-bit mono samples, read-only and shared by every subscriber.
+    samples: np.ndarray
+    sample_rate: int
+    # As measured by the client: RMS of the [-1, 1] signal, times 100.
+    sound_level: float
+    timestamp: float
+    # `time.perf_counter()` at publication, for measuring delivery latency.
+    published_at: float
+
+
+class AudioBus:
+    """
+    Fans decoded audio packets out to in-process subscribers.
+
+    A packet is decoded once, marked read-only and the same buffer is handed to every
+    subscriber, so adding a consumer costs no extra decoding or copying. Each
+    subscriber drains its own `BoundedQueue` in its own task: a slow subscriber drops
+    its oldest packets instead of stalling the others or the WebSocket.
+
+    With a `histogram`, each subscriber's queue wait, handler time and their sum are
+    recorded as `audio_bus.{name}.wait`, `.handler` and `audio_bus.{name}`. Dropped
+    packets are counted in `counters` as `audio_bus.{name}.dropped`.
+    """
+
+    def __init__(
+        self,
+        histogram: LatencyHistogram | None = None,
+        counters: collections.Counter | None = None,
+    ):
+        self.histogram = histogram
+        self.counters = counters
+        self.subscribers: dict[str, BoundedQueue] = {}
+        self.handlers: dict[str, Callable[[AudioPacket], Awaitable[None]]] = {}
+        self.tasks: list[asyncio.Task] = []
+
+    def subscribe(
+        self,
+        name: str,
+        handler: Callable[[AudioPacket], Awaitable[None]],
+        maxsize: int = 64,
+    ):
+        self.subscribers[name] = BoundedQueue(maxsize, policy="drop_oldest", name=name)
+        self.handlers[name] = handler
+
+    def start(self):
+        self.tasks = [
+            asyncio.create_task(self._deliver_loop(name)) for name in self.subscribers
+        ]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def publish(self, samples: np.ndarray, sample_rate: int, sound_level: float):
+        samples.flags.writeable = False
+        packet = AudioPacket(
+            samples, sample_rate, sound_level, time.time(), time.perf_counter()
+        )
+        for name, queue in self.subscribers.items():
+            dropped_count = queue.dropped_count
+            queue.put_nowait(packet)
+            if self.counters is not None and queue.dropped_count > dropped_count:
+                self.counters[f"audio_bus.{name}.dropped"] += (
+                    queue.dropped_count - dropped_count
+                )
+
+    async def _deliver_loop(self, name: str):
+        queue = self.subscribers[name]
+        handler = self.handlers[name]
+        while True:
+            packet = await queue.get()
+            handler_started_at = time.perf_counter()
+            try:
+                await handler(packet)
+            except Exception:
+                logger.exception(f"Audio subscriber '{name}' failed on a packet")
+            if self.histogram is not None:
+                handled_at = time.perf_counter()
+                self.histogram.record(
+                    f"audio_bus.{name}.wait", handler_started_at - packet.published_at
+                )
+                self.histogram.record(
+                    f"audio_bus.{name}.handler", handled_at - handler_started_at
+                )
+                self.histogram.record(
+                    f"audio_bus.{name}", handled_at - packet.published_at
+                )
+
+    def stats(self) -> dict:
+        return {name: queue.stats() for name, queue in self.subscribers.items()}
+
+
+class RecordingSink:
+    """Appends published audio to rotating WAV files, one series per sample rate."""
+
+    def __init__(self, directory: str, max_file_duration_s: float = 600):
+        self.directory = directory
+        self.max_file_duration_s = max_file_duration_s
+        self.recorder: WavRecorder | None = None
+
+    async def __call__(self, packet: AudioPacket):
+        if self.recorder is None or self.recorder.sample_rate != packet.sample_rate:
+            await self.close()
+            self.recorder = WavRecorder(
+                self.directory,
+                prefix=f"recording_{packet.sample_rate}hz",
+                sample_rate=packet.sample_rate,
+                max_file_duration_s=self.max_file_duration_s,
+                compress=True,
+            )
+        self.recorder.write(memoryview(packet.samples).cast("B"))
+
+    async def close(self):
+        if self.recorder is not None:
+            # Finalizing the file and handing it off for compression touches the disk,
+            # so it runs in a thread rather than on the loop every session shares.
+            recorder, self.recorder = self.recorder, None
+            await asyncio.to_thread(recorder.close)
+
+
+class LevelMeter:
+    """
+    Server-side loudness and a simple energy VAD over the published audio.
+
+    A packet counts as speech when its level is above `speech_threshold_dbfs`;
+    speech is held for `hangover_s` after the last loud packet, to bridge short pauses.
+    """
+
+    def __init__(self, speech_threshold_dbfs: float = -40, hangover_s: float = 0.5):
+        self.speech_threshold_dbfs = speech_threshold_dbfs
+        self.hangover_s = hangover_s
+        self.level_dbfs = -math.inf
+        self.speaking = False
+        self.last_speech_at = -math.inf
+        self.speech_s = 0.0
+        self.total_s = 0.0
+
+    async def __call__(self, packet: AudioPacket):
+        samples = packet.samples.astype(np.float32) / 32768
+        rms = float(np.sqrt(np.mean(samples**2))) if len(samples) > 0 else 0.0
+        self.level_dbfs = 20 * math.log10(rms) if rms > 0 else -math.inf
+
+        if self.level_dbfs >= self.speech_threshold_dbfs:
+            self.last_speech_at = packet.timestamp
+        self.speaking = packet.timestamp - self.last_speech_at <= self.hangover_s
+
+        duration_s = len(samples) / packet.sample_rate
+        self.total_s += duration_s
+        if self.speaking:
+            self.speech_s += duration_s
+
+    def stats(self) -> dict:
+        return {
+            "level_dbfs": self.level_dbfs if math.isfinite(self.level_dbfs) else None,
+            "speaking": self.speaking,
+            "speech_fraction": self.speech_s / self.total_s if self.total_s else 0.0,
+        }
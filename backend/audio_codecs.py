@@ -0,0 +1,74 @@
+import struct
+from dataclasses import dataclass
+
+import numpy as np
+
+# Encodings a client may negotiate for binary audio frames on /ws.
+AUDIO_ENCODINGS = ("pcm16", "mulaw")
+AUDIO_SAMPLE_RATES = (16000, 24000, 48000)
+
+# Every binary audio frame starts with the client's sound level (RMS of the [-1, 1]
+# signal, times 100), followed by the encoded samples.
+AUDIO_FRAME_HEADER = struct.Struct("<f")
+
+MULAW_BIAS = 0x84
+MULAW_CLIP = 32635
+
+
+def _mulaw_decode_table() -> np.ndarray:
+    # G.711 µ-law: invert the bits, then sign, 3-bit exponent and 4-bit mantissa.
+    codes = ~np.arange(256, dtype=np.uint8)
+    exponent = (codes >> 4) & 0x07
+    mantissa = codes & 0x0F
+    magnitude = ((mantissa.astype(np.int32) << 3) + MULAW_BIAS) << exponent
+    magnitude -= MULAW_BIAS
+    return np.where(codes & 0x80, -magnitude, magnitude).astype(np.int16)
+
+
+MULAW_DECODE_TABLE = _mulaw_decode_table()
+
+
+def decode_mulaw(data: bytes | memoryview) -> np.ndarray:
+    """Decodes µ-law bytes to 16-bit samples with a single table lookup."""
+    return MULAW_DECODE_TABLE[np.frombuffer(data, dtype=np.uint8)]
+
+
+def encode_mulaw(samples: np.ndarray) -> bytes:
+    """Encodes 16-bit samples as µ-law, e.g. for simulated clients."""
+    samples = samples.astype(np.int32)
+    sign = np.where(samples < 0, 0x80, 0)
+    magnitude = np.minimum(np.abs(samples), MULAW_CLIP) + MULAW_BIAS
+    exponent = np.floor(np.log2(magnitude)).astype(np.int32) - 7
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    return (~(sign | (exponent << 4) | mantissa)).astype(np.uint8).tobytes()
+
+
+@dataclass(slots=True, frozen=True)
+class AudioFormat:
+    encoding: str
+    sample_rate: int
+
+    @classmethod
+    def from_message(cls, message: dict) -> "AudioFormat":
+        """Parses an `audio_format` message, rejecting what the server can't decode."""
+        encoding = message.get("encoding")
+        sample_rate = message.get("sample_rate")
+        if encoding not in AUDIO_ENCODINGS:
+            raise ValueError(f"Unsupported audio encoding: {encoding}")
+        if sample_rate not in AUDIO_SAMPLE_RATES:
+            raise ValueError(f"Unsupported audio sample rate: {sample_rate}")
+        return cls(encoding, sample_rate)
+
+    def decode(self, payload: bytes | memoryview) -> np.ndarray:
+        if self.encoding == "mulaw":
+            return decode_mulaw(payload)
+        return np.frombuffer(payload, dtype=np.int16)
+
+
+def pack_audio_frame(sound_level: float, payload: bytes) -> bytes:
+    return AUDIO_FRAME_HEADER.pack(sound_level) + payload
+
+
+def unpack_audio_frame(frame: bytes) -> tuple[float, memoryview]:
+    (sound_level,) = AUDIO_FRAME_HEADER.unpack_from(frame)
+    return sound_level, memoryview(frame)[AUDIO_FRAME_HEADER.size :]
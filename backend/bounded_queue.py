@@ -0,0 +1,105 @@
+import asyncio
+import collections
+from typing import Any, Callable
+
+from loguru import logger
+
+from clock import Clock, SystemClock
+
+QUEUE_POLICIES = ("block", "drop_oldest", "coalesce")
+
+
+class BoundedQueue(asyncio.Queue):
+    """
+    An `asyncio.Queue` with an overflow policy and depth/wait-time/drop counters.
+
+    Policies, applied when the queue is full:
+    - "block": `put` waits for a free slot and `put_nowait` raises `QueueFull`.
+    - "drop_oldest": the oldest queued item is discarded to make room.
+    - "coalesce": the new item is merged into the newest queued item with
+      `coalesce_fn`. If `coalesce_fn` returns None, the oldest item is dropped instead.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        policy: str = "block",
+        coalesce_fn: Callable[[Any, Any], Any] | None = None,
+        name: str = "",
+        clock: Clock | None = None,
+    ):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"Unknown queue policy: {policy}")
+        if policy == "coalesce" and coalesce_fn is None:
+            raise ValueError("The 'coalesce' policy requires a coalesce_fn.")
+
+        super().__init__(maxsize)
+        self.policy = policy
+        self.coalesce_fn = coalesce_fn
+        self.name = name
+        self.clock = clock or SystemClock()
+        self.put_count = 0
+        self.get_count = 0
+        self.dropped_count = 0
+        self.coalesced_count = 0
+        self.max_depth = 0
+        self.total_wait_s = 0.0
+        self.max_wait_s = 0.0
+
+    # Items are stored together with the time they were enqueued.
+    def _init(self, maxsize):
+        self._queue = collections.deque()
+
+    def _put(self, item):
+        self._queue.append((self.clock.monotonic(), item))
+        self.max_depth = max(self.max_depth, len(self._queue))
+
+    def _get(self):
+        enqueued_at, item = self._queue.popleft()
+        wait_s = self.clock.monotonic() - enqueued_at
+        self.get_count += 1
+        self.total_wait_s += wait_s
+        self.max_wait_s = max(self.max_wait_s, wait_s)
+        return item
+
+    def items(self) -> list:
+        """The queued items, oldest first, without dequeuing them."""
+        return [item for _, item in self._queue]
+
+    def put_nowait(self, item):
+        self.put_count += 1
+        if self.full() and self.policy != "block":
+            if self.policy == "coalesce":
+                assert self.coalesce_fn is not None
+                enqueued_at, newest = self._queue[-1]
+                merged = self.coalesce_fn(newest, item)
+                if merged is not None:
+                    self._queue[-1] = (enqueued_at, merged)
+                    self.coalesced_count += 1
+                    return
+
+            self._queue.popleft()
+            self.task_done()
+            self.dropped_count += 1
+            logger.debug(f"Queue '{self.name}' is full, dropped the oldest item.")
+
+        super().put_nowait(item)
+
+    async def put(self, item):
+        if self.policy == "block":
+            return await super().put(item)
+        self.put_nowait(item)
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.policy,
+            "depth": self.qsize(),
+            "maxsize": self.maxsize,
+            "max_depth": self.max_depth,
+            "put_count": self.put_count,
+            "get_count": self.get_count,
+            "dropped_count": self.dropped_count,
+            "coalesced_count": self.coalesced_count,
+            "avg_wait_s": self.total_wait_s / self.get_count if self.get_count else 0.0,
+            "max_wait_s": self.max_wait_s,
+        }
@@ -0,0 +1,77 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+import PIL.Image
+
+
+def image_content_key(image: PIL.Image.Image) -> str:
+    """Identifies an image by its pixels, so identical frames share a caption."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}:{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class CaptionStore:
+    """
+    Captions keyed by image content, shared by all worker processes on one box.
+
+    Backed by SQLite in WAL mode, so readers never block the single writer and
+    concurrent writes from other processes are serialized by SQLite's own locking.
+    A call may wait up to the busy timeout for another process's write, so callers on
+    an event loop run it in a thread. The connection is shared by those threads
+    under a lock.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS captions ("
+            "key TEXT PRIMARY KEY, caption TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> str | None:
+        return self.get_many([key])[0]
+
+    def get_many(self, keys: list[str]) -> list[str | None]:
+        captions = []
+        with self.lock:
+            for key in keys:
+                row = self.connection.execute(
+                    "SELECT caption FROM captions WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    captions.append(None)
+                else:
+                    self.hits += 1
+                    captions.append(row[0])
+        return captions
+
+    def put(self, key: str, caption: str):
+        self.put_many([(key, caption)])
+
+    def put_many(self, entries: list[tuple[str, str]]):
+        # The first caption stored for an image wins; racing workers agree on it.
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO captions (key, caption, created_at) VALUES (?, ?, ?)",
+                [(key, caption, time.time()) for key, caption in entries],
+            )
+            self.connection.commit()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,104 @@
+import asyncio
+import datetime
+import selectors
+import time
+from abc import ABC, abstractmethod
+
+
+class Clock(ABC):
+    """
+    Source of time for `Streaming` and `Context`.
+
+    `now` is used for timestamps and scheduling decisions, `monotonic` for measuring
+    durations. Sleeps and timeouts go through the running event loop, so they follow
+    virtual time under a `VirtualTimeEventLoop`.
+    """
+
+    @abstractmethod
+    def now(self) -> datetime.datetime:
+        pass
+
+    @abstractmethod
+    def monotonic(self) -> float:
+        pass
+
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(seconds)
+
+    async def wait_for(self, awaitable, timeout: float | None):
+        return await asyncio.wait_for(awaitable, timeout)
+
+
+class SystemClock(Clock):
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.now()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+
+class VirtualClock(Clock):
+    """Wall-clock time derived from the event loop's (possibly virtual) time."""
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        start: datetime.datetime | None = None,
+    ):
+        self.loop = loop
+        self.start = start or datetime.datetime.now()
+        self.origin = loop.time()
+
+    def now(self) -> datetime.datetime:
+        return self.start + datetime.timedelta(seconds=self.loop.time() - self.origin)
+
+    def monotonic(self) -> float:
+        return self.loop.time()
+
+
+class _FastForwardSelector(selectors.DefaultSelector):
+    # Instead of blocking until the next timer is due, jump virtual time forward to it.
+
+    def __init__(self, loop: "VirtualTimeEventLoop"):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if len(events) > 0 or timeout is None or timeout <= 0:
+            # With no timers pending, wait for real I/O (e.g. a thread finishing).
+            return events if timeout is not None else super().select(None)
+        if self.loop.pending_executor_jobs > 0:
+            # Work in threads takes no virtual time: wait for it before skipping ahead.
+            return super().select(None)
+
+        self.loop.virtual_time += timeout
+        return []
+
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+    """
+    An event loop whose clock only advances when every task is waiting on a timer.
+
+    Code runs instantly in virtual time, and `asyncio.sleep`, `wait_for` timeouts and
+    `call_later` fire in the same order as they would in real time, just without the
+    waiting. Like code on the loop, work in `run_in_executor` (and `asyncio.to_thread`)
+    takes no virtual time: the clock stands still until it is done.
+    """
+
+    def __init__(self):
+        self.virtual_time = 0.0
+        self.pending_executor_jobs = 0
+        super().__init__(_FastForwardSelector(self))
+
+    def time(self) -> float:
+        return self.virtual_time
+
+    def run_in_executor(self, executor, func, *args):
+        future = super().run_in_executor(executor, func, *args)
+        self.pending_executor_jobs += 1
+        future.add_done_callback(self._on_executor_job_done)
+        return future
+
+    def _on_executor_job_done(self, future):
+        self.pending_executor_jobs -= 1
@@ -1,21 +1,56 @@
 import asyncio
+import importlib.util
+import io
 import os
-import tempfile
 import wave
+from contextlib import asynccontextmanager
 
 import httpx
 from dotenv import load_dotenv
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from loguru import logger
 
 load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+TRANSCRIPTION_URL = "https://api.openai.com/v1/audio/transcriptions"
+TRANSCRIPTION_REQUEST_PREFIX = b"transcription_request"
+# Audio following the prefix: 16-bit mono PCM, as captured by the extension.
+SAMPLE_RATE = 48000
+MAX_CONCURRENT_REQUESTS = 8
+# HTTP/2 multiplexes concurrent requests over one connection, if `h2` is installed.
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
 
+# Shared for the lifetime of the app, so connections are kept alive and reused.
+http_client: httpx.AsyncClient | None = None
+request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    http_client = httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+        limits=httpx.Limits(
+            max_connections=MAX_CONCURRENT_REQUESTS,
+            max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+            keepalive_expiry=60,
+        ),
+        timeout=httpx.Timeout(30, connect=5),
+    )
+    yield
+    await http_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Dictionary to store active WebSocket connections
 active_connections = {}
+# Audio waiting to be transcribed, per client. While a client's request is in flight,
+# newly received audio is appended here and sent as one follow-up request.
+pending_audio: dict[int, bytearray] = {}
+transcription_tasks: dict[int, asyncio.Task] = {}
 
 
 # WebSocket endpoint to handle connections
@@ -28,22 +63,65 @@ async def websocket_endpoint(client_id: int, websocket: WebSocket):
         while True:
             data = await websocket.receive_bytes()
 
-            if data.startswith("transcription_request"):
-                await handle_transcription(client_id)
+            if data.startswith(TRANSCRIPTION_REQUEST_PREFIX):
+                request_transcription(
+                    client_id, data[len(TRANSCRIPTION_REQUEST_PREFIX) :]
+                )
 
     except WebSocketDisconnect:
         del active_connections[client_id]
+        pending_audio.pop(client_id, None)
 
 
-async def handle_transcription(client_id: int):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            "https://api.openai.com/v1/audio/transcriptions",
-            headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
-            json={"client_id": client_id, "action": "start_transcription"},
+def request_transcription(client_id: int, pcm16: bytes):
+    pending_audio.setdefault(client_id, bytearray()).extend(pcm16)
+    if client_id not in transcription_tasks:
+        transcription_tasks[client_id] = asyncio.create_task(
+            handle_transcription(client_id)
         )
 
-        if response.status_code == 200:
-            pass
-        else:
-            pass
+
+def _to_wav(pcm16: bytes) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(pcm16)
+    return buffer.getvalue()
+
+
+async def handle_transcription(client_id: int):
+    assert http_client is not None
+    try:
+        # Drain the client's pending audio, one coalesced request at a time.
+        while len(pending_audio.get(client_id, b"")) > 0:
+            pcm16 = bytes(pending_audio.pop(client_id))
+
+            async with request_semaphore:
+                response = await http_client.post(
+                    TRANSCRIPTION_URL,
+                    data={"model": "whisper-1"},
+                    files={"file": ("audio.wav", _to_wav(pcm16), "audio/wav")},
+                )
+
+            websocket = active_connections.get(client_id)
+            if websocket is None:
+                break
+
+            if response.status_code == 200:
+                await websocket.send_json(
+                    {"type": "transcription", "text": response.json()["text"]}
+                )
+            else:
+                logger.warning(
+                    f"Transcription for client {client_id} failed: "
+                    f"{response.status_code} {response.text}"
+                )
+                await websocket.send_json(
+                    {"type": "transcription_error", "status": response.status_code}
+                )
+    except Exception as e:
+        logger.error(f"Transcription for client {client_id} failed: {e!r}")
+    finally:
+        del transcription_tasks[client_id]
@@ -0,0 +1,85 @@
+import bisect
+from dataclasses import dataclass
+
+import PIL.Image
+
+from image_pyramid import ImagePyramid
+
+# Slotted records keep long sessions compact: no per-record `__dict__`, and text
+# deltas are coalesced into one record per utterance (see `Context.add_text`).
+# Records are frozen, so a record handed to a snapshot never changes under a reader;
+# coalescing replaces the last record instead of mutating it.
+
+
+@dataclass(slots=True, frozen=True)
+class ImageRecord:
+    id: int
+    timestamp: float
+    image: PIL.Image.Image
+    pyramid: ImagePyramid
+    keyframe: bool
+    role: str = "user"
+
+
+@dataclass(slots=True, frozen=True)
+class TextRecord:
+    id: int
+    role: str
+    text: str
+    # Start and end of the utterance.
+    timestamp: float
+    end_timestamp: float
+
+
+@dataclass(slots=True, frozen=True)
+class ToolCallRequestRecord:
+    id: int
+    name: str
+    arguments: dict
+    tool_call_id: str
+    timestamp: float
+    role: str = "assistant"
+
+
+@dataclass(slots=True, frozen=True)
+class ToolCallResultRecord:
+    id: int
+    tool_call_id: str
+    response_structured: dict
+    response_formatted: str
+    timestamp: float
+    role: str = "tool"
+
+
+ContentRecord = ImageRecord | TextRecord | ToolCallRequestRecord | ToolCallResultRecord
+
+
+@dataclass(slots=True, frozen=True)
+class ContextSnapshot:
+    """
+    The content of a `Context` as of one version, safe to read from any thread.
+
+    Taking a snapshot is O(1): it shares the context's append-only lists and only
+    remembers their lengths. Appends past those lengths are invisible to it, and the
+    one in-place change the context makes, replacing its last record when text is
+    coalesced, is covered by keeping the last record of the snapshot separately.
+    """
+
+    version: int
+    _content: list[ContentRecord]
+    _content_length: int
+    _last_record: ContentRecord | None
+    _images: list[ImageRecord]
+    _images_length: int
+
+    def records(self):
+        for i in range(self._content_length - 1):
+            yield self._content[i]
+        if self._last_record is not None:
+            yield self._last_record
+
+    def images_between(self, start: float, end: float) -> list[ImageRecord]:
+        key = lambda image: image.timestamp
+        lo = bisect.bisect_left(self._images, start, hi=self._images_length, key=key)
+        hi = bisect.bisect_right(self._images, end, hi=self._images_length, key=key)
+        return self._images[lo:hi]
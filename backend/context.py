@@ -1,21 +1,120 @@
 import asyncio
-import base64
+import dataclasses
 import datetime
 import json
-import io
+import math
 import os
+from typing import Callable
 
 from loguru import logger
+import numpy as np
 import openai
 import PIL.Image
 from openai.types.chat import ChatCompletionMessageParam
 
+from bounded_queue import BoundedQueue
+from caption_store import CaptionStore, image_content_key
+from clock import Clock, SystemClock
+from content_records import (
+    ContextSnapshot,
+    ContentRecord,
+    ImageRecord,
+    TextRecord,
+    ToolCallRequestRecord,
+    ToolCallResultRecord,
+)
+from image_pyramid import ImagePyramid
+from lexical_index import LexicalIndex, SearchHit
+from streaming_openai_util import (
+    partial_json_bool,
+    partial_json_string,
+    stream_tool_call,
+)
+from token_budget import (
+    MESSAGE_OVERHEAD_TOKENS,
+    estimate_image_tokens,
+    estimate_text_tokens,
+)
 
-def _image_to_base64(image: PIL.Image.Image):
-    io_save = io.BytesIO()
-    image.save(io_save, format="PNG")
-    io_save.seek(0)
-    return "data:image/png;base64," + base64.b64encode(io_save.read()).decode("utf-8")
+# "all" captions every frame as it arrives. "keyframes" only captions keyframes eagerly,
+# and other frames when a recall needs them.
+CAPTION_POLICIES = ("all", "keyframes")
+
+# Frames are compared on a small grayscale thumbnail to detect scene changes.
+KEYFRAME_SIGNATURE_SIZE = (64, 64)
+KEYFRAME_DIFF_THRESHOLD = 0.08
+
+
+def _image_signature(image: PIL.Image.Image) -> np.ndarray:
+    thumbnail = image.convert("L").resize(KEYFRAME_SIGNATURE_SIZE)
+    return np.asarray(thumbnail, dtype=np.float32) / 255
+
+
+# Within a fine-grained prompt, frames after the first are diffed against the
+# previous frame sent, on their thumbnails, and only the changed region is sent.
+CHANGED_PIXEL_THRESHOLD = 24
+CHANGED_REGION_MARGIN = 0.02
+
+
+def _changed_region(
+    previous: PIL.Image.Image, current: PIL.Image.Image
+) -> tuple[float, float, float, float] | None:
+    """
+    Bounding box (left, top, right, bottom) of the pixels that differ between two
+    frames, as fractions of the frame size and padded by a small margin. None if
+    nothing changed; frames of different sizes differ everywhere.
+    """
+    if previous.size != current.size:
+        return (0.0, 0.0, 1.0, 1.0)
+
+    difference = np.abs(
+        np.asarray(previous.convert("L"), dtype=np.int16)
+        - np.asarray(current.convert("L"), dtype=np.int16)
+    )
+    rows = np.flatnonzero((difference > CHANGED_PIXEL_THRESHOLD).any(axis=1))
+    if len(rows) == 0:
+        return None
+    columns = np.flatnonzero((difference > CHANGED_PIXEL_THRESHOLD).any(axis=0))
+
+    height, width = difference.shape
+    return (
+        max(0.0, columns[0] / width - CHANGED_REGION_MARGIN),
+        max(0.0, rows[0] / height - CHANGED_REGION_MARGIN),
+        min(1.0, (columns[-1] + 1) / width + CHANGED_REGION_MARGIN),
+        min(1.0, (rows[-1] + 1) / height + CHANGED_REGION_MARGIN),
+    )
+
+
+PENDING_TOOL_CALL_RESULT = (
+    "Still in progress. The result will be spoken to the user when it is ready."
+)
+
+
+def _pair_tool_calls(
+    selected: list[tuple[ContentRecord, str]],
+) -> list[tuple[ContentRecord, str]]:
+    # The API requires every tool call to be directly followed by its result. Results
+    # are moved up to their calls, calls still in flight get a placeholder result so
+    # the model does not repeat them, and results without their call are left out.
+    results = {
+        item.tool_call_id: (item, level)
+        for item, level in selected
+        if isinstance(item, ToolCallResultRecord)
+    }
+    paired = []
+    for item, level in selected:
+        if isinstance(item, ToolCallRequestRecord):
+            pending = ToolCallResultRecord(
+                id=item.id,
+                tool_call_id=item.tool_call_id,
+                response_structured={},
+                response_formatted=PENDING_TOOL_CALL_RESULT,
+                timestamp=item.timestamp,
+            )
+            paired += [(item, level), results.get(item.tool_call_id, (pending, level))]
+        elif not isinstance(item, ToolCallResultRecord):
+            paired.append((item, level))
+    return paired
 
 
 class Context:
@@ -25,16 +124,73 @@ class Context:
         openai_client: openai.AsyncOpenAI,
         prompt_history_length_s: float = 30,
         max_finegrained_prompt_length_s: float = 30,
+        finegrained_image_level: str = "thumbnail",
+        visual_recall_window_s: float = 5,
+        recall_top_k: int = 3,
+        recall_max_concurrency: int = 3,
+        caption_batching: bool = False,
+        max_caption_batch_size: int = 8,
+        caption_latency_target_s: float = 10,
+        max_inflight_caption_batches: int = 1,
+        utterance_gap_s: float = 3,
+        recall_hit_radius_s: float = 30,
+        clock: Clock | None = None,
+        caption_store: CaptionStore | None = None,
+        caption_policy: str = "all",
+        lazy_caption_concurrency: int = 4,
+        crop_changed_regions: bool = True,
+        max_changed_region_fraction: float = 0.5,
     ):
+        if caption_policy not in CAPTION_POLICIES:
+            raise ValueError(f"Unknown caption policy: {caption_policy}")
+
         self.log_dir = log_dir
+        self.clock = clock or SystemClock()
+        # Shared with other sessions and worker processes, so a frame seen before is
+        # not captioned again.
+        self.caption_store = caption_store
+        self.caption_policy = caption_policy
+        # In-flight lazy captions by image id, shared by concurrent recalls.
+        self.lazy_caption_tasks: dict[int, asyncio.Task] = {}
+        self.lazy_caption_semaphore = asyncio.Semaphore(lazy_caption_concurrency)
         self.content_id_counter = 0
-        self.indexing_queue = asyncio.Queue()
-        self.content = []
+        self.indexing_queue = BoundedQueue(
+            64, policy="drop_oldest", name="indexing", clock=self.clock
+        )
+        # Append-only, apart from `add_text` replacing the last record, so that
+        # snapshots can share them (see `ContextSnapshot`).
+        self.content: list[ContentRecord] = []
+        # Images are also kept on their own, in timestamp order, for window lookups.
+        self.images: list[ImageRecord] = []
+        self.version = 0
+        self.captions: dict[int, str] = {}
         self.indexing_tasks = []
         self.indexing_thread = None
         self.openai_client = openai_client
         self.prompt_history_length_s = prompt_history_length_s
         self.max_finegrained_prompt_length_s = max_finegrained_prompt_length_s
+        self.finegrained_image_level = finegrained_image_level
+        self.visual_recall_window_s = visual_recall_window_s
+        self.recall_top_k = recall_top_k
+        self.recall_max_concurrency = recall_max_concurrency
+        self.last_keyframe_signature = None
+        self.caption_batching = caption_batching
+        self.max_caption_batch_size = max_caption_batch_size
+        self.caption_latency_target_s = caption_latency_target_s
+        self.caption_batch_limit = max_caption_batch_size
+        # With batching, frames that arrive while a batch is being captioned wait in
+        # the queue, so that they form the next batch.
+        self.caption_batch_slots = asyncio.Semaphore(max_inflight_caption_batches)
+        self.utterance_gap_s = utterance_gap_s
+        # Transcripts and captions, for cheap keyword search before any LLM call.
+        self.lexical_index = LexicalIndex()
+        self.recall_hit_radius_s = recall_hit_radius_s
+        # Send only what changed between consecutive frames of a fine-grained prompt,
+        # unless the change covers more than `max_changed_region_fraction` of it.
+        # Only high-detail levels are cropped: a low-detail image costs the same
+        # tokens whatever its size.
+        self.crop_changed_regions = crop_changed_regions
+        self.max_changed_region_fraction = max_changed_region_fraction
 
         if not os.path.exists(log_dir):
             os.makedirs(log_dir)
@@ -46,7 +202,9 @@ class Context:
         await asyncio.gather(*tasks)
         logger.info("Context indexing thread started.")
 
-    async def _create_caption(self, image: PIL.Image.Image) -> str:
+    async def _create_caption(self, pyramid: ImagePyramid) -> str:
+        # Full-resolution PNG encoding takes long enough to stall the event loop.
+        image_url = await asyncio.to_thread(pyramid.data_url, "full")
         response = await self.openai_client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
@@ -63,7 +221,10 @@ class Context:
                         },
                         {
                             "type": "image_url",
-                            "image_url": {"url": _image_to_base64(image)},
+                            "image_url": {
+                                "url": image_url,
+                                "detail": pyramid.detail("full"),
+                            },
                         },
                     ],
                 },
@@ -74,81 +235,285 @@ class Context:
 
         return caption
 
+    def _caption_batch_content(self, pyramids: list[ImagePyramid]) -> list:
+        # Runs in a worker thread: encodes every frame at full resolution.
+        content: list = [
+            {
+                "type": "text",
+                "text": f"Please describe each of the following {len(pyramids)} images in detail. "
+                "Describe every image on its own, without referring to the other images.",
+            }
+        ]
+        for i, pyramid in enumerate(pyramids):
+            content.append({"type": "text", "text": f"Image {i}:"})
+            content.append(
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": pyramid.data_url("full"),
+                        "detail": pyramid.detail("full"),
+                    },
+                }
+            )
+        return content
+
+    async def _create_captions(self, pyramids: list[ImagePyramid]) -> list[str]:
+        # Packs several frames into one request, with one caption per frame in the response.
+        if len(pyramids) == 1:
+            return [await self._create_caption(pyramids[0])]
+
+        content = await asyncio.to_thread(self._caption_batch_content, pyramids)
+        response = await self.openai_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {
+                    "role": "system",
+                    "content": "You create detailed descriptions of images for future lookup.",
+                },
+                {"role": "user", "content": content},
+            ],
+            tool_choice="required",
+            tools=[
+                {
+                    "type": "function",
+                    "function": {
+                        "description": "Stores the description of each image.",
+                        "name": "store_captions",
+                        "strict": True,
+                        "parameters": {
+                            "type": "object",
+                            "additionalProperties": False,
+                            "properties": {
+                                "captions": {
+                                    "type": "array",
+                                    "items": {
+                                        "type": "object",
+                                        "additionalProperties": False,
+                                        "properties": {
+                                            "image_index": {"type": "integer"},
+                                            "caption": {"type": "string"},
+                                        },
+                                        "required": ["image_index", "caption"],
+                                    },
+                                }
+                            },
+                            "required": ["captions"],
+                        },
+                    },
+                }
+            ],
+        )
+        tool_calls = response.choices[0].message.tool_calls
+        assert tool_calls is not None and len(tool_calls) == 1
+
+        captions: dict[int, str] = {}
+        for entry in json.loads(tool_calls[0].function.arguments)["captions"]:
+            if 0 <= entry["image_index"] < len(pyramids):
+                captions[entry["image_index"]] = entry["caption"]
+
+        # Caption any frames the batched response missed individually.
+        missing = [i for i in range(len(pyramids)) if i not in captions]
+        if len(missing) > 0:
+            logger.warning(f"Batched captioning missed {len(missing)} images.")
+            for i, caption in zip(
+                missing,
+                await asyncio.gather(
+                    *[self._create_caption(pyramids[i]) for i in missing]
+                ),
+            ):
+                captions[i] = caption
+
+        return [captions[i] for i in range(len(pyramids))]
+
+    def _adapt_caption_batch_limit(self, batch_size: int, latency_s: float):
+        # Additive increase while within the latency target, multiplicative decrease otherwise.
+        if latency_s > self.caption_latency_target_s:
+            self.caption_batch_limit = max(1, self.caption_batch_limit // 2)
+        elif batch_size >= self.caption_batch_limit:
+            self.caption_batch_limit = min(
+                self.max_caption_batch_size, self.caption_batch_limit + 1
+            )
+
+    async def _caption_images(self, items: list[ImageRecord]) -> int:
+        # Captions and stores the frames that have no caption yet. Returns how many
+        # captions had to be created.
+        items = [item for item in items if self._get_caption(item) is None]
+        content_keys = {}
+        if self.caption_store is not None:
+            # Hashing the frames and SQLite, which can wait on another worker's write
+            # lock, both run off the event loop.
+            keys = await asyncio.to_thread(
+                lambda: [image_content_key(item.image) for item in items]
+            )
+            stored_captions = await asyncio.to_thread(self.caption_store.get_many, keys)
+            uncaptioned = []
+            for item, key, caption in zip(items, keys, stored_captions):
+                content_keys[item.id] = key
+                if caption is None:
+                    uncaptioned.append(item)
+                else:
+                    self._store_caption(item, caption)
+            items = uncaptioned
+        if len(items) == 0:
+            return 0
+
+        captions = await self._create_captions([item.pyramid for item in items])
+        for item, caption in zip(items, captions):
+            self._store_caption(item, caption)
+        if self.caption_store is not None:
+            await asyncio.to_thread(
+                self.caption_store.put_many,
+                [
+                    (content_keys[item.id], caption)
+                    for item, caption in zip(items, captions)
+                ],
+            )
+
+        return len(items)
+
+    async def _caption_images_lazily(self, items: list[ImageRecord]):
+        # Captions frames skipped at index time, in parallel, once a recall needs them.
+        async def _caption_image(item: ImageRecord):
+            async with self.lazy_caption_semaphore:
+                await self._caption_images([item])
+
+        tasks = []
+        for item in items:
+            if self._get_caption(item) is not None:
+                continue
+            if item.id not in self.lazy_caption_tasks:
+                task = asyncio.create_task(_caption_image(item))
+                task.add_done_callback(
+                    lambda _, id=item.id: self.lazy_caption_tasks.pop(id, None)
+                )
+                self.lazy_caption_tasks[item.id] = task
+            tasks.append(self.lazy_caption_tasks[item.id])
+
+        if len(tasks) > 0:
+            logger.info(f"Captioning {len(tasks)} frame(s) for recall")
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.warning("Lazy captioning failed: " + repr(result))
+
     async def _index_images(self):
-        async def _index_image(item):
-            item["image"].save(f"{self.log_dir}/{item['id']}.png")
+        async def _index_image_batch(items: list[ImageRecord]):
+            for item in items:
+                item.image.save(f"{self.log_dir}/{item.id}.png")
 
-            if not os.path.exists(f"{self.log_dir}/{item['id']}_caption.txt"):
-                caption = await self._create_caption(item["image"])
-                with open(f"{self.log_dir}/{item['id']}_caption.txt", "w") as f:
-                    f.write(caption)
+            if self.caption_policy == "keyframes":
+                items = [item for item in items if item.keyframe]
 
-                logger.info("Created caption")
+            t0 = self.clock.monotonic()
+            created = await self._caption_images(items)
+            if created > 0:
+                self._adapt_caption_batch_limit(created, self.clock.monotonic() - t0)
+                logger.info(f"Created {created} caption(s)")
 
         logger.info("Starting image indexing thread...")
         while True:
-            if self.indexing_queue.empty():
-                await asyncio.sleep(0.1)
+            item = await self.indexing_queue.get()
+            if not isinstance(item, ImageRecord):
                 continue
+            logger.info("Indexing image...")
+            if self.caption_batching:
+                await self.caption_batch_slots.acquire()
 
-            while not self.indexing_queue.empty():
-                logger.info("Indexing image...")
-                item = await self.indexing_queue.get()
-                if item["type"] == "image":
-                    self.indexing_tasks.append(asyncio.create_task(_index_image(item)))
+            # The batch grows with the queue depth, up to the adaptive limit.
+            batch = [item]
+            batch_limit = self.caption_batch_limit if self.caption_batching else 1
+            while len(batch) < batch_limit and not self.indexing_queue.empty():
+                next_item = self.indexing_queue.get_nowait()
+                if isinstance(next_item, ImageRecord):
+                    batch.append(next_item)
 
-    def add_image(self, image: PIL.Image.Image, timestamp: datetime.datetime):
-        self.indexing_queue.put_nowait(
-            {
-                "type": "image",
-                "role": "user",
-                "image": image,
-                "id": self.content_id_counter,
-                "timestamp": timestamp.timestamp(),
-            }
-        )
-        self.content.append(
-            {
-                "type": "image",
-                "role": "user",
-                "image": image,
-                "id": self.content_id_counter,
-                "timestamp": timestamp.timestamp(),
-            }
+            task = asyncio.create_task(_index_image_batch(batch))
+            if self.caption_batching:
+                task.add_done_callback(lambda _: self.caption_batch_slots.release())
+            self.indexing_tasks = [t for t in self.indexing_tasks if not t.done()]
+            self.indexing_tasks.append(task)
+
+    def _is_keyframe(self, image: PIL.Image.Image) -> bool:
+        signature = _image_signature(image)
+        if (
+            self.last_keyframe_signature is not None
+            and np.abs(signature - self.last_keyframe_signature).mean()
+            < KEYFRAME_DIFF_THRESHOLD
+        ):
+            return False
+
+        self.last_keyframe_signature = signature
+        return True
+
+    def add_image(
+        self,
+        image: PIL.Image.Image,
+        timestamp: datetime.datetime,
+        pyramid: ImagePyramid | None = None,
+    ):
+        # Callers on the event loop build the pyramid in a thread and pass it in.
+        if pyramid is None:
+            pyramid = ImagePyramid(image)
+        record = ImageRecord(
+            id=self.content_id_counter,
+            timestamp=timestamp.timestamp(),
+            image=image,
+            pyramid=pyramid,
+            keyframe=self._is_keyframe(pyramid.get("thumbnail")),
         )
+        self.indexing_queue.put_nowait(record)
+        self.content.append(record)
+        self.images.append(record)
         self.content_id_counter += 1
+        self.version += 1
 
     def add_text(self, text: str, role: str, timestamp: datetime.datetime):
-        self.content.append(
-            {
-                "type": "text",
-                "role": role,
-                "text": text,
-                "id": self.content_id_counter,
-                "timestamp": timestamp.timestamp(),
-            }
+        # Coalesce consecutive deltas from the same role into one utterance record.
+        last = self.content[-1] if len(self.content) > 0 else None
+        if (
+            isinstance(last, TextRecord)
+            and last.role == role
+            and timestamp.timestamp() - last.end_timestamp <= self.utterance_gap_s
+        ):
+            last = dataclasses.replace(
+                last, text=last.text + text, end_timestamp=timestamp.timestamp()
+            )
+            self.content[-1] = last
+            self.version += 1
+            self.lexical_index.add(last.id, last.text, role, last.timestamp)
+            return
+
+        record = TextRecord(
+            id=self.content_id_counter,
+            role=role,
+            text=text,
+            timestamp=timestamp.timestamp(),
+            end_timestamp=timestamp.timestamp(),
         )
+        self.content.append(record)
+        self.lexical_index.add(record.id, record.text, role, record.timestamp)
         self.content_id_counter += 1
+        self.version += 1
 
     def add_tool_call_request(
         self,
         name: str,
-        arguments: dict,
+        arguments: dict | str,
         tool_call_id: str,
         timestamp: datetime.datetime,
     ):
+        if isinstance(arguments, str):
+            arguments = json.loads(arguments)
         self.content.append(
-            {
-                "type": "tool_call_request",
-                "role": "assistant",
-                "name": name,
-                "arguments": arguments,
-                "id": self.content_id_counter,
-                "tool_call_id": tool_call_id,
-                "timestamp": timestamp.timestamp(),
-            }
+            ToolCallRequestRecord(
+                id=self.content_id_counter,
+                name=name,
+                arguments=arguments,
+                tool_call_id=tool_call_id,
+                timestamp=timestamp.timestamp(),
+            )
         )
         self.content_id_counter += 1
+        self.version += 1
 
     def add_tool_call_result(
         self,
@@ -158,146 +523,569 @@ class Context:
         timestamp: datetime.datetime,
     ):
         self.content.append(
-            {
-                "type": "tool_call_response",
-                "role": "tool",
-                "response_structured": response_structured,
-                "response_formatted": response_formatted,
-                "id": self.content_id_counter,
-                "tool_call_id": tool_call_id,
-                "timestamp": timestamp.timestamp(),
-            }
+            ToolCallResultRecord(
+                id=self.content_id_counter,
+                tool_call_id=tool_call_id,
+                response_structured=response_structured,
+                response_formatted=response_formatted,
+                timestamp=timestamp.timestamp(),
+            )
         )
         self.content_id_counter += 1
+        self.version += 1
 
-    def get_latest_finegrained_context(self):
-        end_time = datetime.datetime.now()
+    def snapshot(self) -> ContextSnapshot:
+        return ContextSnapshot(
+            version=self.version,
+            _content=self.content,
+            _content_length=len(self.content),
+            _last_record=self.content[-1] if len(self.content) > 0 else None,
+            _images=self.images,
+            _images_length=len(self.images),
+        )
+
+    def get_latest_finegrained_context(self, token_budget: int | None = None):
+        end_time = self.clock.now()
+        start_time = end_time - datetime.timedelta(seconds=self.prompt_history_length_s)
+        return self._construct_finegrained_context(start_time, end_time, token_budget)
+
+    async def build_latest_finegrained_context(self, token_budget: int | None = None):
+        """
+        Like `get_latest_finegrained_context`, but assembles the prompt and encodes
+        the images in a worker thread, from a snapshot taken now.
+        """
+        end_time = self.clock.now()
         start_time = end_time - datetime.timedelta(seconds=self.prompt_history_length_s)
-        return self._construct_finegrained_context(start_time, end_time)
+        return await asyncio.to_thread(
+            self._construct_finegrained_context,
+            start_time,
+            end_time,
+            token_budget,
+            snapshot=self.snapshot(),
+        )
 
-    def _get_caption(self, image_id: str):
-        path = f"{self.log_dir}/{image_id}_caption.txt"
+    def _store_caption(self, image: ImageRecord, caption: str):
+        with open(f"{self.log_dir}/{image.id}_caption.txt", "w") as f:
+            f.write(caption)
+        self.captions[image.id] = caption
+        self.lexical_index.add(image.id, caption, "caption", image.timestamp)
+
+    def _get_caption(self, image: ImageRecord):
+        if image.id in self.captions:
+            return self.captions[image.id]
+
+        path = f"{self.log_dir}/{image.id}_caption.txt"
         if not os.path.exists(path):
             return None
         with open(path, "r") as f:
-            return f.read()
+            self.captions[image.id] = f.read()
+        self.lexical_index.add(
+            image.id, self.captions[image.id], "caption", image.timestamp
+        )
+        return self.captions[image.id]
 
-    def _construct_coarse_context(self) -> list[ChatCompletionMessageParam]:
+    def search_moments(
+        self,
+        query: str,
+        k: int = 5,
+        kinds: set[str] | None = None,
+        accept: Callable[[SearchHit], bool] | None = None,
+    ) -> list[SearchHit]:
+        """Keyword search over utterances and frame captions, ranked by BM25."""
+        return self.lexical_index.search(query, k, kinds, accept)
+
+    def _current_turn_start(self, tool_call_id: str | None) -> float | None:
+        # Start of the user turn that asked for a recall: the last user utterance
+        # before the triggering tool call (or before now, without one).
+        end = len(self.content)
+        for i in range(len(self.content) - 1, -1, -1):
+            record = self.content[i]
+            if (
+                isinstance(record, ToolCallRequestRecord)
+                and record.tool_call_id == tool_call_id
+            ):
+                end = i
+                break
+        for record in reversed(self.content[:end]):
+            if isinstance(record, TextRecord) and record.role == "user":
+                return record.timestamp
+        return None
+
+    def _images_near_hits(self, hits: list[SearchHit]) -> list[ImageRecord]:
+        return [
+            image
+            for image in self.images
+            if any(
+                abs(image.timestamp - hit.timestamp) <= self.recall_hit_radius_s
+                for hit in hits
+            )
+        ]
+
+    def _construct_coarse_context(
+        self, hits: list[SearchHit] | None = None
+    ) -> list[ChatCompletionMessageParam]:
+        # With keyword hits, only the captions around them are included.
         entries = []
-        for image in self.content:
-            caption = self._get_caption(image["id"])
+        for image in self._images_near_hits(hits) if hits else self.images:
+            caption = self._get_caption(image)
             if caption is None:
                 continue
 
             timestamp_formatted = datetime.datetime.fromtimestamp(
-                image["timestamp"]
+                image.timestamp
             ).isoformat()
 
             entries.append(
                 f"Timestamp: {timestamp_formatted}; Image containing: {caption}"
             )
 
+        for hit in hits or []:
+            if hit.kind == "caption":
+                continue
+            timestamp_formatted = datetime.datetime.fromtimestamp(
+                hit.timestamp
+            ).isoformat()
+            entries.append(
+                f"Timestamp: {timestamp_formatted}; The {hit.kind} said: {hit.text}"
+            )
+
         return [{"role": "user", "content": "\n".join(entries)}]
 
-    async def _visual_recall(self, query: str, start_timestamp: str):
+    async def _visual_recall_stream(self, query: str, start_timestamp: str):
+        """
+        Inspects one window and yields `(confident, answer so far)` as the answer is
+        generated. `confident` is None until the model has decided on it.
+        """
         start_time = datetime.datetime.fromisoformat(start_timestamp)
-        end_time = start_time + datetime.timedelta(seconds=5)
+        end_time = start_time + datetime.timedelta(seconds=self.visual_recall_window_s)
 
-        prompt = self._construct_finegrained_context(start_time, end_time)
-        response = await self.openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a helpful assistant that can recall information from images.",
-                },
-                *prompt,
-                {
-                    "role": "user",
-                    "content": f"Please help me answer the following question: {repr(query)}",
+        prompt = await asyncio.to_thread(
+            self._construct_finegrained_context,
+            start_time,
+            end_time,
+            image_level="full",
+            snapshot=self.snapshot(),
+        )
+        messages = [
+            {
+                "role": "system",
+                "content": "You are a helpful assistant that can recall information from images.",
+            },
+            *prompt,
+            {
+                "role": "user",
+                "content": f"Please help me answer the following question: {repr(query)}. "
+                "Only mark the answer as confident if the images clearly contain it.",
+            },
+        ]
+        tools = [
+            {
+                "type": "function",
+                "function": {
+                    "description": "Answers the question based on the images.",
+                    "name": "answer",
+                    "strict": True,
+                    "parameters": {
+                        "type": "object",
+                        "additionalProperties": False,
+                        "properties": {
+                            # Listed first so that the verdict is known before the answer is complete.
+                            "confident": {"type": "boolean"},
+                            "answer": {"type": "string"},
+                        },
+                        "required": ["confident", "answer"],
+                    },
                 },
-            ],
+            }
+        ]
+        async for _, arguments in stream_tool_call(
+            self.openai_client, messages, tools, model="gpt-4o-mini"
+        ):
+            yield (
+                partial_json_bool(arguments, "confident"),
+                partial_json_string(arguments, "answer") or "",
+            )
+
+    async def _visual_recall_candidates_stream(
+        self, query: str, start_timestamps: list[str]
+    ):
+        """
+        Inspects the candidate windows concurrently. The first one whose answer is
+        marked confident is streamed as it is generated and the others are cancelled;
+        if none is confident, the merged answers are yielded once all are done.
+        """
+        candidates = list(dict.fromkeys(start_timestamps))[: self.recall_top_k]
+        semaphore = asyncio.Semaphore(self.recall_max_concurrency)
+        # Receives `(start_timestamp, answers)` from each inspection that turns
+        # confident, where `answers` gets the growing answer and finally None.
+        confident_inspections: asyncio.Queue = asyncio.Queue()
+
+        async def _inspect(start_timestamp: str) -> dict:
+            answers = None
+            confident, answer = None, ""
+            try:
+                async with semaphore:
+                    async for confident, answer in self._visual_recall_stream(
+                        query, start_timestamp
+                    ):
+                        if confident and answers is None:
+                            answers = asyncio.Queue()
+                            confident_inspections.put_nowait((start_timestamp, answers))
+                        if answers is not None:
+                            answers.put_nowait(answer)
+            finally:
+                if answers is not None:
+                    answers.put_nowait(None)
+            return {
+                "start_timestamp": start_timestamp,
+                "answer": answer,
+                "confident": bool(confident),
+            }
+
+        tasks = {ts: asyncio.create_task(_inspect(ts)) for ts in candidates}
+        first_confident = asyncio.create_task(confident_inspections.get())
+        try:
+            pending = set(tasks.values())
+            while len(pending) > 0 and not first_confident.done():
+                _, pending = await asyncio.wait(
+                    pending | {first_confident}, return_when=asyncio.FIRST_COMPLETED
+                )
+                pending.discard(first_confident)
+
+            if first_confident.done():
+                start_timestamp, answers = first_confident.result()
+                logger.info("Confident visual recall answer at " + start_timestamp)
+                # Cancel the inspections whose answers are no longer needed.
+                for ts, task in tasks.items():
+                    if ts != start_timestamp:
+                        task.cancel()
+
+                streamed = ""
+                while (answer := await answers.get()) is not None:
+                    if len(answer) > len(streamed):
+                        yield answer[len(streamed) :]
+                        streamed = answer
+                return
+
+            results = []
+            for task in tasks.values():
+                if task.exception() is not None:
+                    logger.warning(
+                        "Visual recall inspection failed: " + repr(task.exception())
+                    )
+                    continue
+                results.append(task.result())
+            yield self._merge_visual_recall_results(results, candidates)
+        finally:
+            first_confident.cancel()
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(
+                first_confident, *tasks.values(), return_exceptions=True
+            )
+
+    def _merge_visual_recall_results(
+        self, results: list[dict], candidates: list[str]
+    ) -> str:
+        if len(results) == 0:
+            return "I could not find anything relevant to the query."
+        if len(results) == 1:
+            return results[0]["answer"]
+
+        results = sorted(results, key=lambda r: candidates.index(r["start_timestamp"]))
+        return "\n".join(
+            f"Around {result['start_timestamp']}: {result['answer']}"
+            for result in results
         )
-        assert response.choices[0].message.content is not None
-        return response.choices[0].message.content
 
-    async def recall(self, query: str):
-        response = await self.openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a helpful assistant that can recall information from images.",
-                },
-                *self._construct_coarse_context(),
-                {
-                    "role": "user",
-                    "content": f"Please perform the best action you can do answer the following query: {repr(query)}",
-                },
-            ],
-            tool_choice="required",
-            tools=[
-                {
-                    "type": "function",
-                    "function": {
-                        "description": "Visually inspects some of the data in the context to help answer the query.",
-                        "name": "visual_recall",
-                        "strict": True,
-                        "parameters": {
-                            "type": "object",
-                            "additionalProperties": False,
-                            "properties": {
-                                "start_timestamp": {
-                                    "type": "string",
-                                    "description": "The timestamp to inspect more closely. Must be of the format 'YYYY-MM-DDTHH:MM:SS'.",
-                                },
-                                "query": {"type": "string"},
+    def _hit_windows(self, hits: list[SearchHit]) -> list[str]:
+        # Visual recall windows centered on the keyword hits.
+        return [
+            datetime.datetime.fromtimestamp(
+                hit.timestamp - self.visual_recall_window_s / 2
+            ).isoformat(timespec="seconds")
+            for hit in hits
+        ]
+
+    async def recall(self, query: str, tool_call_id: str | None = None) -> str:
+        return "".join(
+            [token async for token in self.recall_stream(query, tool_call_id)]
+        )
+
+    async def recall_stream(self, query: str, tool_call_id: str | None = None):
+        """
+        Answers a question about the session, yielding the answer in pieces as soon
+        as the model generates them. `tool_call_id` identifies the recall tool call
+        that asked, if any.
+        """
+        # The turn that asked shares the query's keywords, and would otherwise outrank
+        # the moment it asks about. Utterances from before it remain candidates.
+        turn_start = self._current_turn_start(tool_call_id)
+        hits = self.search_moments(
+            query,
+            k=self.recall_top_k,
+            accept=lambda hit: hit.kind == "caption"
+            or turn_start is None
+            or hit.timestamp < turn_start,
+        )
+        if len(hits) > 0:
+            logger.info(f"Keyword search found {len(hits)} candidate moments.")
+            if self.caption_policy == "keyframes":
+                # Only the keyframes were captioned up front. Fill in the frames around
+                # the hits; without hits, the keyframe captions summarize the session.
+                await self._caption_images_lazily(self._images_near_hits(hits))
+
+        messages = [
+            {
+                "role": "system",
+                "content": "You are a helpful assistant that can recall information from images.",
+            },
+            *self._construct_coarse_context(hits),
+            {
+                "role": "user",
+                "content": f"Please perform the best action you can do answer the following query: {repr(query)}",
+            },
+        ]
+        tools = [
+            {
+                "type": "function",
+                "function": {
+                    "description": "Visually inspects some of the data in the context to help answer the query.",
+                    "name": "visual_recall",
+                    "strict": True,
+                    "parameters": {
+                        "type": "object",
+                        "additionalProperties": False,
+                        "properties": {
+                            "start_timestamps": {
+                                "type": "array",
+                                "items": {"type": "string"},
+                                "description": f"Up to {self.recall_top_k} candidate timestamps to inspect more closely, most likely first. Each must be of the format 'YYYY-MM-DDTHH:MM:SS'.",
                             },
-                            "required": ["start_timestamp", "query"],
+                            "query": {"type": "string"},
                         },
+                        "required": ["start_timestamps", "query"],
                     },
                 },
-                {
-                    "type": "function",
-                    "function": {
-                        "description": "Directly responds to the query.",
-                        "name": "direct_response",
-                        "strict": True,
-                        "parameters": {
-                            "type": "object",
-                            "additionalProperties": False,
-                            "properties": {"response": {"type": "string"}},
-                            "required": ["response"],
-                        },
+            },
+            {
+                "type": "function",
+                "function": {
+                    "description": "Directly responds to the query.",
+                    "name": "direct_response",
+                    "strict": True,
+                    "parameters": {
+                        "type": "object",
+                        "additionalProperties": False,
+                        "properties": {"response": {"type": "string"}},
+                        "required": ["response"],
                     },
                 },
-            ],
+            },
+        ]
+
+        name, arguments, streamed = "", "", ""
+        async for name, arguments in stream_tool_call(
+            self.openai_client, messages, tools, model="gpt-4o-mini"
+        ):
+            if name == "direct_response":
+                response = partial_json_string(arguments, "response") or ""
+                if len(response) > len(streamed):
+                    yield response[len(streamed) :]
+                    streamed = response
+
+        if name == "visual_recall":
+            arguments = json.loads(arguments)
+            # The model's picks go first, then the keyword hits fill the remaining slots.
+            start_timestamps = arguments["start_timestamps"] + self._hit_windows(hits)
+            async for token in self._visual_recall_candidates_stream(
+                arguments["query"], start_timestamps
+            ):
+                yield token
+
+        elif name != "direct_response":
+            raise ValueError(f"Unknown tool call function name: {name}")
+
+    def _estimate_item_tokens(
+        self, item: ContentRecord, image_level: str = "full"
+    ) -> float:
+        match item:
+            case ImageRecord():
+                return estimate_image_tokens(
+                    *item.pyramid.get(image_level).size,
+                    detail=item.pyramid.detail(image_level),
+                )
+            case TextRecord():
+                return estimate_text_tokens(item.text)
+            case ToolCallRequestRecord():
+                return MESSAGE_OVERHEAD_TOKENS + estimate_text_tokens(
+                    json.dumps(item.arguments)
+                )
+            case ToolCallResultRecord():
+                return MESSAGE_OVERHEAD_TOKENS + estimate_text_tokens(
+                    item.response_formatted
+                )
+
+    def _image_parts(
+        self, image: ImageRecord, level: str, previous: ImageRecord | None
+    ) -> list[dict]:
+        """
+        The message parts for a frame: the whole frame, or only the region that
+        changed since `previous` together with its position (at high detail), or
+        nothing at all if nothing changed.
+        """
+        full_frame = [
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": image.pyramid.data_url(level),
+                    "detail": image.pyramid.detail(level),
+                },
+            }
+        ]
+        if not self.crop_changed_regions or previous is None:
+            return full_frame
+
+        region = _changed_region(
+            previous.pyramid.get("thumbnail"), image.pyramid.get("thumbnail")
         )
-        tool_calls = response.choices[0].message.tool_calls
-        assert tool_calls is not None and len(tool_calls) == 1
+        if region is None:
+            return []
+        left, top, right, bottom = region
+        if (
+            image.pyramid.detail(level) != "high"
+            or (right - left) * (bottom - top) > self.max_changed_region_fraction
+        ):
+            # A crop would cost as many tokens as the frame, plus its label.
+            return full_frame
+
+        width, height = image.pyramid.get(level).size
+        box = (
+            int(left * width),
+            int(top * height),
+            math.ceil(right * width),
+            math.ceil(bottom * height),
+        )
+        return [
+            {
+                "type": "text",
+                "text": f"Next frame: only the region that changed, at x={box[0]}, "
+                f"y={box[1]}, {box[2] - box[0]}x{box[3] - box[1]} pixels of the "
+                f"{width}x{height} frame; the rest is as in the previous frame.",
+            },
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": image.pyramid.crop_data_url(level, box),
+                    "detail": image.pyramid.detail(level),
+                },
+            },
+        ]
 
-        tool_call = tool_calls[0]
-        if tool_call.function.name == "visual_recall":
-            arguments = json.loads(tool_call.function.arguments)
-            start_timestamp = arguments["start_timestamp"]
-            query = arguments["query"]
-            result = await self._visual_recall(query, start_timestamp)
+    def _select_finegrained_items(
+        self,
+        start_time: datetime.datetime,
+        end_time: datetime.datetime,
+        token_budget: int | None = None,
+        image_level: str = "thumbnail",
+        snapshot: ContextSnapshot | None = None,
+    ) -> list[tuple[ContentRecord, str]]:
+        """
+        Selects the content items (with the image pyramid level to use) for a fine-grained prompt.
 
-            return result
+        When the estimated size exceeds `token_budget`, non-keyframe images are dropped
+        first, then images are lowered to the thumbnail level, then the oldest text is
+        trimmed, and finally the oldest remaining images are dropped. The most recent
+        image is always kept.
+        """
+        snapshot = snapshot or self.snapshot()
+        window_image_ids = {
+            image.id
+            for image in snapshot.images_between(
+                start_time.timestamp(), end_time.timestamp()
+            )
+        }
+        items = [
+            item
+            for item in snapshot.records()
+            if not isinstance(item, ImageRecord) or item.id in window_image_ids
+        ]
+        levels = {image_id: image_level for image_id in window_image_ids}
+        if token_budget is None:
+            return _pair_tool_calls(
+                [(item, levels.get(item.id, image_level)) for item in items]
+            )
 
-        elif tool_call.function.name == "direct_response":
-            arguments = json.loads(tool_call.function.arguments)
-            response = arguments["response"]
-            return response
+        costs = {
+            item.id: self._estimate_item_tokens(item, image_level) for item in items
+        }
+        total = sum(costs.values()) + MESSAGE_OVERHEAD_TOKENS * 2
+        images = [item for item in items if isinstance(item, ImageRecord)]
+        latest_image_id = images[-1].id if len(images) > 0 else None
+        dropped = set()
 
-        else:
-            raise ValueError(
-                f"Unknown tool call function name: {tool_call.function.name}"
+        def _drop(item):
+            nonlocal total
+            dropped.add(item.id)
+            total -= costs[item.id]
+
+        # 1. Thin out frames, keeping keyframes.
+        for image in images:
+            if total <= token_budget:
+                break
+            if not image.keyframe and image.id != latest_image_id:
+                _drop(image)
+
+        # 2. Lower the remaining frames to thumbnails, oldest first.
+        for image in images:
+            if total <= token_budget:
+                break
+            if image.id in dropped or levels[image.id] == "thumbnail":
+                continue
+            low_cost = self._estimate_item_tokens(image, "thumbnail")
+            total -= costs[image.id] - low_cost
+            costs[image.id] = low_cost
+            levels[image.id] = "thumbnail"
+
+        # 3. Trim the oldest text.
+        for item in items:
+            if total <= token_budget:
+                break
+            if not isinstance(item, ImageRecord):
+                _drop(item)
+
+        # 4. Drop the oldest remaining frames.
+        for image in images:
+            if total <= token_budget:
+                break
+            if image.id not in dropped and image.id != latest_image_id:
+                _drop(image)
+
+        if total > token_budget:
+            logger.warning(
+                f"Fine-grained context ({total:.0f} tokens) exceeds the budget of {token_budget} tokens."
             )
 
+        return _pair_tool_calls(
+            [
+                (item, levels.get(item.id, image_level))
+                for item in items
+                if item.id not in dropped
+            ]
+        )
+
     def _construct_finegrained_context(
-        self, start_time: datetime.datetime, end_time: datetime.datetime
+        self,
+        start_time: datetime.datetime,
+        end_time: datetime.datetime,
+        token_budget: int | None = None,
+        image_level: str | None = None,
+        snapshot: ContextSnapshot | None = None,
     ):
+        # Only reads `snapshot`, so this may run in a worker thread.
+        if image_level is None:
+            image_level = self.finegrained_image_level
+
         if (
             end_time - start_time
         ).total_seconds() > self.max_finegrained_prompt_length_s:
@@ -307,77 +1095,83 @@ class Context:
             )
 
         prompt: list[ChatCompletionMessageParam] = []
-        for item in self.content:
-            if item["type"] == "image" and not (
-                item["timestamp"] >= start_time.timestamp()
-                and item["timestamp"] <= end_time.timestamp()
-            ):
-                continue
+        # The last frame sent, and the ids of the text parts that label cropped frames.
+        previous_image = None
+        frame_label_ids = set()
+        for item, level in self._select_finegrained_items(
+            start_time, end_time, token_budget, image_level, snapshot
+        ):
+            match item:
+                case ImageRecord():
+                    parts = self._image_parts(item, level, previous_image)
+                    if len(parts) == 0:
+                        # Nothing changed since the last frame sent.
+                        continue
+                    previous_image = item
+                    if parts[0]["type"] == "text":
+                        frame_label_ids.add(id(parts[0]))
 
-            match item["type"]:
-                case "image":
                     # Squeeze consecutive messages from same role into one.
-                    if len(prompt) > 0 and prompt[-1]["role"] == item["role"]:
-                        prompt[-1]["content"].append(  # type: ignore
-                            {
-                                "type": "image_url",
-                                "image_url": {"url": _image_to_base64(item["image"])},
-                            }
-                        )
+                    if len(prompt) > 0 and prompt[-1]["role"] == item.role:
+                        prompt[-1]["content"].extend(parts)  # type: ignore
                         continue
 
                     prompt.append(
                         {
-                            "role": item["role"],  # This can only be 'user'.
-                            "content": [
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": _image_to_base64(item["image"])
-                                    },
-                                }
-                            ],
+                            "role": item.role,  # This can only be 'user'.
+                            "content": parts,
                         }
                     )
-                case "text":
+                case TextRecord():
                     if len(prompt) > 0:
-                        if prompt[-1]["role"] == item["role"]:
-                            if prompt[-1]["content"][0]["type"] == "text":  # type: ignore
+                        if prompt[-1]["role"] == item.role:
+                            first_part = prompt[-1]["content"][0]  # type: ignore
+                            if (
+                                first_part["type"] == "text"
+                                and id(first_part) not in frame_label_ids
+                            ):
                                 # Concatenate consecutive text messages into one.
-                                prompt[-1]["content"][0]["text"] += item["text"]  # type: ignore
+                                first_part["text"] += item.text
                             else:
                                 # Append text content piece to the last message.
                                 prompt[-1]["content"].append(  # type: ignore
-                                    {"type": "text", "text": item["text"]}
+                                    {"type": "text", "text": item.text}
                                 )
                             continue
 
                     prompt.append(
                         {
-                            "role": item["role"],
+                            "role": item.role,
                             "content": [
-                                {"type": "text", "text": item["text"]},
+                                {"type": "text", "text": item.text},
                             ],
                         }
                     )
-                case "function_call_request":
+                case ToolCallRequestRecord():
                     prompt.append(
                         {
-                            "role": item["role"],
-                            "content": [
-                                {"type": "text", "text": item["text"]},
+                            "role": "assistant",
+                            "tool_calls": [
+                                {
+                                    "id": item.tool_call_id,
+                                    "type": "function",
+                                    "function": {
+                                        "name": item.name,
+                                        "arguments": json.dumps(item.arguments),
+                                    },
+                                }
                             ],
                         }
                     )
-                case "function_call_response":
+                case ToolCallResultRecord():
                     prompt.append(
                         {
-                            "role": item["role"],
-                            "content": item["response_formatted"],
-                            "tool_call_id": item["tool_call_id"],
+                            "role": "tool",
+                            "content": item.response_formatted,
+                            "tool_call_id": item.tool_call_id,
                         }
                     )
                 case _:
-                    raise ValueError(f"Unknown content type: {item['type']}")
+                    raise ValueError(f"Unknown content type: {type(item).__name__}")
 
         return prompt
@@ -0,0 +1,73 @@
+import base64
+import io
+import threading
+
+import PIL.Image
+
+# Maximum side length of each level. `None` keeps the captured resolution.
+PYRAMID_LEVELS = {
+    "thumbnail": 512,
+    "full": None,
+}
+# A 512px thumbnail is exactly what the model sees in low-detail mode.
+PYRAMID_LEVEL_DETAIL = {
+    "thumbnail": "low",
+    "full": "high",
+}
+JPEG_QUALITY = 80
+
+
+def _image_to_base64(image: PIL.Image.Image, format: str = "PNG"):
+    io_save = io.BytesIO()
+    if format == "JPEG":
+        image = image.convert("RGB")
+        image.save(io_save, format=format, quality=JPEG_QUALITY)
+    else:
+        image.save(io_save, format=format)
+    io_save.seek(0)
+    return f"data:image/{format.lower()};base64," + base64.b64encode(
+        io_save.read()
+    ).decode("utf-8")
+
+
+class ImagePyramid:
+    """
+    Downscaled copies of a frame, built once at ingest.
+
+    The thumbnail is JPEG-encoded on first use and its data URL memoized. The full
+    level keeps the lossless PNG encoding and is encoded on every use instead: at
+    ~1 MB per frame, memoizing it would grow session memory without bound. Prompts
+    are built in worker threads, so the memo is guarded by a per-pyramid lock.
+    """
+
+    def __init__(self, image: PIL.Image.Image):
+        self.levels: dict[str, PIL.Image.Image] = {}
+        self._data_urls: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+        for level, max_side in PYRAMID_LEVELS.items():
+            if max_side is None or max(image.size) <= max_side:
+                self.levels[level] = image
+            else:
+                resized = image.copy()
+                resized.thumbnail((max_side, max_side))
+                self.levels[level] = resized
+
+    def get(self, level: str) -> PIL.Image.Image:
+        return self.levels[level]
+
+    def detail(self, level: str) -> str:
+        return PYRAMID_LEVEL_DETAIL[level]
+
+    def data_url(self, level: str) -> str:
+        if level == "full":
+            return _image_to_base64(self.levels[level], "PNG")
+        with self._lock:
+            if level not in self._data_urls:
+                self._data_urls[level] = _image_to_base64(self.levels[level], "JPEG")
+            return self._data_urls[level]
+
+    def crop_data_url(self, level: str, box: tuple[int, int, int, int]) -> str:
+        # Crops depend on the frame they are diffed against, so they are not memoized.
+        format = "PNG" if level == "full" else "JPEG"
+        return _image_to_base64(self.levels[level].crop(box), format)
@@ -0,0 +1,122 @@
+import collections
+import math
+import re
+from dataclasses import dataclass
+from typing import Callable
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by do for from has have he her his i in is it its me "
+    "my of on or our she so that the their them they this to us was we were what "
+    "when where which who will with you your".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    return [
+        token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS
+    ]
+
+
+@dataclass(slots=True)
+class SearchHit:
+    doc_id: int
+    kind: str
+    timestamp: float
+    text: str
+    score: float
+
+
+class LexicalIndex:
+    """
+    Incrementally maintained BM25 inverted index with timestamped documents.
+
+    Adding or updating a document only records its text; it is (re)tokenized lazily
+    before the next search. This keeps `add` cheap enough to call on every text delta
+    of an utterance that is still growing.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # term -> {doc_id: term frequency}
+        self.postings: dict[str, dict[int, int]] = collections.defaultdict(dict)
+        self.doc_terms: dict[int, collections.Counter[str]] = {}
+        self.doc_lengths: dict[int, int] = {}
+        self.docs: dict[int, tuple[str, float, str]] = {}
+        self.dirty: set[int] = set()
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, doc_id: int, text: str, kind: str, timestamp: float):
+        """Adds a document, or replaces the text of an existing one."""
+        self.docs[doc_id] = (kind, timestamp, text)
+        self.dirty.add(doc_id)
+
+    def _unindex(self, doc_id: int):
+        terms = self.doc_terms.pop(doc_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            del self.postings[term][doc_id]
+            if len(self.postings[term]) == 0:
+                del self.postings[term]
+        self.total_length -= self.doc_lengths.pop(doc_id)
+
+    def _flush(self):
+        for doc_id in self.dirty:
+            self._unindex(doc_id)
+            terms = collections.Counter(tokenize(self.docs[doc_id][2]))
+            for term, frequency in terms.items():
+                self.postings[term][doc_id] = frequency
+            self.doc_terms[doc_id] = terms
+            self.doc_lengths[doc_id] = sum(terms.values())
+            self.total_length += self.doc_lengths[doc_id]
+        self.dirty.clear()
+
+    def search(
+        self,
+        query: str,
+        k: int = 5,
+        kinds: set[str] | None = None,
+        accept: Callable[[SearchHit], bool] | None = None,
+    ) -> list[SearchHit]:
+        self._flush()
+        if len(self.doc_terms) == 0:
+            return []
+
+        num_docs = len(self.doc_terms)
+        average_length = max(1.0, self.total_length / num_docs)
+        scores: dict[int, float] = collections.defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+
+            idf = math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings.items():
+                length = self.doc_lengths[doc_id]
+                scores[doc_id] += idf * (
+                    frequency
+                    * (self.k1 + 1)
+                    / (
+                        frequency
+                        + self.k1 * (1 - self.b + self.b * length / average_length)
+                    )
+                )
+
+        hits = []
+        for doc_id, score in sorted(scores.items(), key=lambda x: x[1], reverse=True):
+            kind, timestamp, text = self.docs[doc_id]
+            if kinds is not None and kind not in kinds:
+                continue
+            hit = SearchHit(doc_id, kind, timestamp, text, score)
+            if accept is not None and not accept(hit):
+                continue
+            hits.append(hit)
+            if len(hits) == k:
+                break
+
+        return hits
@@ -0,0 +1,383 @@
+"""
+Load generator for the /ws endpoint.
+
+Opens simulated extension clients against a running backend, in steps of growing
+size, and reports per step the server's CPU, RSS, event-loop lag, packet-processing
+latency and throughput, and finally the knee where throughput collapses. Audio
+latency and throughput are those of the transcription subscriber of each session's
+audio bus: from publication until it has handled a packet, including queue wait.
+
+Start the backend with local stubs for every upstream service first:
+
+    JITLENS_STUB_UPSTREAM=1 uvicorn websocket_endpoint:app --port 8000
+
+then run e.g.
+
+    python load_test.py --url ws://127.0.0.1:8000/ws --max-clients 64
+
+Pass `--audio-encoding mulaw` to send audio as the extension does after negotiating
+compressed audio: 24 kHz µ-law in binary frames instead of base64 PCM in JSON.
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import random
+import time
+
+import httpx
+import numpy as np
+import websockets
+from loguru import logger
+from PIL import Image, ImageDraw
+
+from audio_codecs import encode_mulaw, pack_audio_frame
+from server_metrics import (
+    histogram_percentiles,
+    merge_histograms,
+    percentiles,
+    subtract_histograms,
+)
+
+# What the extension sends: 4096-sample packets of 48 kHz audio, a frame every 5 s.
+SAMPLE_RATE = 48000
+SAMPLES_PER_PACKET = 4096
+PACKET_INTERVAL_S = SAMPLES_PER_PACKET / SAMPLE_RATE
+# With compressed audio, the same packet interval at the negotiated rate.
+MULAW_SAMPLE_RATE = 24000
+IMAGE_INTERVAL_S = 5.0
+IMAGE_SIZE = (1280, 720)
+# The audio bus subscriber whose latency and drops stand for audio processing.
+AUDIO_SUBSCRIBER = "transcription"
+
+# A step is past the knee if the server falls this far behind the offered load.
+MIN_THROUGHPUT_RATIO = 0.9
+
+
+def _make_audio_packets(
+    seed: int, sample_rate: int = SAMPLE_RATE, count: int = 16
+) -> list[np.ndarray]:
+    rng = np.random.default_rng(seed)
+    samples_per_packet = round(PACKET_INTERVAL_S * sample_rate)
+    packets = []
+    for i in range(count):
+        t = (np.arange(samples_per_packet) + i * samples_per_packet) / sample_rate
+        signal = 4000 * np.sin(2 * np.pi * 180 * t) + rng.normal(
+            0, 500, samples_per_packet
+        )
+        packets.append(np.clip(signal, -32768, 32767).astype(np.int16))
+    return packets
+
+
+def _make_frames(seed: int, count: int = 4) -> list[str]:
+    # Mostly static screens with a moving element, like a page with a video on it.
+    rng = random.Random(seed)
+    background = tuple(rng.randrange(256) for _ in range(3))
+    frames = []
+    for i in range(count):
+        image = Image.new("RGB", IMAGE_SIZE, background)
+        draw = ImageDraw.Draw(image)
+        for line in range(20):
+            draw.text((40, 40 + line * 24), f"Client {seed}, line {line}", fill="black")
+        x = 200 + i * 150
+        draw.rectangle((x, 300, x + 320, 480), fill=(255 - i * 40, 80, 40 + i * 50))
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        frames.append(base64.b64encode(buffer.getvalue()).decode())
+    return frames
+
+
+class SimulatedClient:
+    """Streams audio and screenshots at the extension's real-time pace."""
+
+    def __init__(self, url: str, client_id: int, audio_encoding: str = "pcm16"):
+        self.url = url
+        self.client_id = client_id
+        self.audio_encoding = audio_encoding
+        if audio_encoding == "mulaw":
+            self.audio_packets = [
+                encode_mulaw(packet)
+                for packet in _make_audio_packets(client_id, MULAW_SAMPLE_RATE)
+            ]
+        else:
+            self.audio_packets = [
+                base64.b64encode(packet.tobytes()).decode()
+                for packet in _make_audio_packets(client_id)
+            ]
+        self.frames = _make_frames(client_id)
+        self.sent_packets = 0
+        self.sent_bytes = 0
+        # How far behind its schedule each send completed.
+        self.send_lags_s: list[float] = []
+        self.error: str | None = None
+
+    def drain_send_lags(self) -> list[float]:
+        lags, self.send_lags_s = self.send_lags_s, []
+        return lags
+
+    async def _send(self, ws, message: dict | bytes, scheduled_at: float):
+        data = message if isinstance(message, bytes) else json.dumps(message)
+        await ws.send(data)
+        self.sent_packets += 1
+        self.sent_bytes += len(data)
+        self.send_lags_s.append(max(0.0, time.monotonic() - scheduled_at))
+
+    async def run(self):
+        try:
+            async with websockets.connect(self.url, max_size=None) as ws:
+                if self.audio_encoding == "mulaw":
+                    await ws.send(
+                        json.dumps(
+                            {
+                                "type": "audio_format",
+                                "encoding": "mulaw",
+                                "sample_rate": MULAW_SAMPLE_RATE,
+                            }
+                        )
+                    )
+                    reply = json.loads(await ws.recv())
+                    assert reply["type"] == "audio_format_accepted", reply
+                start = time.monotonic()
+                next_image_at = start
+                packet_index = 0
+                while True:
+                    scheduled_at = start + packet_index * PACKET_INTERVAL_S
+                    delay = scheduled_at - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+                    # Alternate between talking and silence, as a user in a call would.
+                    talking = (packet_index // 40) % 2 == 0
+                    sound_level = 12.0 if talking else 1.0
+                    audio = self.audio_packets[packet_index % len(self.audio_packets)]
+                    if self.audio_encoding == "mulaw":
+                        message = pack_audio_frame(sound_level, audio)
+                    else:
+                        message = {
+                            "type": "audio_packet",
+                            "timestamp": int(time.time() * 1000),
+                            "data": audio,
+                            "sound_level": sound_level,
+                        }
+                    await self._send(ws, message, scheduled_at)
+                    packet_index += 1
+
+                    if time.monotonic() >= next_image_at:
+                        await self._send(
+                            ws,
+                            {
+                                "type": "image_packet",
+                                "timestamp": int(time.time() * 1000),
+                                "data": self.frames[packet_index % len(self.frames)],
+                            },
+                            next_image_at,
+                        )
+                        next_image_at += IMAGE_INTERVAL_S
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = repr(e)
+            logger.warning(f"Client {self.client_id} failed: {self.error}")
+
+
+def _offered_packets_per_s(num_clients: int) -> float:
+    return num_clients * (1 / PACKET_INTERVAL_S + 1 / IMAGE_INTERVAL_S)
+
+
+def _latency_percentiles(counts: list[int] | None) -> dict | None:
+    if counts is None or sum(counts) == 0:
+        return None
+    return {"count": sum(counts), **histogram_percentiles(counts)}
+
+
+def _step_report(
+    num_clients: int,
+    duration_s: float,
+    before: dict,
+    after: dict,
+    clients: list[SimulatedClient],
+) -> dict:
+    # The server reports cumulative histograms; the step is their difference.
+    histograms = subtract_histograms(
+        after["latency_histograms"], before["latency_histograms"]
+    )
+    audio_latencies = histograms.get(f"audio_bus.{AUDIO_SUBSCRIBER}")
+    audio_waits = histograms.get(f"audio_bus.{AUDIO_SUBSCRIBER}.wait")
+    dropped_key = f"audio_bus.{AUDIO_SUBSCRIBER}.dropped"
+    audio_dropped = after["counters"].get(dropped_key, 0) - before["counters"].get(
+        dropped_key, 0
+    )
+    processed = sum(histograms.get("image_packet", [])) + sum(audio_latencies or [])
+    send_lags = [lag for client in clients for lag in client.drain_send_lags()]
+    loop_lags = histograms.get("loop_lag")
+    return {
+        "workers": after["workers"],
+        "clients": num_clients,
+        "failed_clients": sum(client.error is not None for client in clients),
+        "offered_packets_per_s": _offered_packets_per_s(num_clients),
+        "processed_packets_per_s": processed / duration_s,
+        "cpu_percent": 100 * (after["cpu_s"] - before["cpu_s"]) / duration_s,
+        "rss_mb": after["rss_bytes"] / 2**20,
+        "loop_lag_p99_s": (
+            histogram_percentiles(loop_lags)["p99"] if loop_lags else None
+        ),
+        "upload_kb_per_s_per_client": (
+            sum(client.sent_bytes for client in clients)
+            / 1024
+            / duration_s
+            / num_clients
+        ),
+        "audio_latency_s": _latency_percentiles(audio_latencies),
+        "audio_wait_s": _latency_percentiles(audio_waits),
+        "audio_dropped": audio_dropped,
+        "image_latency_s": _latency_percentiles(histograms.get("image_packet")),
+        "send_lag_s": percentiles(send_lags),
+    }
+
+
+def _knee_reason(report: dict) -> str | None:
+    throughput_ratio = (
+        report["processed_packets_per_s"] / report["offered_packets_per_s"]
+    )
+    if report["failed_clients"] > 0:
+        return f"{report['failed_clients']} clients disconnected"
+    if report["audio_dropped"] > 0:
+        return f"{AUDIO_SUBSCRIBER} dropped {report['audio_dropped']} audio packets"
+    if (report["audio_wait_s"] or {"p99": 0.0})["p99"] > PACKET_INTERVAL_S:
+        return f"{AUDIO_SUBSCRIBER} falls behind the audio packet interval"
+    if throughput_ratio < MIN_THROUGHPUT_RATIO:
+        return f"server processed only {throughput_ratio:.0%} of the offered packets"
+    if report["send_lag_s"]["p99"] > PACKET_INTERVAL_S:
+        return "clients could not send in real time (backpressure)"
+    if (report["loop_lag_p99_s"] or 0) > PACKET_INTERVAL_S:
+        return "event loop lag exceeds the audio packet interval"
+    return None
+
+
+def _print_report(report: dict):
+    audio = report["audio_latency_s"] or {"p50": 0.0, "p99": 0.0}
+    print(
+        f"{report['clients']:>4} clients on {report['workers']} workers | "
+        f"{report['processed_packets_per_s']:7.1f}/{report['offered_packets_per_s']:7.1f} pkt/s | "
+        f"cpu {report['cpu_percent']:5.1f}% | rss {report['rss_mb']:7.1f} MB | "
+        f"up {report['upload_kb_per_s_per_client']:6.1f} KB/s/client | "
+        f"loop p99 {1000 * (report['loop_lag_p99_s'] or 0):6.1f} ms | "
+        f"audio p50/p99 {1000 * audio['p50']:6.2f}/{1000 * audio['p99']:6.2f} ms | "
+        f"dropped {report['audio_dropped']} | "
+        f"send lag p99 {1000 * report['send_lag_s']['p99']:6.1f} ms",
+        flush=True,
+    )
+
+
+async def run_load_test(
+    url: str,
+    metrics_url: str,
+    start_clients: int,
+    max_clients: int,
+    step_factor: float,
+    step_duration_s: float,
+    warmup_s: float,
+    stop_at_knee: bool,
+    audio_encoding: str = "pcm16",
+) -> list[dict]:
+    clients: list[SimulatedClient] = []
+    tasks: list[asyncio.Task] = []
+    reports = []
+
+    async with httpx.AsyncClient() as http:
+        num_clients = start_clients
+        try:
+            while num_clients <= max_clients:
+                for client_id in range(len(clients), num_clients):
+                    client = SimulatedClient(url, client_id, audio_encoding)
+                    clients.append(client)
+                    tasks.append(asyncio.create_task(client.run()))
+
+                # Let new sessions connect, then start a fresh measurement window.
+                await asyncio.sleep(warmup_s)
+                for client in clients:
+                    client.drain_send_lags()
+                    client.sent_bytes = 0
+                before = (await http.get(metrics_url)).json()
+                t0 = time.monotonic()
+                await asyncio.sleep(step_duration_s)
+                after = (await http.get(metrics_url)).json()
+
+                report = _step_report(
+                    num_clients, time.monotonic() - t0, before, after, clients
+                )
+                report["knee"] = _knee_reason(report)
+                reports.append(report)
+                _print_report(report)
+                if report["knee"] is not None and stop_at_knee:
+                    break
+
+                num_clients = max(num_clients + 1, round(num_clients * step_factor))
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    knee = next((report for report in reports if report["knee"] is not None), None)
+    if knee is None:
+        print(f"No knee found up to {reports[-1]['clients']} clients.")
+    else:
+        healthy = [report for report in reports if report["knee"] is None]
+        sustained = healthy[-1]["clients"] if healthy else 0
+        print(
+            f"Knee at {knee['clients']} clients: {knee['knee']}. "
+            f"Last healthy step: {sustained} clients."
+        )
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="ws://127.0.0.1:8000/ws")
+    parser.add_argument(
+        "--metrics-url",
+        default=None,
+        help="Defaults to /metrics on the same host as --url.",
+    )
+    parser.add_argument("--start-clients", type=int, default=1)
+    parser.add_argument("--max-clients", type=int, default=64)
+    parser.add_argument("--step-factor", type=float, default=2.0)
+    parser.add_argument("--step-duration-s", type=float, default=20.0)
+    parser.add_argument("--warmup-s", type=float, default=5.0)
+    parser.add_argument(
+        "--keep-going",
+        action="store_true",
+        help="Keep ramping up after the knee instead of stopping there.",
+    )
+    parser.add_argument("--audio-encoding", choices=["pcm16", "mulaw"], default="pcm16")
+    parser.add_argument("--output", help="Write the per-step reports as JSON here.")
+    args = parser.parse_args()
+
+    metrics_url = args.metrics_url or (
+        args.url.replace("ws://", "http://", 1)
+        .replace("wss://", "https://", 1)
+        .rsplit("/", 1)[0]
+        + "/metrics"
+    )
+    reports = asyncio.run(
+        run_load_test(
+            args.url,
+            metrics_url,
+            args.start_clients,
+            args.max_clients,
+            args.step_factor,
+            args.step_duration_s,
+            args.warmup_s,
+            stop_at_knee=not args.keep_going,
+            audio_encoding=args.audio_encoding,
+        )
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
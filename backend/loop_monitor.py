@@ -0,0 +1,171 @@
+import asyncio
+import collections
+import json
+import linecache
+import os
+import sys
+import threading
+import time
+
+from loguru import logger
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+REPORT_FILE_NAME = "loop_lag.jsonl"
+MAX_STACK_DEPTH = 30
+
+
+def _describe_frame(frame) -> dict:
+    filename = frame.f_code.co_filename
+    return {
+        "function": frame.f_code.co_name,
+        "file": (
+            os.path.relpath(filename, BACKEND_DIR)
+            if filename.startswith(BACKEND_DIR)
+            else filename
+        ),
+        "line": frame.f_lineno,
+        "source": linecache.getline(filename, frame.f_lineno).strip(),
+        "in_backend": filename.startswith(BACKEND_DIR),
+    }
+
+
+def _call_site(stack: list[dict]) -> str:
+    # The innermost frame in our own code is the call that blocked the loop, e.g.
+    # `data = sps.resample(data, num_samples)` when the time is spent inside scipy.
+    for frame in stack:
+        if frame["in_backend"]:
+            return f"{frame['function']} ({frame['file']}:{frame['line']}): {frame['source']}"
+    frame = stack[0]
+    return f"{frame['function']} ({frame['file']}:{frame['line']})"
+
+
+class LoopLagMonitor:
+    """
+    Opt-in profiler for event-loop stalls.
+
+    A coroutine on the loop records a heartbeat every `interval_s`. A watchdog thread
+    samples the loop thread's stack whenever the heartbeat is older than
+    `threshold_s`. When the stall ends, it is attributed to the call site seen in
+    most samples and appended as a JSON line to `{log_dir}/loop_lag.jsonl`.
+
+    There is one monitor per event loop. A stall delays every session on the loop, so
+    the report is also appended in each directory registered with `add_report_dir`.
+    """
+
+    def __init__(
+        self,
+        log_dir: str,
+        interval_s: float = 0.05,
+        threshold_s: float = 0.1,
+        sample_interval_s: float = 0.01,
+        histogram=None,
+    ):
+        self.report_path = os.path.join(log_dir, REPORT_FILE_NAME)
+        # Replaced rather than mutated, so the watchdog thread can iterate it safely.
+        self.report_dirs: frozenset[str] = frozenset()
+        self.interval_s = interval_s
+        self.threshold_s = threshold_s
+        self.sample_interval_s = sample_interval_s
+        # Optional `server_metrics.LatencyHistogram` that also receives every lag.
+        self.histogram = histogram
+        self.lags_s: collections.deque[float] = collections.deque(maxlen=1000)
+        self.max_lag_s = 0.0
+        self.stall_count = 0
+        self.last_beat = time.monotonic()
+        self.loop_thread_id = None
+        self.heartbeat_task = None
+        self.watchdog_thread = None
+        self.stop_event = threading.Event()
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+        self.watchdog_thread = threading.Thread(
+            target=self._watchdog, name="loop-lag-watchdog", daemon=True
+        )
+        self.watchdog_thread.start()
+        logger.info(f"Loop lag monitor started, writing reports to {self.report_path}")
+
+    def add_report_dir(self, directory: str):
+        self.report_dirs = self.report_dirs | {directory}
+
+    def remove_report_dir(self, directory: str):
+        self.report_dirs = self.report_dirs - {directory}
+
+    def stop(self):
+        self.stop_event.set()
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+
+    async def _heartbeat_loop(self):
+        while True:
+            t0 = time.monotonic()
+            await asyncio.sleep(self.interval_s)
+            now = time.monotonic()
+            lag_s = max(0.0, now - t0 - self.interval_s)
+            self.lags_s.append(lag_s)
+            self.max_lag_s = max(self.max_lag_s, lag_s)
+            if self.histogram is not None:
+                self.histogram.record("loop_lag", lag_s)
+            self.last_beat = now
+
+    def _sample_stack(self) -> list[dict]:
+        frame = sys._current_frames().get(self.loop_thread_id)  # type: ignore
+        stack = []
+        while frame is not None and len(stack) < MAX_STACK_DEPTH:
+            stack.append(_describe_frame(frame))
+            frame = frame.f_back
+        return stack
+
+    def _watchdog(self):
+        stall_beat = None
+        samples: collections.Counter[str] = collections.Counter()
+        stacks: dict[str, list[dict]] = {}
+
+        while not self.stop_event.wait(self.sample_interval_s):
+            beat = self.last_beat
+            if stall_beat is not None and beat != stall_beat:
+                # The loop is responsive again: report the stall.
+                self._write_report(stall_beat, beat, samples, stacks)
+                stall_beat = None
+                samples = collections.Counter()
+                stacks = {}
+
+            if time.monotonic() - beat > self.threshold_s:
+                stack = self._sample_stack()
+                if len(stack) == 0:
+                    continue
+                stall_beat = beat
+                call_site = _call_site(stack)
+                samples[call_site] += 1
+                stacks.setdefault(call_site, stack)
+
+    def _write_report(self, stall_beat, resumed_beat, samples, stacks):
+        self.stall_count += 1
+        call_site, _ = samples.most_common(1)[0]
+        duration_s = resumed_beat - stall_beat - self.interval_s
+        report = {
+            "time": time.time() - (time.monotonic() - stall_beat),
+            "duration_s": round(duration_s, 4),
+            "call_site": call_site,
+            "samples": dict(samples),
+            "stack": stacks[call_site],
+        }
+        logger.warning(f"Event loop blocked for {duration_s:.3f}s by {call_site}")
+        line = json.dumps(report) + "\n"
+        report_paths = [self.report_path] + [
+            os.path.join(directory, REPORT_FILE_NAME) for directory in self.report_dirs
+        ]
+        for report_path in report_paths:
+            with open(report_path, "a") as f:
+                f.write(line)
+
+    def stats(self) -> dict:
+        lags = sorted(self.lags_s) or [0.0]
+        return {
+            "lag_p50_s": lags[len(lags) // 2],
+            "lag_p99_s": lags[min(len(lags) - 1, int(len(lags) * 0.99))],
+            "lag_max_s": self.max_lag_s,
+            "stall_count": self.stall_count,
+        }
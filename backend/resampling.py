@@ -0,0 +1,46 @@
+import math
+
+import numpy as np
+import scipy.signal as sps
+
+
+class StreamingResampler:
+    """
+    Resamples a stream of 16-bit PCM chunks of any size.
+
+    Unlike resampling each chunk on its own (e.g. with `scipy.signal.resample`), the
+    anti-aliasing FIR filter state and the decimation phase carry over between calls,
+    so there are no discontinuities at chunk boundaries and small chunks are cheap.
+    Chunks may be bytes or int16 arrays, e.g. straight out of `audio_codecs`.
+    """
+
+    def __init__(self, input_rate: int, output_rate: int, taps_per_phase: int = 32):
+        divisor = math.gcd(input_rate, output_rate)
+        self.up = output_rate // divisor
+        self.down = input_rate // divisor
+        factor = max(self.up, self.down)
+        if factor == 1:
+            # Same rate: chunks pass through unfiltered.
+            return
+        # Low-pass at the lower of the two Nyquist frequencies, on the upsampled signal.
+        # Scaled by `up` to make up for the energy lost to zero-stuffing.
+        self.taps = sps.firwin(taps_per_phase * factor + 1, 1 / factor) * self.up
+        self.zi = np.zeros(len(self.taps) - 1)
+        # Index, in the next upsampled chunk, of the next sample to keep.
+        self.phase = 0
+
+    def process(self, pcm16: bytes | np.ndarray) -> bytes:
+        if self.up == self.down:
+            return np.asarray(np.frombuffer(pcm16, dtype=np.int16)).tobytes()
+
+        samples = np.frombuffer(pcm16, dtype=np.int16).astype(np.float64)
+        if self.up > 1:
+            upsampled = np.zeros(len(samples) * self.up)
+            upsampled[:: self.up] = samples
+            samples = upsampled
+
+        filtered, self.zi = sps.lfilter(self.taps, 1.0, samples, zi=self.zi)
+        output = filtered[self.phase :: self.down]
+        self.phase = (self.phase - len(filtered)) % self.down
+
+        return np.clip(np.round(output), -32768, 32767).astype(np.int16).tobytes()
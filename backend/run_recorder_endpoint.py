@@ -1,34 +1,43 @@
 import base64
 
-from fastapi import FastAPI, WebSocket
-import wave
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+
+from wav_recorder import WavRecorder
 
 app = FastAPI()
 
+# Rotate every 10 minutes of 48 KHz 16-bit mono audio.
+MAX_FILE_DURATION_S = 600
+
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
-    data = b""
-    while True:
-        message = await websocket.receive_json()
-        match message["type"]:
-            case "audio_packet":
-                # logger.debug("Received audio packet")
-                data += base64.b64decode(message["data"].encode("utf-8"))
-
-                with wave.open("recording.wav", "wb") as writer:
-                    writer.setframerate(48000)
-                    writer.setnchannels(1)
-                    writer.setsampwidth(2)
-                    writer.setnframes(len(data) // 2)
-                    writer.writeframes(data)
-                    print("Writing data:", len(data) // 2, "frames")
-
-            case "image_packet":
-                pass
-            case _:
-                print("Wrong type")
+    recorder = WavRecorder(
+        ".",
+        prefix="recording",
+        sample_rate=48000,
+        channels=1,
+        sample_width=2,
+        max_file_duration_s=MAX_FILE_DURATION_S,
+        compress=True,
+    )
+    try:
+        while True:
+            message = await websocket.receive_json()
+            match message["type"]:
+                case "audio_packet":
+                    # logger.debug("Received audio packet")
+                    recorder.write(base64.b64decode(message["data"].encode("utf-8")))
+
+                case "image_packet":
+                    pass
+                case _:
+                    print("Wrong type")
+    except WebSocketDisconnect:
+        print("WebSocket disconnected")
+    finally:
+        recorder.close()
 
 
 # with wave.open("recording.wav", "rb") as reader:
@@ -0,0 +1,34 @@
+"""
+Runs the backend with one worker process per core.
+
+Each WebSocket session stays on the worker that accepted it, so session state needs
+no sharing. Session directories are allocated atomically, and captions and
+synthesized phrases are shared between workers through `captions.db` and
+`./tts_cache`.
+
+    python serve.py --port 8000 --workers 8
+"""
+
+import argparse
+import os
+
+import uvicorn
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    uvicorn.run(
+        "websocket_endpoint:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+    )
+
+
+if __name__ == "__main__":
+    main()
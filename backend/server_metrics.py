@@ -0,0 +1,170 @@
+import asyncio
+import bisect
+import collections
+import json
+import os
+import resource
+import time
+
+# Latency histogram buckets: 10 per decade from 10 µs to 100 s.
+BUCKET_BOUNDS_S = [10 ** (exponent / 10) for exponent in range(-50, 21)]
+
+
+def percentiles(values: list[float], points=(50, 90, 99)) -> dict:
+    values = sorted(values) or [0.0]
+    return {
+        f"p{point}": values[min(len(values) - 1, len(values) * point // 100)]
+        for point in points
+    }
+
+
+def histogram_percentiles(counts: list[int], points=(50, 90, 99)) -> dict:
+    """Upper bucket bounds of the given percentiles of a histogram."""
+    total = sum(counts)
+    result = {}
+    for point in points:
+        target = total * point / 100
+        cumulative = 0
+        for bound, count in zip(BUCKET_BOUNDS_S + [float("inf")], counts):
+            cumulative += count
+            if cumulative >= target:
+                result[f"p{point}"] = bound if total > 0 else 0.0
+                break
+    return result
+
+
+class LatencyHistogram:
+    """
+    Cumulative per-kind latency histograms.
+
+    Unlike raw samples, histograms from several processes or points in time can be
+    added and subtracted, e.g. to get the percentiles of one load test step across
+    all workers.
+    """
+
+    def __init__(self):
+        self.counts: dict[str, list[int]] = {}
+
+    def record(self, kind: str, latency_s: float):
+        if kind not in self.counts:
+            self.counts[kind] = [0] * (len(BUCKET_BOUNDS_S) + 1)
+        self.counts[kind][bisect.bisect_left(BUCKET_BOUNDS_S, latency_s)] += 1
+
+    def snapshot(self) -> dict[str, list[int]]:
+        return {kind: list(counts) for kind, counts in self.counts.items()}
+
+
+def merge_histograms(snapshots: list[dict[str, list[int]]]) -> dict:
+    merged: dict[str, list[int]] = {}
+    for snapshot in snapshots:
+        for kind, counts in snapshot.items():
+            total = merged.setdefault(kind, [0] * len(counts))
+            for i, count in enumerate(counts):
+                total[i] += count
+    return merged
+
+
+def subtract_histograms(after: dict, before: dict) -> dict:
+    return {
+        kind: [a - b for a, b in zip(counts, before.get(kind, [0] * len(counts)))]
+        for kind, counts in after.items()
+    }
+
+
+def process_usage() -> dict:
+    """CPU time and resident memory of this process."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    rss_bytes = None
+    try:
+        with open("/proc/self/statm") as f:
+            rss_bytes = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except FileNotFoundError:
+        # Not Linux: fall back to the peak, which `ru_maxrss` reports in bytes on macOS.
+        rss_bytes = usage.ru_maxrss
+
+    return {
+        "cpu_s": usage.ru_utime + usage.ru_stime,
+        "rss_bytes": rss_bytes,
+    }
+
+
+class WorkerMetrics:
+    """
+    Publishes this worker's cumulative metrics to a directory shared by all workers.
+
+    Every worker writes `{directory}/{pid}.json` once per `interval_s`, so whichever
+    worker serves a /metrics request can report the totals of all of them.
+    """
+
+    def __init__(self, directory: str, interval_s: float = 1.0, stale_s: float = 5.0):
+        self.directory = directory
+        self.interval_s = interval_s
+        self.stale_s = stale_s
+        self.path = os.path.join(directory, f"{os.getpid()}.json")
+        self.histogram = LatencyHistogram()
+        # Cumulative event counts, e.g. packets dropped by a slow audio subscriber.
+        self.counters: collections.Counter[str] = collections.Counter()
+        self.publish_task = None
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def start(self, get_session_count):
+        self.get_session_count = get_session_count
+        self.publish_task = asyncio.create_task(self._publish_loop())
+
+    def stop(self):
+        if self.publish_task is not None:
+            self.publish_task.cancel()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _snapshot(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "time": time.time(),
+            "sessions": self.get_session_count(),
+            "latency_histograms": self.histogram.snapshot(),
+            "counters": dict(self.counters),
+            **process_usage(),
+        }
+
+    def publish(self):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(self._snapshot(), f)
+        os.replace(temporary_path, self.path)
+
+    async def _publish_loop(self):
+        while True:
+            self.publish()
+            await asyncio.sleep(self.interval_s)
+
+    def aggregate(self) -> dict:
+        # Our own numbers are always fresh; other workers' are at most `interval_s` old.
+        self.publish()
+        workers = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    worker = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            if time.time() - worker["time"] < self.stale_s:
+                workers.append(worker)
+
+        return {
+            "workers": len(workers),
+            "sessions": sum(worker["sessions"] for worker in workers),
+            "cpu_s": sum(worker["cpu_s"] for worker in workers),
+            "rss_bytes": sum(worker["rss_bytes"] for worker in workers),
+            "latency_histograms": merge_histograms(
+                [worker["latency_histograms"] for worker in workers]
+            ),
+            "counters": sum(
+                (collections.Counter(worker["counters"]) for worker in workers),
+                collections.Counter(),
+            ),
+        }
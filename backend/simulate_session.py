@@ -0,0 +1,193 @@
+"""
+Replays a session through `Streaming` and `Context` in virtual time.
+
+Upstream services are replaced by the local stubs in `stub_upstream.py`, and the
+event loop skips ahead whenever all tasks are waiting, so an hour-long session runs
+in seconds with the same scheduling decisions as in real time. Audio comes from a
+16-bit mono WAV recording (e.g. one written by `run_recorder_endpoint.py`) or is
+synthesized; frames come from a directory of images or are synthesized.
+
+    python simulate_session.py --duration-s 3600
+    python simulate_session.py --wav recording_0000.wav --images-dir ./context_0
+"""
+
+import argparse
+import asyncio
+import glob
+import os
+import tempfile
+import time
+import tracemalloc
+import wave
+
+import numpy as np
+import scipy.signal as sps
+from loguru import logger
+from PIL import Image, ImageDraw
+
+from clock import VirtualClock, VirtualTimeEventLoop
+from context import Context
+from server_metrics import process_usage
+from speech_synthesis import ToneSpeechSynthesizer
+from streaming import INPUT_SAMPLE_RATE, Streaming
+from streaming_openai_util import first_token_tracker
+from stub_upstream import STUB_UTTERANCES, NullAudioOutput, StubAsyncOpenAI
+from transcription import ScriptedTranscriber
+
+# The same pacing as the extension: 4096-sample audio packets, a frame every 5 s.
+SAMPLES_PER_PACKET = 4096
+PACKET_INTERVAL_S = SAMPLES_PER_PACKET / INPUT_SAMPLE_RATE
+IMAGE_INTERVAL_S = 5.0
+
+
+def _audio_packets(wav_path: str | None):
+    if wav_path is None:
+        # Alternate ~3.4 s of talking with ~3.4 s of silence.
+        t = np.arange(SAMPLES_PER_PACKET) / INPUT_SAMPLE_RATE
+        speech = (4000 * np.sin(2 * np.pi * 180 * t)).astype(np.int16).tobytes()
+        silence = bytes(SAMPLES_PER_PACKET * 2)
+        index = 0
+        while True:
+            talking = (index // 40) % 2 == 0
+            yield (speech, 12.0) if talking else (silence, 1.0)
+            index += 1
+
+    with wave.open(wav_path, "rb") as wav_file:
+        assert wav_file.getnchannels() == 1 and wav_file.getsampwidth() == 2
+        samples = np.frombuffer(
+            wav_file.readframes(wav_file.getnframes()), dtype=np.int16
+        )
+        if wav_file.getframerate() != INPUT_SAMPLE_RATE:
+            samples = sps.resample_poly(
+                samples, INPUT_SAMPLE_RATE, wav_file.getframerate()
+            )
+            samples = np.clip(samples, -32768, 32767).astype(np.int16)
+
+    while True:
+        for i in range(0, len(samples) - SAMPLES_PER_PACKET + 1, SAMPLES_PER_PACKET):
+            packet = samples[i : i + SAMPLES_PER_PACKET]
+            # The extension's sound level: RMS of the [-1, 1] signal, times 100.
+            rms = np.sqrt(np.mean((packet.astype(np.float64) / 32768) ** 2))
+            yield packet.tobytes(), rms * 100
+
+
+def _frames(images_dir: str | None):
+    if images_dir is not None:
+        paths = sorted(glob.glob(os.path.join(images_dir, "*.png")))
+        assert len(paths) > 0, f"No PNG images in {images_dir}"
+        while True:
+            for path in paths:
+                yield Image.open(path).convert("RGB")
+
+    index = 0
+    while True:
+        # A new page every ten frames, with a moving element in between.
+        image = Image.new("RGB", (1280, 720), (255, 255, 255))
+        draw = ImageDraw.Draw(image)
+        for line in range(20):
+            draw.text((40, 40 + line * 24), f"Page {index // 10}, line {line}", "black")
+        x = 200 + (index % 10) * 80
+        draw.rectangle((x, 500, x + 200, 620), fill=(200, 60, 60))
+        yield image
+        index += 1
+
+
+async def simulate(args) -> dict:
+    loop = asyncio.get_running_loop()
+    clock = VirtualClock(loop)
+    # Time-to-first-token samples are measured in virtual time as well.
+    first_token_tracker.clock = clock
+    openai_client = StubAsyncOpenAI()
+    context = Context(args.log_dir, openai_client, clock=clock)  # type: ignore
+    streaming = Streaming(
+        context,
+        openai_client,  # type: ignore
+        silence_period_s=1,
+        thinking_period_s=5,
+        transcriber=ScriptedTranscriber(STUB_UTTERANCES),
+        synthesizer=ToneSpeechSynthesizer(),
+        audio_output=NullAudioOutput(),
+        audio_streaming=True,
+        clock=clock,
+    )
+    tasks = [
+        asyncio.create_task(context._index_images()),
+        asyncio.create_task(streaming.run()),
+    ]
+
+    audio = _audio_packets(args.wav)
+    frames = _frames(args.images_dir)
+    start = clock.monotonic()
+    next_image_at = start
+    packet_index = 0
+    while clock.monotonic() - start < args.duration_s:
+        # Sleep until the next packet is due, as the extension would send it.
+        await clock.sleep(start + packet_index * PACKET_INTERVAL_S - clock.monotonic())
+        packet, sound_level = next(audio)
+        await streaming.on_audio_packet_received(packet, sound_level)
+        packet_index += 1
+
+        if clock.monotonic() >= next_image_at:
+            context.add_image(next(frames), clock.now())
+            next_image_at += IMAGE_INTERVAL_S
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    return {
+        "virtual_duration_s": clock.monotonic() - start,
+        "content_records": len(context.content),
+        "images": len(context.images),
+        "captions": len(context.captions),
+        "llm_requests": openai_client.chat.completions.request_count,
+        "queues": streaming.get_queue_stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--duration-s", type=float, default=3600)
+    parser.add_argument("--wav", help="16-bit mono WAV to replay as the user's audio.")
+    parser.add_argument("--images-dir", help="Directory of PNG frames to replay.")
+    parser.add_argument("--log-dir", default=None)
+    parser.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="Also report the peak Python heap (slows the replay down).",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    args.log_dir = args.log_dir or tempfile.mkdtemp(prefix="simulated_context_")
+    if not args.verbose:
+        logger.remove()
+        logger.add(lambda message: print(message, end=""), level="WARNING")
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    loop = VirtualTimeEventLoop()
+    try:
+        report = loop.run_until_complete(simulate(args))
+    finally:
+        loop.close()
+    wall_s = time.perf_counter() - t0
+
+    print(f"Simulated {report['virtual_duration_s']:.0f}s in {wall_s:.1f}s")
+    print(f"  speedup: {report['virtual_duration_s'] / wall_s:.0f}x")
+    if args.tracemalloc:
+        _, peak_traced_bytes = tracemalloc.get_traced_memory()
+        print(f"  peak Python heap: {peak_traced_bytes / 2**20:.1f} MB")
+    print(f"  RSS: {process_usage()['rss_bytes'] / 2**20:.1f} MB")
+    for key in ["content_records", "images", "captions", "llm_requests"]:
+        print(f"  {key}: {report[key]}")
+    for name, stats in report["queues"].items():
+        print(
+            f"  queue {name}: max depth {stats['max_depth']}, "
+            f"dropped {stats['dropped_count']}"
+        )
+    print(f"  log dir: {args.log_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import asyncio
+import base64
+import json
+import os
+from abc import ABC, abstractmethod
+from typing import AsyncIterator
+
+import numpy as np
+
+from ws_client import ReconnectingWebSocket, WebSocketPool
+
+CARTESIA_WS_URL = "wss://api.cartesia.ai/tts/websocket"
+CARTESIA_VERSION = "2024-11-13"
+CARTESIA_SAMPLE_RATE = 48000
+CARTESIA_API_KEY = os.environ.get("CARTESIA_API_KEY")
+DEFAULT_UTTERANCE_ID = "base-cartesia-context"
+
+
+def cartesia_ws_url(api_key: str) -> str:
+    # https://docs.cartesia.ai/2024-11-13/api-reference/tts/tts
+    return f"{CARTESIA_WS_URL}?api_key={api_key}&cartesia_version={CARTESIA_VERSION}"
+
+
+class SpeechSynthesizer(ABC):
+    """
+    Streams text in and 16-bit mono PCM audio out.
+
+    Text sent without an `utterance_id` continues one open-ended utterance, so that
+    prosody carries across token batches. Text sent with an `utterance_id` is
+    synthesized as a standalone utterance, unless `continue_utterance` is set, in
+    which case more text for it follows and it is finished by a final call (which
+    may have empty text).
+
+    Events are dicts of the form `{"type": "chunk", "data": bytes, "utterance_id": str}`,
+    and `{"type": "done", "utterance_id": str}` once a standalone utterance is complete.
+    An utterance that fails instead ends with
+    `{"type": "error", "utterance_id": str, "message": str}`.
+    """
+
+    sample_rate: int = CARTESIA_SAMPLE_RATE
+
+    async def connect(self):
+        pass
+
+    @abstractmethod
+    async def synthesize(
+        self,
+        text: str,
+        utterance_id: str | None = None,
+        continue_utterance: bool = False,
+    ):
+        pass
+
+    @abstractmethod
+    def events(self) -> AsyncIterator[dict]:
+        pass
+
+    async def close(self):
+        pass
+
+
+class CartesiaSpeechSynthesizer(SpeechSynthesizer):
+    def __init__(
+        self,
+        api_key: str | None = CARTESIA_API_KEY,
+        ws_pool: WebSocketPool | None = None,
+        model_id: str = "sonic-2",
+        voice_id: str = "a0e99841-438c-4a64-b679-ae501e7d6091",
+        language: str = "en",
+        sample_rate: int = CARTESIA_SAMPLE_RATE,
+    ):
+        if api_key is None and ws_pool is None:
+            raise ValueError("CARTESIA_API_KEY is not set.")
+
+        self.api_key = api_key
+        self.ws_pool = ws_pool
+        self.model_id = model_id
+        self.voice_id = voice_id
+        self.language = language
+        self.sample_rate = sample_rate
+        self.ws: ReconnectingWebSocket | None = None
+        self.event_queue: asyncio.Queue[dict] = asyncio.Queue()
+        # Utterances sent but not yet done, which a reconnect would lose.
+        self.inflight_utterance_ids: set[str] = set()
+        self.receive_task = None
+
+    async def connect(self):
+        # Take a pre-warmed connection when a pool is available.
+        if self.ws_pool is not None:
+            self.ws = self.ws_pool.acquire()
+        else:
+            assert self.api_key is not None
+            self.ws = ReconnectingWebSocket(cartesia_ws_url(self.api_key))
+        self.ws.add_reconnect_listener(
+            # Cartesia contexts do not survive the connection they were opened on.
+            lambda: self._fail_inflight_utterances("Connection lost")
+        )
+        await self.ws.ensure_connected()
+        self.receive_task = asyncio.create_task(self._receive_loop())
+
+    def _fail_inflight_utterances(self, message: str):
+        for utterance_id in self.inflight_utterance_ids:
+            self.event_queue.put_nowait(
+                {"type": "error", "utterance_id": utterance_id, "message": message}
+            )
+        self.inflight_utterance_ids.clear()
+
+    async def synthesize(
+        self,
+        text: str,
+        utterance_id: str | None = None,
+        continue_utterance: bool = False,
+    ):
+        assert self.ws is not None
+        await self.ws.send(
+            json.dumps(
+                {
+                    "model_id": self.model_id,
+                    "transcript": text,
+                    "voice": {
+                        "mode": "id",
+                        "id": self.voice_id,
+                    },
+                    "language": self.language,
+                    "context_id": utterance_id or DEFAULT_UTTERANCE_ID,
+                    "output_format": {
+                        "container": "raw",
+                        "encoding": "pcm_s16le",
+                        "sample_rate": self.sample_rate,
+                    },
+                    "add_timestamps": True,
+                    "continue": utterance_id is None or continue_utterance,
+                }
+            )
+        )
+        # Added after sending, so a reconnect made by this send does not fail it.
+        self.inflight_utterance_ids.add(utterance_id or DEFAULT_UTTERANCE_ID)
+
+    async def _receive_loop(self):
+        assert self.ws is not None
+        while True:
+            data = json.loads(await self.ws.recv())
+            utterance_id = data.get("context_id")
+            if data["type"] == "chunk":
+                self.event_queue.put_nowait(
+                    {
+                        "type": "chunk",
+                        "data": base64.b64decode(data["data"]),
+                        "utterance_id": utterance_id,
+                    }
+                )
+            elif data["type"] == "error" and utterance_id is None:
+                # Not tied to one context, e.g. a rejected request.
+                self._fail_inflight_utterances(str(data.get("error")))
+            elif data["type"] in ("done", "error"):
+                self.inflight_utterance_ids.discard(utterance_id)
+                event = {"type": data["type"], "utterance_id": utterance_id}
+                if data["type"] == "error":
+                    event["message"] = str(data.get("error"))
+                self.event_queue.put_nowait(event)
+
+    async def events(self):
+        while True:
+            yield await self.event_queue.get()
+
+    async def close(self):
+        if self.receive_task is not None:
+            self.receive_task.cancel()
+        if self.ws is not None:
+            await self.ws.close()
+
+
+class ToneSpeechSynthesizer(SpeechSynthesizer):
+    """
+    Deterministic local stub that renders each text as a quiet sine tone.
+
+    The tone lasts `seconds_per_character` per character and its pitch is derived
+    from the text, so identical texts produce identical audio.
+    """
+
+    def __init__(
+        self,
+        sample_rate: int = CARTESIA_SAMPLE_RATE,
+        seconds_per_character: float = 0.06,
+        chunk_s: float = 0.1,
+    ):
+        self.sample_rate = sample_rate
+        self.seconds_per_character = seconds_per_character
+        self.chunk_s = chunk_s
+        self.event_queue: asyncio.Queue[dict] = asyncio.Queue()
+
+    async def synthesize(
+        self,
+        text: str,
+        utterance_id: str | None = None,
+        continue_utterance: bool = False,
+    ):
+        num_samples = round(len(text) * self.seconds_per_character * self.sample_rate)
+        frequency = 220 + sum(text.encode("utf-8")) % 440
+        t = np.arange(num_samples) / self.sample_rate
+        pcm = (np.sin(2 * np.pi * frequency * t) * 3000).astype(np.int16).tobytes()
+
+        chunk_bytes = round(self.chunk_s * self.sample_rate) * 2
+        for i in range(0, len(pcm), chunk_bytes):
+            self.event_queue.put_nowait(
+                {
+                    "type": "chunk",
+                    "data": pcm[i : i + chunk_bytes],
+                    "utterance_id": utterance_id or DEFAULT_UTTERANCE_ID,
+                }
+            )
+        if utterance_id is not None and not continue_utterance:
+            self.event_queue.put_nowait({"type": "done", "utterance_id": utterance_id})
+
+    async def events(self):
+        while True:
+            yield await self.event_queue.get()
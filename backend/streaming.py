@@ -1,24 +1,31 @@
 import asyncio
-import base64
 import json
-from datetime import datetime
-import os
 import traceback
 from loguru import logger
 
 import numpy as np
 import scipy.signal as sps
-import websockets
 from openai import AsyncOpenAI
 
+from bounded_queue import BoundedQueue
+from clock import Clock, SystemClock
 from context import Context
+from resampling import StreamingResampler
 from streaming_openai_util import stream_openai_request_and_accumulate_toolcalls
-from audio_piping import VBcablePlayer
+from token_budget import estimate_messages_tokens
+from tools import RECALL_TOOL
+from speech_synthesis import CartesiaSpeechSynthesizer, SpeechSynthesizer
+from transcription import OpenAIRealtimeTranscriber, Transcriber
 
-OPENAI_WS_URL = "wss://api.openai.com/v1/realtime?intent=transcription"
-CARTESIA_WS_URL = "wss://api.cartesia.ai/tts/websocket"
-CARTESIA_SAMPLE_RATE = 48000
-CARTESIA_API_KEY = os.environ["CARTESIA_API_KEY"]
+# Sample rate of the audio packets sent by the extension.
+INPUT_SAMPLE_RATE = 48000
+
+
+def _coalesce_transcribed_text(older: dict, newer: dict) -> dict:
+    return {
+        "text": older["text"] + newer["text"],
+        "turn_end": older["turn_end"] or newer["turn_end"],
+    }
 
 
 class Streaming:
@@ -28,140 +35,214 @@ class Streaming:
         openai_client: AsyncOpenAI,
         silence_period_s: float = 5,
         thinking_period_s: float = 15,
+        max_input_tokens: int = 16000,
+        queue_stats_period_s: float = 30,
+        transcriber: Transcriber | None = None,
+        synthesizer: SpeechSynthesizer | None = None,
+        audio_output=None,
+        hedge_user_queries: bool = False,
+        hedge_model: str | None = None,
+        audio_streaming: bool = False,
+        audio_frame_s: float = 0.1,
+        clock: Clock | None = None,
     ):
+        self.clock = clock or SystemClock()
         self.inflight_request_buffer = {}
         self.inflight_request_counter = 0
         self.cancelled_tool_calls = set()
         self.active_tool_call_tasks: list[asyncio.Task] = []
         self.model_consumer_generator = None
-        self.audio_transcription_queue = asyncio.Queue()
-        self.transcribed_text_queue = asyncio.Queue()
-        self.tool_call_queue = asyncio.Queue()
-        self.tts_text_queue = asyncio.Queue()
+        # Bounded so that a slow upstream degrades gracefully instead of growing memory.
+        self.audio_transcription_queue = BoundedQueue(
+            64, policy="drop_oldest", name="audio_transcription", clock=self.clock
+        )
+        self.transcribed_text_queue = BoundedQueue(
+            256,
+            policy="coalesce",
+            coalesce_fn=_coalesce_transcribed_text,
+            name="transcribed_text",
+            clock=self.clock,
+        )
+        self.tool_call_queue = BoundedQueue(
+            64, policy="block", name="tool_call", clock=self.clock
+        )
+        self.tts_text_queue = BoundedQueue(
+            256,
+            policy="coalesce",
+            coalesce_fn=lambda a, b: a + b,
+            name="tts_text",
+            clock=self.clock,
+        )
         self.openai_client = openai_client
         self.context = context
         self.silence_period_s = silence_period_s
         self.thinking_period_s = thinking_period_s
-        self.last_text_received_timestamp = datetime.now()
-        self.last_user_query_request_timestamp = datetime.now()
-        self.last_background_request_timestamp = datetime.now()
-        self.openai_realtime_transcription_ws_ctx_manager = websockets.connect(
-            OPENAI_WS_URL,
-            additional_headers={
-                "Authorization": f"Bearer {openai_client.api_key}",
-                "OpenAI-Beta": "realtime=v1",
-            },
+        self.max_input_tokens = max_input_tokens
+        self.queue_stats_period_s = queue_stats_period_s
+        # Race a second request if a user query's first token is late (see
+        # `stream_openai_request_and_accumulate_toolcalls`).
+        self.hedge_user_queries = hedge_user_queries
+        self.hedge_model = hedge_model
+        self.last_text_received_timestamp = self.clock.now()
+        self.last_user_query_request_timestamp = self.clock.now()
+        self.last_background_request_timestamp = self.clock.now()
+        self.transcriber = transcriber or OpenAIRealtimeTranscriber(
+            openai_client.api_key
         )
-        self.openai_realtime_transcription_ws = None
-        self.pc_cable = VBcablePlayer(input_sample_rate=CARTESIA_SAMPLE_RATE)
+        self.synthesizer = synthesizer or CartesiaSpeechSynthesizer()
+        if audio_output is None:
+            # Imported here so that headless runs (e.g. load tests) need no audio device.
+            from audio_piping import VBcablePlayer
+
+            audio_output = VBcablePlayer(input_sample_rate=self.synthesizer.sample_rate)
+        self.pc_cable = audio_output
         self.buffer = bytes()
-        self.cartesia_ws = None
+        # In streaming mode, audio is forwarded in `audio_frame_s` frames as it arrives
+        # and the transcriber's server-side VAD segments the turns.
+        self.audio_streaming = audio_streaming
+        self.audio_frame_bytes = round(audio_frame_s * self.transcriber.sample_rate) * 2
+        self.set_input_sample_rate(INPUT_SAMPLE_RATE)
 
     async def run(self):
-        self.openai_realtime_transcription_ws = (
-            await self.openai_realtime_transcription_ws_ctx_manager.__aenter__()
-        )
-        # https://docs.cartesia.ai/2024-11-13/api-reference/tts/tts
-        self.cartesia_ws = await websockets.connect(
-            f"{CARTESIA_WS_URL}?api_key={CARTESIA_API_KEY}&cartesia_version=2024-11-13",
-        )
+        await asyncio.gather(self.transcriber.connect(), self.synthesizer.connect())
+
         tasks = [
             asyncio.create_task(self.transcribe_loop()),
             asyncio.create_task(self.generate_response_tokens_loop()),
             asyncio.create_task(self.synthesize_speech_loop()),
             asyncio.create_task(self.playback_speech_loop()),
+            asyncio.create_task(self.log_queue_stats_loop()),
         ]
         await asyncio.gather(*tasks)
 
     async def close(self):
         await asyncio.gather(*self.active_tool_call_tasks)
-        await self.openai_realtime_transcription_ws_ctx_manager.__aexit__(
-            None, None, None
-        )
+        await self.transcriber.close()
+        await self.synthesizer.close()
+
+    def get_queue_stats(self) -> dict:
+        queues = [
+            self.audio_transcription_queue,
+            self.transcribed_text_queue,
+            self.tool_call_queue,
+            self.tts_text_queue,
+            self.context.indexing_queue,
+        ]
+        return {queue.name: queue.stats() for queue in queues}
+
+    async def log_queue_stats_loop(self):
+        dropped_counts = {}
+        while True:
+            await self.clock.sleep(self.queue_stats_period_s)
+            for name, stats in self.get_queue_stats().items():
+                if stats["dropped_count"] > dropped_counts.get(name, 0):
+                    logger.warning(
+                        f"Queue '{name}' is overloaded: {stats['dropped_count']} items dropped so far."
+                    )
+                dropped_counts[name] = stats["dropped_count"]
+            logger.debug("Queue stats: " + json.dumps(self.get_queue_stats()))
+
+    def set_input_sample_rate(self, sample_rate: int):
+        # Clients may negotiate a lower rate than the default (see `audio_codecs`).
+        self.input_sample_rate = sample_rate
+        self.resampler = StreamingResampler(sample_rate, self.transcriber.sample_rate)
+        self.buffer = bytes()
 
-    async def on_audio_packet_received(self, packet_data: bytes, sound_level: float):
+    async def on_audio_packet_received(
+        self, packet_data: bytes | np.ndarray, sound_level: float
+    ):
+        # `packet_data` is 16-bit PCM at `input_sample_rate`, as bytes or int16 array.
         # logger.debug("Received audio packet")
-        assert self.openai_realtime_transcription_ws
-        self.buffer += packet_data
-        if len(self.buffer) < 48000 * 2 or (
-            sound_level < 6 and len(self.buffer) < 48000 * 10
+        if self.audio_streaming:
+            self.buffer += self.resampler.process(packet_data)
+            while len(self.buffer) >= self.audio_frame_bytes:
+                frame = self.buffer[: self.audio_frame_bytes]
+                self.buffer = self.buffer[self.audio_frame_bytes :]
+                await self.transcriber.send_audio(frame)
+            return
+
+        self.buffer += bytes(packet_data)
+        # Commit after 1 s of audio, or up to 5 s while the user keeps talking.
+        bytes_per_s = self.input_sample_rate * 2
+        if len(self.buffer) < bytes_per_s or (
+            sound_level < 6 and len(self.buffer) < bytes_per_s * 5
         ):
             return
 
-        # The buffer is 48 KHz. We want 24 KHz.
+        # Resample the buffer to what the transcriber expects (e.g. 24 KHz).
         data = np.frombuffer(self.buffer, dtype=np.int16)
-        num_samples = round(len(data) / 2)
+        num_samples = round(
+            len(data) * self.transcriber.sample_rate / self.input_sample_rate
+        )
         data = sps.resample(data, num_samples)
         # Ensure the data remains in 16-bit range.
         data = np.clip(data, -32768, 32767).astype(np.int16)
-        buffer = data.tobytes()
 
-        data = base64.b64encode(buffer).decode("utf-8")
         self.buffer = b""
-        await self.openai_realtime_transcription_ws.send(
-            json.dumps({"type": "input_audio_buffer.append", "audio": data})
-        )
-        await self.openai_realtime_transcription_ws.send(
-            json.dumps({"type": "input_audio_buffer.commit"})
-        )
+        await self.transcriber.send_audio(data.tobytes())
+        await self.transcriber.commit()
 
     async def on_transcribed_text_received(self, text: str):
         logger.debug("Received transcribed text: " + text)
-        await self.transcribed_text_queue.put({"text": text})
+        await self.transcribed_text_queue.put({"text": text, "turn_end": False})
+
+    def _new_text_pending(self) -> bool:
+        # Turn ends without text (e.g. a VAD turn over noise) are not new speech.
+        return any(
+            chunk["text"].strip() != "" for chunk in self.transcribed_text_queue.items()
+        )
 
     async def transcribe_loop(self):
         logger.info("Starting transcription loop")
 
-        assert self.openai_realtime_transcription_ws
-
-        await self.openai_realtime_transcription_ws.send(
-            json.dumps(
-                {
-                    "type": "transcription_session.update",
-                    "session": {
-                        "input_audio_format": "pcm16",
-                        "input_audio_transcription": {
-                            "model": "whisper-1",
-                            # "model": "gpt-4o-transcribe",
-                            "prompt": "",
-                            "language": "en",
-                        },
-                        "turn_detection": {
-                            "type": "server_vad",
-                            "threshold": 0.5,
-                            "prefix_padding_ms": 300,
-                            "silence_duration_ms": 500,
-                        },
-                        "input_audio_noise_reduction": {"type": "near_field"},
-                        "include": [
-                            # "item.input_audio_transcription.logprobs",
-                        ],
-                    },
-                }
+        async for event in self.transcriber.events():
+            if event["type"] == "delta":
+                await self.on_transcribed_text_received(event["text"])
+            elif event["type"] == "turn_end":
+                logger.debug("Received turn end")
+                await self.transcribed_text_queue.put({"text": "", "turn_end": True})
+
+    async def _build_request_messages(self, before: list, after: list) -> list:
+        # Fit the fine-grained context into what remains of the input-token ceiling.
+        # Built off the event loop, so ingestion carries on while images are encoded.
+        token_budget = self.max_input_tokens - estimate_messages_tokens(before + after)
+        return (
+            before
+            + await self.context.build_latest_finegrained_context(
+                token_budget=token_budget
             )
+            + after
         )
 
-        while True:
-            # TODO: Parse from the OpenAI response.
-            # https://platform.openai.com/docs/guides/realtime-transcription#realtime-transcription-sessions
-            result = await self.openai_realtime_transcription_ws.recv()
-
-            # logger.info("Received transcription result: " + repr(result))
-
-            data = json.loads(result)
-            if data["type"] == "conversation.item.input_audio_transcription.delta":
-                if data["delta"] != "":
-                    await self.on_transcribed_text_received(data["delta"])
-
     async def handle_tool_call(self, tool_call: dict):
         # Handles the tool call.
-        if tool_call["name"] == "recall":
-            query = tool_call["arguments"]["query"]
+        name = tool_call["function"]["name"]
+        arguments = json.loads(tool_call["function"]["arguments"])
+        if name == "recall":
+            query = arguments["query"]
 
-            result = await self.context.recall(query)
+            # Speak the answer as it is generated, then record it as the call's result.
+            answer = ""
+            try:
+                async for token in self.context.recall_stream(
+                    query, tool_call_id=tool_call["id"]
+                ):
+                    answer += token
+                    await self.tts_text_queue.put(token)
+            except Exception as e:
+                logger.error(
+                    "Error in recall: " + repr(e) + "\n\n" + traceback.format_exc()
+                )
+                answer += " (The recall failed.)"
+            self.context.add_tool_call_result(
+                tool_call["id"],
+                {"answer": answer},
+                answer,
+                timestamp=self.clock.now(),
+            )
 
-        elif tool_call["name"] == "research":
-            query = tool_call["arguments"]["query"]
+        elif name == "research":
+            query = arguments["query"]
 
     async def generate_response_tokens_loop(self):
         logger.info("Starting response generation loop")
@@ -170,27 +251,35 @@ class Streaming:
             try:
                 # Dequeue all of the transcribed text and add it to the context.
                 run_once = False
+                turn_ended = False
                 while not run_once or not self.transcribed_text_queue.empty():
                     run_once = True
-                    transcribed_text_chunk = await asyncio.wait_for(
+                    transcribed_text_chunk = await self.clock.wait_for(
                         self.transcribed_text_queue.get(), timeout=self.silence_period_s
                     )
+                    turn_ended = turn_ended or transcribed_text_chunk["turn_end"]
+                    if transcribed_text_chunk["text"] == "":
+                        continue
 
                     self.context.add_text(
                         transcribed_text_chunk["text"],
                         role="user",
-                        timestamp=datetime.now(),
+                        timestamp=self.clock.now(),
                     )
-                    self.last_text_received_timestamp = datetime.now()
+                    self.last_text_received_timestamp = self.clock.now()
 
                     logger.debug(
                         "Added text to context: " + repr(transcribed_text_chunk["text"])
                     )
 
-                continue
+                if not turn_ended:
+                    continue
+                # The server VAD detected the end of the turn: respond right away
+                # instead of waiting out the silence period.
+                logger.debug("Turn end reached.")
             except asyncio.TimeoutError:
-                # If there was a timeout, it means that the silence period has been reached,
-                # and we are OK to send a request to OpenAI.
+                # Fallback for when no turn end arrives: after the silence period, we
+                # are OK to send a request to OpenAI.
                 logger.debug("Silence period reached.")
                 pass
 
@@ -200,7 +289,7 @@ class Streaming:
                 >= self.last_text_received_timestamp
             )
             time_since_background_request = (
-                datetime.now()
+                self.clock.now()
                 - max(
                     self.last_user_query_request_timestamp,
                     self.last_background_request_timestamp,
@@ -224,33 +313,37 @@ class Streaming:
                 text = ""
 
                 # Do a "background" request.
-                self.last_background_request_timestamp = datetime.now()
+                self.last_background_request_timestamp = self.clock.now()
                 async for delta in stream_openai_request_and_accumulate_toolcalls(
                     self.openai_client,
                     # TODO: Make a nicer prompt for handling 'background tasks'.
-                    [
-                        {
-                            "role": "system",
-                            "content": "You are a helpful assistant who helps a user. You will receive images and text representing what a user sees and says. Please respond to the user accordingly. If you do not receive any images, say 'NO IMAGES'. Please respond in a single sentence, because you will be speaking to the user.",
-                        }
-                    ]
-                    + self.context.get_latest_finegrained_context()
-                    + [
-                        {
-                            "role": "user",
-                            "content": "I want to listen to music, but I don't know what I can use to listen to it. Please let me know whenever you see something that might be nice.",
-                        }
-                    ],
+                    await self._build_request_messages(
+                        [
+                            {
+                                "role": "system",
+                                "content": "You are a helpful assistant who helps a user. You will receive images and text representing what a user sees and says. Please respond to the user accordingly. If you do not receive any images, say 'NO IMAGES'. Please respond in a single sentence, because you will be speaking to the user.",
+                            }
+                        ],
+                        [
+                            {
+                                "role": "user",
+                                "content": "I want to listen to music, but I don't know what I can use to listen to it. Please let me know whenever you see something that might be nice.",
+                            }
+                        ],
+                    ),
                     model="gpt-4o",
                 ):
                     if delta["type"] == "tool_call":
-                        logger.debug("Received toolcall delta: " + delta["text"])
+                        logger.debug(
+                            "Received tool call: "
+                            + delta["tool_call"]["function"]["name"]  # type: ignore
+                        )
                         # Add the 'tool call' to the list of running tasks.
                         self.context.add_tool_call_request(
                             delta["tool_call"]["function"]["name"],  # type: ignore
                             delta["tool_call"]["function"]["arguments"],  # type: ignore
                             delta["tool_call"]["id"],  # type: ignore
-                            timestamp=datetime.now(),
+                            timestamp=self.clock.now(),
                         )
                         task = event_loop.create_task(
                             self.handle_tool_call(delta["tool_call"])  # type: ignore
@@ -261,10 +354,10 @@ class Streaming:
                         text += delta["text"]
                         await self.tts_text_queue.put(delta["text"])
                         self.context.add_text(
-                            delta["text"], "assistant", timestamp=datetime.now()
+                            delta["text"], "assistant", timestamp=self.clock.now()
                         )
 
-                    if not self.transcribed_text_queue.empty():
+                    if self._new_text_pending():
                         # Interrupt the response if new text was received.
                         logger.debug(
                             "Interrupting response due to new text in tts_text_queue."
@@ -279,26 +372,34 @@ class Streaming:
 
                 # Do a "user query" request (handling the new text as if it's a user query).
                 try:
-                    self.last_user_query_request_timestamp = datetime.now()
+                    self.last_user_query_request_timestamp = self.clock.now()
                     async for delta in stream_openai_request_and_accumulate_toolcalls(
                         self.openai_client,
-                        [
-                            {
-                                "role": "system",
-                                "content": "You will receive a stream of images and text representing what a user sees and says. Please respond to the user accordingly. If you do not receive any images, say 'NO IMAGES'. Please respond in a single sentence, because you will be speaking to the user.",
-                            },
-                            *self.context.get_latest_finegrained_context(),
-                        ],
+                        await self._build_request_messages(
+                            [
+                                {
+                                    "role": "system",
+                                    "content": "You will receive a stream of images and text representing what a user sees and says. Please respond to the user accordingly. If you do not receive any images, say 'NO IMAGES'. Please respond in a single sentence, because you will be speaking to the user.",
+                                },
+                            ],
+                            [],
+                        ),
                         model="gpt-4o",
+                        hedge=self.hedge_user_queries,
+                        hedge_model=self.hedge_model,
+                        tools=[RECALL_TOOL],
                     ):
                         if delta["type"] == "tool_call":
-                            logger.debug("Received toolcall delta: " + delta["text"])
+                            logger.debug(
+                                "Received tool call: "
+                                + delta["tool_call"]["function"]["name"]  # type: ignore
+                            )
                             # Add the 'tool call' to the list of running tasks.
                             self.context.add_tool_call_request(
                                 delta["tool_call"]["function"]["name"],  # type: ignore
                                 delta["tool_call"]["function"]["arguments"],  # type: ignore
                                 delta["tool_call"]["id"],  # type: ignore
-                                timestamp=datetime.now(),
+                                timestamp=self.clock.now(),
                             )
                             task = event_loop.create_task(
                                 self.handle_tool_call(delta["tool_call"])  # type: ignore
@@ -308,11 +409,11 @@ class Streaming:
                             # logger.debug("Received text delta: " + delta["text"])
                             text += delta["text"]
                             self.context.add_text(
-                                delta["text"], "assistant", timestamp=datetime.now()
+                                delta["text"], "assistant", timestamp=self.clock.now()
                             )
                             await self.tts_text_queue.put(delta["text"])
 
-                        if not self.transcribed_text_queue.empty():
+                        if self._new_text_pending():
                             # Interrupt the response if new text was received.
                             logger.debug(
                                 "Interrupting response due to new text in tts_text_queue."
@@ -334,8 +435,6 @@ class Streaming:
         has_sent_initial_sentence = False
         minimum_bootstrap_length = 6
 
-        assert self.cartesia_ws is not None
-
         while True:
             if (
                 not has_sent_initial_sentence
@@ -343,10 +442,10 @@ class Streaming:
                 or self.tts_text_queue.empty()
             ):
                 # Wait for a while to get some initial text.
-                await asyncio.sleep(0.1)
+                await self.clock.sleep(0.1)
                 continue
 
-            if not self.transcribed_text_queue.empty():
+            if self._new_text_pending():
                 # Flush tts_text_queue
                 while self.tts_text_queue.qsize() > 0:
                     await self.tts_text_queue.get()
@@ -361,37 +460,13 @@ class Streaming:
 
             logger.debug("Received text for TTS: " + repr(text))
 
-            # Send the text to the Cartesia websocket.
-            await self.cartesia_ws.send(
-                json.dumps(
-                    {
-                        "model_id": "sonic-2",
-                        "transcript": text,
-                        "voice": {
-                            "mode": "id",
-                            "id": "a0e99841-438c-4a64-b679-ae501e7d6091",
-                        },
-                        "language": "en",
-                        "context_id": "base-cartesia-context",
-                        "output_format": {
-                            "container": "raw",
-                            "encoding": "pcm_s16le",
-                            "sample_rate": 48000,
-                        },
-                        "add_timestamps": True,
-                        "continue": True,
-                    }
-                )
-            )
+            await self.synthesizer.synthesize(text)
 
             has_sent_initial_sentence = True
 
     async def playback_speech_loop(self):
         logger.info("Starting playback loop")
 
-        assert self.cartesia_ws is not None
-
-        while True:
-            data = json.loads(await self.cartesia_ws.recv())
-            if data["type"] == "chunk":
-                self.pc_cable.write(base64.b64decode(data["data"]))
+        async for event in self.synthesizer.events():
+            if event["type"] == "chunk":
+                self.pc_cable.write(event["data"])
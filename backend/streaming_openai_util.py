@@ -1,8 +1,13 @@
+import asyncio
+import collections
 import json
+import re
 
 from loguru import logger
 from openai import AsyncOpenAI
 
+from clock import Clock, SystemClock
+
 
 def _valid_json(text: str):
     try:
@@ -12,22 +17,267 @@ def _valid_json(text: str):
         return False
 
 
+def _partial_json_value_start(arguments: str, field: str) -> int | None:
+    match = re.search(rf'"{re.escape(field)}"\s*:\s*', arguments)
+    return match.end() if match is not None else None
+
+
+def partial_json_string(arguments: str, field: str) -> str | None:
+    """
+    The decoded value of a top-level string field in incomplete JSON, as far as it
+    has arrived, e.g. `"Hel` for `{"response": "Hel`. None until the value starts.
+    """
+    start = _partial_json_value_start(arguments, field)
+    if start is None or start >= len(arguments) or arguments[start] != '"':
+        return None
+
+    raw = []
+    i = start + 1
+    while i < len(arguments):
+        char = arguments[i]
+        if char == '"':
+            break
+        if char == "\\":
+            escape_length = 6 if arguments[i + 1 : i + 2] == "u" else 2
+            if i + escape_length > len(arguments):
+                # Hold back an escape sequence that is cut off.
+                break
+            if (
+                escape_length == 6
+                and 0xD800 <= int(arguments[i + 2 : i + 6], 16) <= 0xDBFF
+                and i + 12 > len(arguments)
+            ):
+                # Also hold back the high half of a surrogate pair until the low half
+                # arrives; decoded alone, it would be a lone surrogate.
+                break
+            raw.append(arguments[i : i + escape_length])
+            i += escape_length
+            continue
+        raw.append(char)
+        i += 1
+
+    return json.loads('"' + "".join(raw) + '"')
+
+
+def partial_json_bool(arguments: str, field: str) -> bool | None:
+    """A top-level boolean field of incomplete JSON, or None until it is complete."""
+    start = _partial_json_value_start(arguments, field)
+    if start is None:
+        return None
+    if arguments.startswith("true", start):
+        return True
+    if arguments.startswith("false", start):
+        return False
+    return None
+
+
+async def stream_tool_call(
+    openai_client: AsyncOpenAI, messages: list, tools: list, model="gpt-4o-mini"
+):
+    """
+    Forces a single tool call and yields its name and the arguments received so far
+    after every chunk, so that callers can act on the arguments before they are done.
+    """
+    stream = await openai_client.chat.completions.create(
+        model=model,
+        messages=messages,
+        tools=tools,
+        tool_choice="required",
+        parallel_tool_calls=False,
+        stream=True,
+    )
+    name = ""
+    arguments = ""
+    try:
+        async for chunk in stream:
+            for tool_call in chunk.choices[0].delta.tool_calls or []:
+                if tool_call.index != 0 or tool_call.function is None:
+                    continue
+                name += tool_call.function.name or ""
+                arguments += tool_call.function.arguments or ""
+            if name != "":
+                yield name, arguments
+    finally:
+        await stream.close()
+
+
+class FirstTokenTracker:
+    """
+    Rolling time-to-first-token samples per model.
+
+    The hedging deadline for a model is the given percentile of its recent samples,
+    or `default_deadline_s` until there are `min_samples` of them.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        window: int = 200,
+        min_samples: int = 20,
+        default_deadline_s: float = 1.5,
+        clock: Clock | None = None,
+    ):
+        self.clock = clock or SystemClock()
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.default_deadline_s = default_deadline_s
+        self.samples: dict[str, collections.deque[float]] = collections.defaultdict(
+            lambda: collections.deque(maxlen=window)
+        )
+        self.hedged_count = 0
+        self.hedge_won_count = 0
+
+    def record(self, model: str, first_token_s: float):
+        self.samples[model].append(first_token_s)
+
+    def _percentile(self, model: str, percentile: float) -> float:
+        samples = sorted(self.samples[model])
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+    def deadline_s(self, model: str) -> float:
+        if len(self.samples[model]) < self.min_samples:
+            return self.default_deadline_s
+        return self._percentile(model, self.percentile)
+
+    def stats(self) -> dict:
+        return {
+            "hedged_count": self.hedged_count,
+            "hedge_won_count": self.hedge_won_count,
+            "first_token_s": {
+                model: {
+                    "p50": self._percentile(model, 50),
+                    "p95": self._percentile(model, 95),
+                    "p99": self._percentile(model, 99),
+                }
+                for model, samples in self.samples.items()
+                if len(samples) > 0
+            },
+        }
+
+
+first_token_tracker = FirstTokenTracker()
+
+
+def _tools_kwargs(tools: list | None) -> dict:
+    return {"tools": tools} if tools else {}
+
+
+async def _start_stream(
+    openai_client: AsyncOpenAI, messages: list, model: str, tools: list | None = None
+):
+    # Opens a stream and waits for its first chunk.
+    t0 = first_token_tracker.clock.monotonic()
+    stream = None
+    try:
+        stream = await openai_client.chat.completions.create(
+            model=model, messages=messages, stream=True, **_tools_kwargs(tools)
+        )
+        first_chunk = await stream.__anext__()
+    except asyncio.CancelledError:
+        # Lost the race. The elapsed time is only a lower bound on this model's
+        # latency, so it is not recorded; it would drag the percentiles down.
+        if stream is not None:
+            await stream.close()
+        raise
+
+    first_token_tracker.record(model, first_token_tracker.clock.monotonic() - t0)
+    return stream, first_chunk
+
+
+async def _hedged_stream(
+    openai_client: AsyncOpenAI,
+    messages: list,
+    model: str,
+    hedge_model: str,
+    tools: list | None = None,
+):
+    """
+    Streams chunks from `model`, hedged by a second request to `hedge_model`.
+
+    The second request is only sent if the first token has not arrived by the
+    deadline. Whichever request produces its first chunk first is streamed, and the
+    other one is cancelled.
+    """
+    tasks = [asyncio.create_task(_start_stream(openai_client, messages, model, tools))]
+    winner = None
+    try:
+        done, _ = await asyncio.wait(
+            tasks, timeout=first_token_tracker.deadline_s(model)
+        )
+        if len(done) == 0:
+            logger.info(f"No first token from {model} yet, hedging with {hedge_model}.")
+            first_token_tracker.hedged_count += 1
+            tasks.append(
+                asyncio.create_task(
+                    _start_stream(openai_client, messages, hedge_model, tools)
+                )
+            )
+
+        pending = set(tasks)
+        while winner is None and len(pending) > 0:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            # Prefer the primary request if both finished in the same iteration.
+            for task in sorted(done, key=tasks.index):
+                if task.exception() is None:
+                    winner = task
+                    break
+    finally:
+        # Also runs if the caller is cancelled while waiting, so no request outlives it.
+        for task in tasks:
+            if task is winner:
+                continue
+            if task.done():
+                if not task.cancelled() and task.exception() is None:
+                    await task.result()[0].close()
+            else:
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if winner is None:
+        raise tasks[0].exception()  # type: ignore
+    if winner is not tasks[0]:
+        first_token_tracker.hedge_won_count += 1
+
+    stream, first_chunk = winner.result()
+    try:
+        yield first_chunk
+        async for chunk in stream:
+            yield chunk
+    finally:
+        await stream.close()
+
+
 async def stream_openai_request_and_accumulate_toolcalls(
-    openai_client: AsyncOpenAI, messages: list, model="gpt-4o"
+    openai_client: AsyncOpenAI,
+    messages: list,
+    model="gpt-4o",
+    hedge: bool = False,
+    hedge_model: str | None = None,
+    tools: list | None = None,
 ):
     aggregated_tool_calls: dict[int, dict] = {}
     completed_tool_calls = set()
 
-    async for chunk in await openai_client.chat.completions.create(
-        model=model, messages=messages, stream=True
-    ):
+    if hedge:
+        chunks = _hedged_stream(
+            openai_client, messages, model, hedge_model or model, tools
+        )
+    else:
+        chunks = await openai_client.chat.completions.create(
+            model=model, messages=messages, stream=True, **_tools_kwargs(tools)
+        )
+
+    async for chunk in chunks:
         delta = chunk.choices[0].delta
 
         if delta.tool_calls is not None:
             for tool_call in delta.tool_calls:
                 if tool_call.index not in aggregated_tool_calls:
                     aggregated_tool_calls[tool_call.index] = {
-                        "function": {"name": "", "arguments": ""}
+                        "id": None,
+                        "function": {"name": "", "arguments": ""},
                     }
 
                 if tool_call.id is not None:
@@ -0,0 +1,202 @@
+import asyncio
+import json
+import os
+from types import SimpleNamespace
+
+# Local stand-ins for the upstream services, used when the backend runs with
+# JITLENS_STUB_UPSTREAM=1 (e.g. under `load_test.py`). Latencies are simulated with
+# sleeps, so the stubs cost the backend about as much CPU as the real clients would.
+
+STUB_RESPONSE = "I can see your screen, and nothing in it needs your attention."
+STUB_UTTERANCES = [
+    "what am I looking at right now",
+    "can you remind me what was on the page a minute ago",
+    "is there anything here I could use to listen to music",
+]
+
+
+def _count_images(messages: list) -> int:
+    return sum(
+        1
+        for message in messages
+        if isinstance(message.get("content"), list)
+        for part in message["content"]
+        if part.get("type") == "image_url"
+    )
+
+
+def _example_arguments(schema: dict):
+    # Smallest value that satisfies a strict JSON schema.
+    match schema["type"]:
+        case "object":
+            return {
+                name: _example_arguments(property_schema)
+                for name, property_schema in schema["properties"].items()
+            }
+        case "array":
+            return []
+        case "string":
+            return "stub"
+        case "integer" | "number":
+            return 0
+        case "boolean":
+            return False
+
+
+def _last_user_text(messages: list) -> str:
+    for message in reversed(messages):
+        if message["role"] != "user":
+            continue
+        if isinstance(message["content"], str):
+            return message["content"]
+        texts = [part["text"] for part in message["content"] if part["type"] == "text"]
+        if len(texts) > 0:
+            return texts[-1]
+    return ""
+
+
+def _stub_tool_call(messages: list, tools: list) -> tuple[str, dict]:
+    names = [tool["function"]["name"] for tool in tools]
+    if "direct_response" in names:
+        # Keeps recall to a single round trip.
+        return "direct_response", {"response": STUB_RESPONSE}
+    if "store_captions" in names:
+        return "store_captions", {
+            "captions": [
+                {"image_index": i, "caption": f"A stub caption for image {i}."}
+                for i in range(_count_images(messages))
+            ]
+        }
+
+    function = tools[0]["function"]
+    return function["name"], _example_arguments(function["parameters"])
+
+
+class _StubCompletions:
+    def __init__(self, latency_s: float, first_token_s: float, token_interval_s: float):
+        self.latency_s = latency_s
+        self.first_token_s = first_token_s
+        self.token_interval_s = token_interval_s
+        self.request_count = 0
+
+    async def create(
+        self,
+        model: str,
+        messages: list,
+        stream: bool = False,
+        tools: list | None = None,
+        **kwargs,
+    ):
+        self.request_count += 1
+        if stream:
+            return _StubStream(
+                self._stream_deltas(messages, tools, kwargs.get("tool_choice")),
+                self.first_token_s,
+                self.token_interval_s,
+            )
+
+        await asyncio.sleep(self.latency_s)
+        tool_calls = None
+        content = None
+        if tools:
+            name, arguments = _stub_tool_call(messages, tools)
+            tool_calls = [
+                SimpleNamespace(
+                    id=f"call_stub_{self.request_count}",
+                    type="function",
+                    function=SimpleNamespace(
+                        name=name, arguments=json.dumps(arguments)
+                    ),
+                )
+            ]
+        else:
+            content = STUB_RESPONSE
+
+        message = SimpleNamespace(content=content, tool_calls=tool_calls)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    def _stream_deltas(self, messages: list, tools: list | None, tool_choice):
+        names = [tool["function"]["name"] for tool in tools or []]
+        # Asking to be reminded of something is answered by calling `recall`.
+        if (
+            "recall" in names
+            and messages[-1]["role"] == "user"
+            and "remind" in _last_user_text(messages)
+        ):
+            name, arguments = "recall", {"query": _last_user_text(messages)}
+        elif tools and tool_choice == "required":
+            name, arguments = _stub_tool_call(messages, tools)
+        else:
+            words = STUB_RESPONSE.split(" ")
+            return [
+                SimpleNamespace(content=word if i == 0 else " " + word, tool_calls=None)
+                for i, word in enumerate(words)
+            ]
+
+        # The arguments arrive a few characters at a time, like the real API's.
+        arguments_json = json.dumps(arguments)
+        pieces = [arguments_json[i : i + 4] for i in range(0, len(arguments_json), 4)]
+        return [
+            SimpleNamespace(
+                content=None,
+                tool_calls=[
+                    SimpleNamespace(
+                        index=0,
+                        id=f"call_stub_{self.request_count}" if i == 0 else None,
+                        function=SimpleNamespace(
+                            name=name if i == 0 else None, arguments=piece
+                        ),
+                    )
+                ],
+            )
+            for i, piece in enumerate(pieces)
+        ]
+
+
+class _StubStream:
+    # Mirrors the parts of `openai.AsyncStream` the backend uses.
+
+    def __init__(self, deltas: list, first_token_s: float, token_interval_s: float):
+        self.deltas = deltas
+        self.first_token_s = first_token_s
+        self.token_interval_s = token_interval_s
+        self.index = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.index >= len(self.deltas):
+            raise StopAsyncIteration
+
+        await asyncio.sleep(
+            self.first_token_s if self.index == 0 else self.token_interval_s
+        )
+        delta = self.deltas[self.index]
+        self.index += 1
+        return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+    async def close(self):
+        self.index = len(self.deltas)
+
+
+class StubAsyncOpenAI:
+    """Answers the chat completion calls the backend makes, without a network."""
+
+    def __init__(
+        self,
+        latency_s: float = float(os.environ.get("JITLENS_STUB_LATENCY_S", "0.5")),
+        first_token_s: float = 0.3,
+        token_interval_s: float = 0.02,
+    ):
+        self.api_key = "stub"
+        self.chat = SimpleNamespace(
+            completions=_StubCompletions(latency_s, first_token_s, token_interval_s)
+        )
+
+
+class NullAudioOutput:
+    """Discards synthesized speech instead of playing it on the VB-Cable device."""
+
+    def write(self, data):
+        pass
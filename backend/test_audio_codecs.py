@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from audio_codecs import (
+    AudioFormat,
+    MULAW_DECODE_TABLE,
+    decode_mulaw,
+    encode_mulaw,
+    pack_audio_frame,
+    unpack_audio_frame,
+)
+
+
+def test_decode_mulaw_reference_values():
+    # G.711: 0x00 and 0x80 are the extremes, 0x7F and 0xFF both encode silence.
+    assert decode_mulaw(bytes([0x00, 0x80, 0x7F, 0xFF])).tolist() == [
+        -32124,
+        32124,
+        0,
+        0,
+    ]
+
+
+def test_encode_mulaw_inverts_decode():
+    codes = np.arange(256, dtype=np.uint8)
+    encoded = np.frombuffer(encode_mulaw(MULAW_DECODE_TABLE[codes]), dtype=np.uint8)
+    # Negative zero (0x7F) comes back as positive zero (0xFF).
+    assert encoded.tolist() == [0xFF if code == 0x7F else code for code in codes]
+
+
+def test_mulaw_round_trip_error_is_bounded():
+    samples = np.linspace(-32768, 32767, 10000).astype(np.int16)
+    decoded = decode_mulaw(encode_mulaw(samples)).astype(np.int32)
+    error = np.abs(decoded - samples)
+    assert np.all(error <= np.maximum(64, np.abs(samples.astype(np.int32)) // 16))
+
+
+def test_audio_frame_round_trip():
+    payload = np.arange(8, dtype=np.int16).tobytes()
+    sound_level, unpacked = unpack_audio_frame(pack_audio_frame(12.5, payload))
+    assert sound_level == 12.5
+    assert bytes(unpacked) == payload
+
+
+def test_audio_format_rejects_unsupported_formats():
+    assert AudioFormat.from_message(
+        {"encoding": "mulaw", "sample_rate": 24000}
+    ) == AudioFormat("mulaw", 24000)
+    with pytest.raises(ValueError):
+        AudioFormat.from_message({"encoding": "opus", "sample_rate": 24000})
+    with pytest.raises(ValueError):
+        AudioFormat.from_message({"encoding": "pcm16", "sample_rate": 44100})
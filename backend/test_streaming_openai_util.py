@@ -0,0 +1,40 @@
+import json
+
+from streaming_openai_util import partial_json_bool, partial_json_string
+
+
+def _stream(value: str) -> list[str]:
+    # Feeds the JSON one character at a time, as the deltas a caller would speak.
+    arguments = json.dumps({"confident": True, "response": value})
+    streamed = ""
+    deltas = []
+    for end in range(1, len(arguments) + 1):
+        partial = partial_json_string(arguments[:end], "response")
+        if partial is None:
+            continue
+        assert partial.startswith(streamed)
+        if len(partial) > len(streamed):
+            deltas.append(partial[len(streamed) :])
+            streamed = partial
+    assert streamed == value
+    return deltas
+
+
+def test_partial_json_string_streams_escapes():
+    assert _stream('say "hi"\nand \\ leave') == list('say "hi"\nand \\ leave')
+
+
+def test_partial_json_string_holds_back_surrogate_pairs():
+    assert _stream("a😀b") == ["a", "😀", "b"]
+
+
+def test_partial_json_string_before_value():
+    assert partial_json_string('{"response"', "response") is None
+    assert partial_json_string('{"response": ', "response") is None
+    assert partial_json_string('{"response": "', "response") == ""
+
+
+def test_partial_json_bool():
+    assert partial_json_bool('{"confident": tr', "confident") is None
+    assert partial_json_bool('{"confident": true', "confident") is True
+    assert partial_json_bool('{"confident": false', "confident") is False
@@ -0,0 +1,54 @@
+import math
+
+# Rough average for English text with the `o200k` tokenizer used by `gpt-4o`.
+CHARS_PER_TOKEN = 4
+# Fixed per-message overhead (role, separators).
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# https://platform.openai.com/docs/guides/vision#calculating-costs
+IMAGE_LOW_DETAIL_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_TILE_SIZE = 512
+IMAGE_MAX_SIDE = 2048
+IMAGE_SHORT_SIDE = 768
+# Used when the size of an image in an already-built message is unknown (a 1024x1024 image).
+IMAGE_DEFAULT_HIGH_DETAIL_TOKENS = 765
+
+
+def estimate_text_tokens(text: str) -> float:
+    return len(text) / CHARS_PER_TOKEN
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "auto") -> int:
+    if detail == "low":
+        return IMAGE_LOW_DETAIL_TOKENS
+
+    # Fit within a 2048x2048 square, then scale the shortest side down to 768.
+    scale = min(1.0, IMAGE_MAX_SIDE / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, IMAGE_SHORT_SIDE / min(width, height))
+    width, height = width * scale, height * scale
+
+    tiles = math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE)
+    return IMAGE_TILE_TOKENS * tiles + IMAGE_LOW_DETAIL_TOKENS
+
+
+def estimate_messages_tokens(messages: list) -> int:
+    total = 0.0
+    for message in messages:
+        total += MESSAGE_OVERHEAD_TOKENS
+        content = message.get("content")
+        if isinstance(content, str):
+            total += estimate_text_tokens(content)
+            continue
+
+        for part in content or []:
+            if part["type"] == "text":
+                total += estimate_text_tokens(part["text"])
+            elif part["type"] == "image_url":
+                if part["image_url"].get("detail") == "low":
+                    total += IMAGE_LOW_DETAIL_TOKENS
+                else:
+                    total += IMAGE_DEFAULT_HIGH_DETAIL_TOKENS
+
+    return math.ceil(total)
@@ -1,5 +1,27 @@
 from context import Context
 
+# Offered to the conversation model, which calls it to look back at the session.
+# The call is handled by `Streaming.handle_tool_call`, which speaks the answer.
+RECALL_TOOL = {
+    "type": "function",
+    "function": {
+        "description": "Recalls something the user saw or said earlier in this session, e.g. what was on a page a while ago.",
+        "name": "recall",
+        "strict": True,
+        "parameters": {
+            "type": "object",
+            "additionalProperties": False,
+            "properties": {
+                "query": {
+                    "type": "string",
+                    "description": "What to recall, as a self-contained question.",
+                }
+            },
+            "required": ["query"],
+        },
+    },
+}
+
 
 async def research(query: str):
     pass
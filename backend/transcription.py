@@ -0,0 +1,173 @@
+import asyncio
+import base64
+import json
+from abc import ABC, abstractmethod
+from typing import AsyncIterator
+
+from ws_client import ReconnectingWebSocket, WebSocketPool
+
+OPENAI_WS_URL = "wss://api.openai.com/v1/realtime?intent=transcription"
+
+
+def openai_realtime_headers(api_key: str) -> dict:
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "OpenAI-Beta": "realtime=v1",
+    }
+
+
+class Transcriber(ABC):
+    """
+    Streams 16-bit mono PCM audio in and transcription events out.
+
+    Events are dicts of the form `{"type": "delta", "text": str}`, and
+    `{"type": "turn_end"}` once the transcription of a finished turn is complete.
+    """
+
+    # The sample rate `send_audio` expects.
+    sample_rate: int = 24000
+
+    async def connect(self):
+        pass
+
+    @abstractmethod
+    async def send_audio(self, pcm16: bytes):
+        pass
+
+    async def commit(self):
+        """Marks the end of the audio sent so far as a segment to transcribe."""
+        pass
+
+    @abstractmethod
+    def events(self) -> AsyncIterator[dict]:
+        pass
+
+    async def close(self):
+        pass
+
+
+class OpenAIRealtimeTranscriber(Transcriber):
+    def __init__(
+        self,
+        api_key: str,
+        ws_pool: WebSocketPool | None = None,
+        model: str = "whisper-1",
+        language: str = "en",
+    ):
+        self.api_key = api_key
+        self.ws_pool = ws_pool
+        self.model = model
+        self.language = language
+        self.ws: ReconnectingWebSocket | None = None
+        # Items the server VAD ended with `speech_stopped`, awaiting their transcript.
+        self.vad_item_ids: set[str] = set()
+
+    async def connect(self):
+        # Take a pre-warmed connection when a pool is available.
+        if self.ws_pool is not None:
+            self.ws = self.ws_pool.acquire()
+        else:
+            self.ws = ReconnectingWebSocket(
+                OPENAI_WS_URL, openai_realtime_headers(self.api_key)
+            )
+
+        # Registered as session state so that it is replayed after a reconnect.
+        # https://platform.openai.com/docs/guides/realtime-transcription#realtime-transcription-sessions
+        await self.ws.send_session_message(
+            json.dumps(
+                {
+                    "type": "transcription_session.update",
+                    "session": {
+                        "input_audio_format": "pcm16",
+                        "input_audio_transcription": {
+                            "model": self.model,
+                            # "model": "gpt-4o-transcribe",
+                            "prompt": "",
+                            "language": self.language,
+                        },
+                        "turn_detection": {
+                            "type": "server_vad",
+                            "threshold": 0.5,
+                            "prefix_padding_ms": 300,
+                            "silence_duration_ms": 500,
+                        },
+                        "input_audio_noise_reduction": {"type": "near_field"},
+                        "include": [
+                            # "item.input_audio_transcription.logprobs",
+                        ],
+                    },
+                }
+            )
+        )
+
+    async def send_audio(self, pcm16: bytes):
+        assert self.ws is not None
+        data = base64.b64encode(pcm16).decode("utf-8")
+        await self.ws.send(
+            json.dumps({"type": "input_audio_buffer.append", "audio": data})
+        )
+
+    async def commit(self):
+        assert self.ws is not None
+        await self.ws.send(json.dumps({"type": "input_audio_buffer.commit"}))
+
+    async def events(self):
+        assert self.ws is not None
+        while True:
+            data = json.loads(await self.ws.recv())
+            match data["type"]:
+                case "conversation.item.input_audio_transcription.delta":
+                    if data["delta"] != "":
+                        yield {"type": "delta", "text": data["delta"]}
+                case "input_audio_buffer.speech_stopped":
+                    # The turn ended, but its transcript may still be streaming in.
+                    self.vad_item_ids.add(data["item_id"])
+                case "conversation.item.input_audio_transcription.completed":
+                    # Items committed by us rather than the VAD are not turn ends,
+                    # and neither are VAD turns in which nothing was said.
+                    if data["item_id"] in self.vad_item_ids:
+                        self.vad_item_ids.remove(data["item_id"])
+                        if data.get("transcript", "").strip() != "":
+                            yield {"type": "turn_end"}
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+
+
+class ScriptedTranscriber(Transcriber):
+    """
+    Deterministic local stub that plays back a script.
+
+    Emits the next scripted utterance, one word per delta, after every
+    `seconds_per_utterance` of received audio. Useful for tests and benchmarks that
+    should not depend on a network service.
+    """
+
+    def __init__(
+        self,
+        utterances: list[str],
+        sample_rate: int = 24000,
+        seconds_per_utterance: float = 3.0,
+    ):
+        self.utterances = utterances
+        self.sample_rate = sample_rate
+        self.seconds_per_utterance = seconds_per_utterance
+        self.utterance_index = 0
+        self.received_bytes = 0
+        self.event_queue: asyncio.Queue[dict] = asyncio.Queue()
+
+    async def send_audio(self, pcm16: bytes):
+        self.received_bytes += len(pcm16)
+        bytes_per_utterance = self.seconds_per_utterance * self.sample_rate * 2
+        while self.received_bytes >= bytes_per_utterance and len(self.utterances) > 0:
+            self.received_bytes -= bytes_per_utterance
+            utterance = self.utterances[self.utterance_index % len(self.utterances)]
+            self.utterance_index += 1
+            for word in utterance.split(" "):
+                self.event_queue.put_nowait({"type": "delta", "text": word + " "})
+            self.event_queue.put_nowait({"type": "turn_end"})
+
+    async def events(self):
+        while True:
+            yield await self.event_queue.get()
@@ -0,0 +1,360 @@
+import asyncio
+import collections
+import hashlib
+import itertools
+import os
+import re
+from dataclasses import dataclass, field
+
+from loguru import logger
+
+from speech_synthesis import SpeechSynthesizer
+
+SENTENCE_END_PATTERN = re.compile(r"[.!?]+(?=\s|$)")
+
+
+class TTSCache:
+    """
+    Content-addressed cache of synthesized PCM audio.
+
+    Entries live in an in-memory LRU. Entries evicted from memory spill to
+    `directory`, which is itself bounded and evicts its oldest files first. The
+    directory is reused across sessions and processes.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_memory_bytes: int = 16 * 1024 * 1024,
+        max_disk_bytes: int = 256 * 1024 * 1024,
+    ):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory: collections.OrderedDict[str, bytes] = collections.OrderedDict()
+        self.memory_bytes = 0
+        self.disk: collections.OrderedDict[str, int] = collections.OrderedDict()
+        self.disk_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # Pick up entries spilled by earlier sessions, oldest first.
+        paths = [
+            os.path.join(directory, name)
+            for name in os.listdir(directory)
+            if name.endswith(".pcm")
+        ]
+        for path in sorted(paths, key=os.path.getmtime):
+            key = os.path.basename(path)[: -len(".pcm")]
+            self.disk[key] = os.path.getsize(path)
+            self.disk_bytes += self.disk[key]
+
+    @staticmethod
+    def key(text: str, voice_id: str, model_id: str, sample_rate: int) -> str:
+        return hashlib.sha256(
+            "\0".join([text.strip(), voice_id, model_id, str(sample_rate)]).encode()
+        ).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".pcm")
+
+    def get(self, key: str) -> bytes | None:
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.memory_hits += 1
+            self.bytes_saved += len(self.memory[key])
+            return self.memory[key]
+
+        if key in self.disk:
+            try:
+                with open(self._path(key), "rb") as f:
+                    pcm = f.read()
+            except FileNotFoundError:
+                # Evicted by another process sharing the directory.
+                self.disk_bytes -= self.disk.pop(key)
+            else:
+                self.disk_hits += 1
+                self.bytes_saved += len(pcm)
+                self.put(key, pcm)
+                return pcm
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, pcm: bytes):
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key))
+        self.memory[key] = pcm
+        self.memory_bytes += len(pcm)
+
+        while self.memory_bytes > self.max_memory_bytes and len(self.memory) > 1:
+            evicted_key, evicted_pcm = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted_pcm)
+            self._spill(evicted_key, evicted_pcm)
+
+    def _spill(self, key: str, pcm: bytes):
+        if key in self.disk:
+            self.disk.move_to_end(key)
+            return
+
+        # Written under a temporary name and renamed, so other worker processes sharing
+        # the directory never read a partial file.
+        temporary_path = f"{self._path(key)}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(pcm)
+        os.replace(temporary_path, self._path(key))
+        self.disk[key] = len(pcm)
+        self.disk_bytes += len(pcm)
+
+        while self.disk_bytes > self.max_disk_bytes and len(self.disk) > 1:
+            evicted_key, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.remove(self._path(evicted_key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (
+                (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+            ),
+            "bytes_saved": self.bytes_saved,
+            "memory_bytes": self.memory_bytes,
+            "disk_bytes": self.disk_bytes,
+        }
+
+
+@dataclass(slots=True)
+class _Segment:
+    utterance_id: str
+    events: collections.deque[dict] = field(default_factory=collections.deque)
+    # Set when the segment's audio is to be stored in the cache once complete.
+    key: str | None = None
+    chunks: list[bytes] = field(default_factory=list)
+    # Loop time by which the next event is due, once all of its text has been sent.
+    deadline: float | None = None
+
+
+class CachingSpeechSynthesizer(SpeechSynthesizer):
+    """
+    Serves short, whole sentences (e.g. "NO IMAGES.") from a `TTSCache`.
+
+    Continued text is assembled into sentences before any of it is synthesized. Text
+    is held back until it either completes a sentence of at most
+    `max_cacheable_chars`, or grows past that (or is held for `max_hold_s`). A short
+    sentence is served from the cache, or on a miss is synthesized as a standalone
+    utterance so that its audio can be stored. All other text streams through one
+    continued utterance, which is only finished when a short sentence is queued
+    after it.
+
+    Every utterance is a segment, and segments are emitted strictly in the order
+    their text arrived, so a cache hit never plays ahead of earlier audio. A segment
+    ends with `done` or `error`; one that goes `segment_timeout_s` without events
+    after its last text is ended with an `error`, so a lost utterance cannot hold
+    back everything queued after it.
+    """
+
+    def __init__(
+        self,
+        inner: SpeechSynthesizer,
+        cache: TTSCache,
+        max_cacheable_chars: int = 80,
+        max_hold_s: float = 0.5,
+        segment_timeout_s: float = 10,
+        chunk_bytes: int = 9600,
+    ):
+        self.inner = inner
+        self.cache = cache
+        self.sample_rate = inner.sample_rate
+        self.voice_id = getattr(inner, "voice_id", type(inner).__name__)
+        self.model_id = getattr(inner, "model_id", type(inner).__name__)
+        self.max_cacheable_chars = max_cacheable_chars
+        self.max_hold_s = max_hold_s
+        self.segment_timeout_s = segment_timeout_s
+        self.chunk_bytes = chunk_bytes
+        self.utterance_counter = itertools.count()
+        # Text of the current sentence that has not been sent yet.
+        self.held_text = ""
+        # Whether the current sentence is too long to cache and is being streamed.
+        self.streaming_sentence = False
+        self.stream_segment: _Segment | None = None
+        self.segments: collections.deque[_Segment] = collections.deque()
+        self.segments_by_id: dict[str, _Segment] = {}
+        self.segment_ready = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.hold_task = None
+        self.pump_task = None
+
+    async def connect(self):
+        await self.inner.connect()
+        self.pump_task = asyncio.create_task(self._pump_inner_events())
+
+    async def synthesize(
+        self,
+        text: str,
+        utterance_id: str | None = None,
+        continue_utterance: bool = False,
+    ):
+        async with self.lock:
+            if utterance_id is not None:
+                if utterance_id not in self.segments_by_id:
+                    await self._finish_stream()
+                    self._append_segment(utterance_id)
+                await self.inner.synthesize(text, utterance_id, continue_utterance)
+                if not continue_utterance:
+                    self._await_events(self.segments_by_id[utterance_id])
+                return
+
+            start = 0
+            for match in SENTENCE_END_PATTERN.finditer(text):
+                await self._feed(text[start : match.end()], sentence_end=True)
+                start = match.end()
+            if start < len(text):
+                await self._feed(text[start:], sentence_end=False)
+
+        if self.held_text.strip() != "" and self.hold_task is None:
+            self.hold_task = asyncio.create_task(self._release_held_text_later())
+
+    async def _feed(self, text: str, sentence_end: bool):
+        if self.streaming_sentence:
+            await self._stream(text)
+            self.streaming_sentence = not sentence_end
+            return
+
+        self.held_text += text
+        if len(self.held_text.strip()) > self.max_cacheable_chars:
+            await self._stream(self.held_text)
+            self.held_text = ""
+            self.streaming_sentence = not sentence_end
+        elif sentence_end:
+            await self._synthesize_sentence(self.held_text)
+            self.held_text = ""
+
+    async def _release_held_text_later(self):
+        # Text that does not become a sentence in time (e.g. a reply that ends without
+        # punctuation) is streamed after all.
+        await asyncio.sleep(self.max_hold_s)
+        async with self.lock:
+            self.hold_task = None
+            if self.held_text.strip() != "":
+                await self._stream(self.held_text)
+                self.held_text = ""
+                self.streaming_sentence = True
+
+    def _await_events(self, segment: _Segment):
+        segment.deadline = asyncio.get_running_loop().time() + self.segment_timeout_s
+
+    def _append_segment(self, utterance_id: str) -> _Segment:
+        segment = _Segment(utterance_id)
+        self.segments.append(segment)
+        self.segments_by_id[utterance_id] = segment
+        return segment
+
+    async def _stream(self, text: str):
+        if self.stream_segment is None:
+            self.stream_segment = self._append_segment(
+                f"tts-stream-{next(self.utterance_counter)}"
+            )
+        await self.inner.synthesize(
+            text, self.stream_segment.utterance_id, continue_utterance=True
+        )
+
+    async def _finish_stream(self):
+        if self.stream_segment is not None:
+            await self.inner.synthesize("", self.stream_segment.utterance_id)
+            self._await_events(self.stream_segment)
+            self.stream_segment = None
+
+    async def _synthesize_sentence(self, text: str):
+        await self._finish_stream()
+        key = TTSCache.key(text, self.voice_id, self.model_id, self.sample_rate)
+        segment = self._append_segment(f"tts-cache-{next(self.utterance_counter)}")
+        pcm = self.cache.get(key)
+        if pcm is None:
+            segment.key = key
+            await self.inner.synthesize(text, segment.utterance_id)
+            self._await_events(segment)
+            return
+
+        logger.debug(f"TTS cache hit for {text!r}: {self.cache.stats()}")
+        for i in range(0, len(pcm), self.chunk_bytes):
+            segment.events.append(
+                {
+                    "type": "chunk",
+                    "data": pcm[i : i + self.chunk_bytes],
+                    "utterance_id": segment.utterance_id,
+                }
+            )
+        segment.events.append({"type": "done", "utterance_id": segment.utterance_id})
+        self.segment_ready.set()
+
+    async def _pump_inner_events(self):
+        async for event in self.inner.events():
+            segment = self.segments_by_id.get(event["utterance_id"])
+            if segment is None:
+                logger.warning(f"Dropping TTS event for unknown utterance: {event}")
+                continue
+
+            if segment.key is not None:
+                if event["type"] == "chunk":
+                    segment.chunks.append(event["data"])
+                elif event["type"] == "done":
+                    self.cache.put(segment.key, b"".join(segment.chunks))
+                    segment.chunks = []
+            if event["type"] == "error":
+                logger.warning(f"TTS utterance failed: {event}")
+                segment.chunks = []
+                if segment is self.stream_segment:
+                    # Text that follows starts a new utterance.
+                    self.stream_segment = None
+            if segment.deadline is not None:
+                self._await_events(segment)
+            segment.events.append(event)
+            self.segment_ready.set()
+
+    async def events(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            head = self.segments[0] if len(self.segments) > 0 else None
+            if head is not None and len(head.events) > 0:
+                event = head.events.popleft()
+                if event["type"] in ("done", "error"):
+                    del self.segments_by_id[self.segments.popleft().utterance_id]
+                yield event
+                continue
+
+            timeout = None
+            if head is not None and head.deadline is not None:
+                timeout = head.deadline - loop.time()
+                if timeout <= 0:
+                    head.events.append(
+                        {
+                            "type": "error",
+                            "utterance_id": head.utterance_id,
+                            "message": "Timed out",
+                        }
+                    )
+                    logger.warning(f"TTS utterance {head.utterance_id} timed out.")
+                    continue
+
+            self.segment_ready.clear()
+            try:
+                await asyncio.wait_for(self.segment_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        for task in (self.hold_task, self.pump_task):
+            if task is not None:
+                task.cancel()
+        await self.inner.close()
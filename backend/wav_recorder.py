@@ -0,0 +1,153 @@
+import gzip
+import os
+import shutil
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+WAV_HEADER_SIZE = 44
+
+
+def _wav_header(data_length: int, sample_rate: int, channels: int, sample_width: int):
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF",
+        36 + data_length,
+        b"WAVE",
+        b"fmt ",
+        16,  # fmt chunk size
+        1,  # PCM format
+        channels,
+        sample_rate,
+        sample_rate * channels * sample_width,
+        channels * sample_width,
+        sample_width * 8,
+        b"data",
+        data_length,
+    )
+
+
+def _compress_file(path: str):
+    # Written under a temporary name, so an interrupted compression never leaves a
+    # truncated archive next to (or instead of) the WAV file.
+    with open(path, "rb") as src, gzip.open(path + ".gz.tmp", "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(path + ".gz.tmp", path + ".gz")
+    os.remove(path)
+    logger.info(f"Compressed {path}")
+
+
+class WavRecorder:
+    """
+    Append-only WAV recorder.
+
+    Each file is opened once and frames are appended as they arrive. The RIFF and
+    data chunk sizes in the header are only patched every `header_patch_interval_s`
+    and when the file is closed, so the file is playable (up to the last patch) at
+    any time. Files are rotated by size and/or duration, and rotated files can be
+    gzip-compressed on a background thread.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        prefix: str = "recording",
+        sample_rate: int = 48000,
+        channels: int = 1,
+        sample_width: int = 2,
+        max_file_bytes: int | None = None,
+        max_file_duration_s: float | None = None,
+        header_patch_interval_s: float = 1.0,
+        compress: bool = False,
+    ):
+        self.directory = directory
+        self.prefix = prefix
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.max_file_bytes = max_file_bytes
+        self.max_file_duration_s = max_file_duration_s
+        self.header_patch_interval_s = header_patch_interval_s
+        self.compress = compress
+        self.compression_executor = ThreadPoolExecutor(max_workers=1)
+        self.file = None
+        self.path = None
+        self.file_index = 0
+        self.data_length = 0
+        self.last_header_patch_time = 0.0
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @property
+    def bytes_per_second(self) -> int:
+        return self.sample_rate * self.channels * self.sample_width
+
+    def _should_rotate(self, incoming_bytes: int) -> bool:
+        if self.max_file_bytes is not None and (
+            self.data_length + incoming_bytes > self.max_file_bytes
+        ):
+            return self.data_length > 0
+        if self.max_file_duration_s is not None and (
+            self.data_length >= self.max_file_duration_s * self.bytes_per_second
+        ):
+            return True
+        return False
+
+    def _open_next_file(self):
+        self.path = os.path.join(
+            self.directory, f"{self.prefix}_{self.file_index:04d}.wav"
+        )
+        self.file_index += 1
+        self.file = open(self.path, "wb")
+        self.file.write(
+            _wav_header(0, self.sample_rate, self.channels, self.sample_width)
+        )
+        self.data_length = 0
+        self.last_header_patch_time = time.monotonic()
+
+    def _patch_header(self):
+        assert self.file is not None
+        self.file.seek(4)
+        self.file.write(struct.pack("<I", 36 + self.data_length))
+        self.file.seek(40)
+        self.file.write(struct.pack("<I", self.data_length))
+        self.file.seek(0, os.SEEK_END)
+        self.file.flush()
+        self.last_header_patch_time = time.monotonic()
+
+    def _finalize_file(self):
+        if self.file is None:
+            return
+
+        self._patch_header()
+        self.file.close()
+        self.file = None
+        if self.compress:
+            self.compression_executor.submit(_compress_file, self.path)
+
+    def write(self, frames: bytes | memoryview):
+        if self.file is None:
+            self._open_next_file()
+        elif self._should_rotate(len(frames)):
+            self._finalize_file()
+            self._open_next_file()
+
+        assert self.file is not None
+        self.file.write(frames)
+        self.data_length += len(frames)
+
+        if (
+            time.monotonic() - self.last_header_patch_time
+            > self.header_patch_interval_s
+        ):
+            self._patch_header()
+
+    def close(self, wait_for_compression: bool = False):
+        self._finalize_file()
+        # Compressing a long recording takes seconds, so by default the pending jobs
+        # finish in the background (the interpreter joins them at exit) instead of
+        # blocking the caller, which is usually an event loop.
+        self.compression_executor.shutdown(wait=wait_for_compression)
@@ -1,30 +1,192 @@
 import asyncio
 import base64
-import datetime
+import json
 import os
 import time
+from contextlib import asynccontextmanager
 from io import BytesIO
 
 from dotenv import load_dotenv
 
 load_dotenv()
+import numpy as np
+from audio_bus import AudioBus, AudioPacket, LevelMeter, RecordingSink
+from audio_codecs import AudioFormat, unpack_audio_frame
+from caption_store import CaptionStore
 from context import Context
+from image_pyramid import ImagePyramid
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from loguru import logger
+from loop_monitor import LoopLagMonitor
 from openai import AsyncOpenAI
 from PIL import Image
-from streaming import Streaming
+from server_metrics import WorkerMetrics
+from speech_synthesis import (
+    CARTESIA_API_KEY,
+    CartesiaSpeechSynthesizer,
+    ToneSpeechSynthesizer,
+    cartesia_ws_url,
+)
+from streaming import INPUT_SAMPLE_RATE, Streaming
+from streaming_openai_util import first_token_tracker
+from stub_upstream import STUB_UTTERANCES, NullAudioOutput, StubAsyncOpenAI
+from transcription import (
+    OPENAI_WS_URL,
+    OpenAIRealtimeTranscriber,
+    ScriptedTranscriber,
+    openai_realtime_headers,
+)
+from tts_cache import CachingSpeechSynthesizer, TTSCache
+from ws_client import WebSocketPool
 
-app = FastAPI()
+# Set JITLENS_STUB_UPSTREAM=1 to replace OpenAI, transcription, TTS and playback with
+# local stubs, e.g. to load test a single process with `load_test.py`.
+STUB_UPSTREAM = os.environ.get("JITLENS_STUB_UPSTREAM") == "1"
 
-openai_client = AsyncOpenAI()
-ctx_counter = 0
-
-while os.path.exists(f"./context_{ctx_counter}"):
-    ctx_counter += 1
+openai_client = StubAsyncOpenAI() if STUB_UPSTREAM else AsyncOpenAI()
+if not STUB_UPSTREAM and CARTESIA_API_KEY is None:
+    # The Cartesia pool would otherwise retry an unauthenticated URL forever.
+    raise ValueError("CARTESIA_API_KEY is not set.")
+# Active sessions in this worker process, keyed by their log directory. A session
+# lives on the worker that accepted its WebSocket, so no session state is shared.
+sessions: dict[str, Streaming] = {}
+audio_buses: dict[str, AudioBus] = {}
+meters: dict[str, LevelMeter] = {}
+# Shared by all sessions and worker processes (see `serve.py`).
+caption_store = CaptionStore(os.environ.get("JITLENS_CAPTION_DB", "./captions.db"))
 
 THINKING_PERIOD_S = 5
 SILENCE_PERIOD_S = 1
+MAX_INPUT_TOKENS = 16000
+# Set LOOP_LAG_MONITOR=1 to write event-loop stall reports into each session's log dir.
+# The stubbed setup always monitors the loop, for `load_test.py`.
+LOOP_LAG_MONITOR = os.environ.get("LOOP_LAG_MONITOR") == "1"
+# Set HEDGE_USER_QUERIES=1 to race a second request when gpt-4o's first token is late.
+HEDGE_USER_QUERIES = os.environ.get("HEDGE_USER_QUERIES") == "1"
+HEDGE_MODEL = "gpt-4o-mini"
+# Forward audio to the transcriber in ~100 ms frames and let its VAD find the turns,
+# instead of committing multi-second chunks.
+AUDIO_STREAMING = True
+# Set JITLENS_RECORD_AUDIO=1 to also record each session's audio into its log dir.
+RECORD_AUDIO = os.environ.get("JITLENS_RECORD_AUDIO") == "1"
+# Caption queued frames together in one request, sized to keep up with the upstream.
+CAPTION_BATCHING = True
+# Caption keyframes as they arrive, and other frames only when a recall needs them.
+CAPTION_POLICY = "keyframes"
+# Number of upstream connections kept open, ready for the next session.
+WARM_CONNECTIONS = 1
+
+transcription_ws_pool = WebSocketPool(
+    OPENAI_WS_URL,
+    additional_headers=openai_realtime_headers(openai_client.api_key),
+    size=WARM_CONNECTIONS,
+)
+# Shared by all sessions, so common phrases are synthesized once per process.
+tts_cache = TTSCache("./tts_cache")
+cartesia_ws_pool = WebSocketPool(
+    cartesia_ws_url(CARTESIA_API_KEY), size=WARM_CONNECTIONS
+)
+# Health of this worker, published for /metrics on any worker to aggregate.
+worker_metrics = WorkerMetrics("./worker_metrics")
+# One monitor per worker: every session on the loop shares its stalls.
+process_loop_monitor = (
+    LoopLagMonitor(".", histogram=worker_metrics.histogram)
+    if STUB_UPSTREAM or LOOP_LAG_MONITOR
+    else None
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    worker_metrics.start(lambda: len(sessions))
+    if process_loop_monitor is not None:
+        process_loop_monitor.start()
+    try:
+        async with _upstream_lifespan():
+            yield
+    finally:
+        if process_loop_monitor is not None:
+            process_loop_monitor.stop()
+        worker_metrics.stop()
+
+
+@asynccontextmanager
+async def _upstream_lifespan():
+    if STUB_UPSTREAM:
+        yield
+        return
+
+    transcription_ws_pool.start()
+    cartesia_ws_pool.start()
+    yield
+    await transcription_ws_pool.close()
+    await cartesia_ws_pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.get("/stats")
+async def stats_endpoint():
+    return {
+        "sessions": {
+            log_dir: {
+                **streaming.get_queue_stats(),
+                "audio_bus": audio_buses[log_dir].stats(),
+                "level_meter": meters[log_dir].stats(),
+            }
+            for log_dir, streaming in sessions.items()
+            if log_dir in audio_buses
+        },
+        "pid": os.getpid(),
+        "tts_cache": tts_cache.stats(),
+        "caption_store": caption_store.stats(),
+        "llm": first_token_tracker.stats(),
+    }
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    # Cumulative totals over all workers; clients diff two snapshots.
+    return worker_metrics.aggregate()
+
+
+def _create_engines():
+    if STUB_UPSTREAM:
+        return ScriptedTranscriber(STUB_UTTERANCES), ToneSpeechSynthesizer()
+
+    transcriber = OpenAIRealtimeTranscriber(
+        openai_client.api_key, ws_pool=transcription_ws_pool
+    )
+    synthesizer = CachingSpeechSynthesizer(
+        CartesiaSpeechSynthesizer(ws_pool=cartesia_ws_pool), tts_cache
+    )
+    return transcriber, synthesizer
+
+
+def _decode_image(data: bytes) -> tuple[Image.Image, ImagePyramid]:
+    # Decoding and downscaling a 1080p frame takes longer than an audio packet
+    # interval, so it runs in a thread instead of on the loop every session shares.
+    image = Image.open(BytesIO(data))
+    image.load()
+    return image, ImagePyramid(image)
+
+
+def _allocate_log_dir() -> str:
+    # `os.mkdir` is atomic, so concurrent sessions and workers never share a directory.
+    existing = [
+        int(name[len("context_") :])
+        for name in os.listdir(".")
+        if name.startswith("context_") and name[len("context_") :].isdigit()
+    ]
+    index = max(existing, default=-1) + 1
+    while True:
+        try:
+            os.mkdir(f"./context_{index}")
+            return f"./context_{index}/"
+        except FileExistsError:
+            index += 1
+
 
 # context = None
 # streaming = None
@@ -32,43 +194,130 @@ SILENCE_PERIOD_S = 1
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    global ctx_counter  # , context, streaming
-    log_dir = f"./context_{ctx_counter}/"
-    ctx_counter += 1
+    log_dir = _allocate_log_dir()
     # if context is None:
-    context = Context(log_dir, openai_client)
+    context = Context(
+        log_dir,
+        openai_client,
+        caption_store=caption_store,
+        caption_policy=CAPTION_POLICY,
+        caption_batching=CAPTION_BATCHING,
+    )
+    if LOOP_LAG_MONITOR:
+        assert process_loop_monitor is not None
+        process_loop_monitor.add_report_dir(log_dir)
     indexing_task = asyncio.create_task(context._index_images())
+    transcriber, synthesizer = _create_engines()
     # if streaming is None:
     streaming = Streaming(
         context,
         openai_client,
         silence_period_s=SILENCE_PERIOD_S,
         thinking_period_s=THINKING_PERIOD_S,
+        max_input_tokens=MAX_INPUT_TOKENS,
+        transcriber=transcriber,
+        synthesizer=synthesizer,
+        audio_output=NullAudioOutput() if STUB_UPSTREAM else None,
+        hedge_user_queries=HEDGE_USER_QUERIES,
+        hedge_model=HEDGE_MODEL,
+        audio_streaming=AUDIO_STREAMING,
     )
     streaming_task = asyncio.create_task(streaming.run())
 
+    # Every packet is decoded once and shared by transcription, recording and metering.
+    async def transcribe(packet: AudioPacket):
+        if packet.sample_rate != streaming.input_sample_rate:
+            streaming.set_input_sample_rate(packet.sample_rate)
+        await streaming.on_audio_packet_received(packet.samples, packet.sound_level)
+
+    audio_bus = AudioBus(worker_metrics.histogram, worker_metrics.counters)
+    audio_bus.subscribe("transcription", transcribe, maxsize=256)
+    recording_sink = RecordingSink(log_dir) if RECORD_AUDIO else None
+    if recording_sink is not None:
+        audio_bus.subscribe("recording", recording_sink, maxsize=256)
+    level_meter = LevelMeter()
+    audio_bus.subscribe("level_meter", level_meter, maxsize=16)
+    audio_bus.start()
+    sessions[log_dir] = streaming
+    audio_buses[log_dir] = audio_bus
+    meters[log_dir] = level_meter
+
     await websocket.accept()
     await asyncio.sleep(1.0)
     t0 = time.time()
+    # Until the client negotiates a format, audio arrives as base64 JSON at 48 kHz.
+    audio_format = None
     try:
         while True:
-            message = await websocket.receive_json()
+            raw_message = await websocket.receive()
+            received_at = time.perf_counter()
+            if raw_message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(raw_message.get("code", 1000))
+
+            if raw_message.get("bytes") is not None:
+                # Binary frames are audio in the negotiated format, without base64.
+                if audio_format is None:
+                    logger.warning("Binary audio frame before audio_format; ignored")
+                    continue
+                sound_level, payload = unpack_audio_frame(raw_message["bytes"])
+                audio_bus.publish(
+                    audio_format.decode(payload), audio_format.sample_rate, sound_level
+                )
+                # Decoding and enqueueing only; the bus records what its subscribers
+                # take (`audio_bus.{name}`).
+                worker_metrics.histogram.record(
+                    "audio_frame", time.perf_counter() - received_at
+                )
+                continue
+
+            message = json.loads(raw_message["text"])
             match message["type"]:
+                case "audio_format":
+                    try:
+                        audio_format = AudioFormat.from_message(message)
+                    except ValueError as e:
+                        await websocket.send_json({"type": "error", "message": str(e)})
+                        continue
+                    logger.info(f"Negotiated audio format: {audio_format}")
+                    await websocket.send_json(
+                        {
+                            "type": "audio_format_accepted",
+                            "encoding": audio_format.encoding,
+                            "sample_rate": audio_format.sample_rate,
+                        }
+                    )
                 case "audio_packet":
                     # logger.debug("Received audio packet")
-                    frames = base64.b64decode(message["data"])
-                    await streaming.on_audio_packet_received(
-                        frames, message["sound_level"]
+                    samples = np.frombuffer(
+                        base64.b64decode(message["data"]), dtype=np.int16
+                    )
+                    audio_bus.publish(
+                        samples, INPUT_SAMPLE_RATE, message["sound_level"]
                     )
                 case "image_packet":
                     logger.debug("Received image packet")
-                    image_data = base64.b64decode(message["data"])
-                    image = Image.open(BytesIO(image_data))
-
-                    context.add_image(image, datetime.datetime.now())
+                    timestamp = context.clock.now()
+                    image, pyramid = await asyncio.to_thread(
+                        _decode_image, base64.b64decode(message["data"])
+                    )
+                    context.add_image(image, timestamp, pyramid)
                 case _:
                     print("Wrong type")
+                    continue
+            worker_metrics.histogram.record(
+                message["type"], time.perf_counter() - received_at
+            )
     except WebSocketDisconnect:
         print("WebSocket disconnected")
         await streaming.close()
         streaming_task.cancel()
+    finally:
+        await audio_bus.close()
+        if recording_sink is not None:
+            await recording_sink.close()
+        sessions.pop(log_dir, None)
+        audio_buses.pop(log_dir, None)
+        meters.pop(log_dir, None)
+        if LOOP_LAG_MONITOR:
+            assert process_loop_monitor is not None
+            process_loop_monitor.remove_report_dir(log_dir)
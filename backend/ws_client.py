@@ -0,0 +1,207 @@
+import asyncio
+import time
+from typing import Callable
+
+import websockets
+from loguru import logger
+from websockets.exceptions import ConnectionClosed, WebSocketException
+from websockets.protocol import State
+
+# Keepalive pings double as dead-socket detection: a missing pong closes the connection.
+PING_INTERVAL_S = 10
+PING_TIMEOUT_S = 10
+MAX_RECONNECT_BACKOFF_S = 5
+
+
+async def _open_connection(url: str, additional_headers: dict | None):
+    return await websockets.connect(
+        url,
+        additional_headers=additional_headers,
+        ping_interval=PING_INTERVAL_S,
+        ping_timeout=PING_TIMEOUT_S,
+    )
+
+
+def _is_open(ws) -> bool:
+    return ws is not None and ws.state is State.OPEN
+
+
+class ReconnectingWebSocket:
+    """
+    A WebSocket client that transparently reconnects when the connection drops.
+
+    Messages sent with `send_session_message` are remembered and replayed after every
+    reconnect, so server-side session state (e.g. `transcription_session.update`)
+    survives network blips. Anything else in flight on the old connection is lost;
+    callbacks registered with `add_reconnect_listener` are told after each reconnect.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        additional_headers: dict | None = None,
+        connection=None,
+    ):
+        self.url = url
+        self.additional_headers = additional_headers
+        self.ws = connection
+        self.session_messages: list[str] = []
+        self.reconnect_listeners: list[Callable[[], None]] = []
+        self.reconnect_count = 0
+        self._has_connected = connection is not None
+        self._connect_lock = asyncio.Lock()
+        self._closed = False
+
+    async def ensure_connected(self):
+        if _is_open(self.ws):
+            return self.ws
+
+        async with self._connect_lock:
+            # Another coroutine may have reconnected while we were waiting.
+            if _is_open(self.ws):
+                return self.ws
+
+            backoff_s = 0.1
+            while not self._closed:
+                try:
+                    ws = await _open_connection(self.url, self.additional_headers)
+                    break
+                except (OSError, asyncio.TimeoutError, WebSocketException) as e:
+                    logger.warning(
+                        f"Failed to connect to {self.url.split('?')[0]}: {e!r}. "
+                        f"Retrying in {backoff_s:.1f}s."
+                    )
+                    await asyncio.sleep(backoff_s)
+                    backoff_s = min(backoff_s * 2, MAX_RECONNECT_BACKOFF_S)
+            else:
+                raise ConnectionError("WebSocket client is closed.")
+
+            for message in self.session_messages:
+                await ws.send(message)
+
+            if self._has_connected:
+                self.reconnect_count += 1
+                logger.info(
+                    f"Reconnected to {self.url.split('?')[0]} "
+                    f"(replayed {len(self.session_messages)} session messages)."
+                )
+            self.ws = ws
+            if self._has_connected:
+                for listener in self.reconnect_listeners:
+                    listener()
+            self._has_connected = True
+
+        return self.ws
+
+    def add_reconnect_listener(self, listener: Callable[[], None]):
+        self.reconnect_listeners.append(listener)
+
+    async def send(self, message: str):
+        ws = await self.ensure_connected()
+        try:
+            await ws.send(message)
+        except ConnectionClosed:
+            ws = await self.ensure_connected()
+            await ws.send(message)
+
+    async def send_session_message(self, message: str):
+        self.session_messages.append(message)
+        await self.send(message)
+
+    async def recv(self):
+        while True:
+            ws = await self.ensure_connected()
+            try:
+                return await ws.recv()
+            except ConnectionClosed as e:
+                if self._closed:
+                    raise
+                logger.warning(
+                    f"Connection to {self.url.split('?')[0]} dropped: {e!r}. Reconnecting."
+                )
+
+    async def close(self):
+        self._closed = True
+        if self.ws is not None:
+            await self.ws.close()
+
+
+class WebSocketPool:
+    """
+    Keeps `size` warm connections to one endpoint so new sessions skip the handshake.
+
+    Idle connections are kept alive by keepalive pings, health-checked, and recycled
+    after `max_idle_s` so that sessions never receive a connection that is about to
+    be closed by the server.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        additional_headers: dict | None = None,
+        size: int = 1,
+        max_idle_s: float = 300,
+    ):
+        self.url = url
+        self.additional_headers = additional_headers
+        self.size = size
+        self.max_idle_s = max_idle_s
+        self.idle_connections: list[tuple[float, object]] = []
+        self.refill_event = asyncio.Event()
+        self.refill_task = None
+
+    def start(self):
+        self.refill_task = asyncio.create_task(self._refill_loop())
+
+    async def _refill_loop(self):
+        backoff_s = 0.1
+        while True:
+            now = time.monotonic()
+            healthy = []
+            for connected_at, ws in self.idle_connections:
+                if _is_open(ws) and now - connected_at < self.max_idle_s:
+                    healthy.append((connected_at, ws))
+                else:
+                    asyncio.create_task(ws.close())
+            self.idle_connections = healthy
+
+            try:
+                while len(self.idle_connections) < self.size:
+                    ws = await _open_connection(self.url, self.additional_headers)
+                    self.idle_connections.append((time.monotonic(), ws))
+                backoff_s = 0.1
+            except (OSError, asyncio.TimeoutError, WebSocketException) as e:
+                logger.warning(
+                    f"Failed to pre-warm a connection to {self.url.split('?')[0]}: {e!r}"
+                )
+                await asyncio.sleep(backoff_s)
+                backoff_s = min(backoff_s * 2, MAX_RECONNECT_BACKOFF_S)
+                continue
+
+            self.refill_event.clear()
+            try:
+                await asyncio.wait_for(self.refill_event.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+
+    def acquire(self) -> ReconnectingWebSocket:
+        # Falls back to connecting on first use when no warm connection is ready.
+        connection = None
+        while len(self.idle_connections) > 0:
+            _, ws = self.idle_connections.pop(0)
+            if _is_open(ws):
+                connection = ws
+                break
+
+        self.refill_event.set()
+        return ReconnectingWebSocket(
+            self.url, self.additional_headers, connection=connection
+        )
+
+    async def close(self):
+        if self.refill_task is not None:
+            self.refill_task.cancel()
+        await asyncio.gather(
+            *[ws.close() for _, ws in self.idle_connections], return_exceptions=True
+        )
+        self.idle_connections = []
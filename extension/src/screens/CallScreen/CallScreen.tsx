@@ -1,6 +1,12 @@
 import { useCallback, useEffect, useRef, useState } from "react";
+import { createAudioFrame, encodeMulaw } from "../../utils/audio";
 import styles from "./CallScreen.module.scss";
 
+// Compressed audio, offered to the backend when the WebSocket opens. Until the backend
+// accepts it, audio is sent the old way: base64 48 kHz 16-bit PCM in JSON.
+const AUDIO_FORMAT = { encoding: "mulaw", sample_rate: 24000 };
+const DEFAULT_SAMPLE_RATE = 48000;
+
 const CallScreen = () => {
     const [stream, setStream] = useState<MediaStream | null>(null);
     const [error, setError] = useState<string>("");
@@ -9,6 +15,7 @@ const CallScreen = () => {
     const wsRef = useRef<WebSocket | null>(null);
     const audioContainerRef = useRef<HTMLDivElement>(null);
     const processorRef = useRef<ScriptProcessorNode | null>(null);
+    const audioFormatAcceptedRef = useRef(false);
 
     const addLog = useCallback((message: string) => {
         setLogs((prevLogs) => [...prevLogs, `[${new Date().toLocaleTimeString()}] ${message}`]);
@@ -26,12 +33,17 @@ const CallScreen = () => {
 
         ws.onopen = () => {
             addLog("WebSocket connection established");
+            audioFormatAcceptedRef.current = false;
+            ws.send(JSON.stringify({ type: "audio_format", ...AUDIO_FORMAT }));
         };
 
         ws.onmessage = (event) => {
             try {
                 const message = JSON.parse(event.data);
-                if (message.type === "error") {
+                if (message.type === "audio_format_accepted") {
+                    audioFormatAcceptedRef.current = true;
+                    addLog(`Audio format: ${message.encoding} at ${message.sample_rate}Hz`);
+                } else if (message.type === "error") {
                     addLog(`Error from server: ${message.message}`);
                 }
             } catch (e) {
@@ -105,7 +117,11 @@ const CallScreen = () => {
             setStream(capturedStream);
             addLog("Successfully captured audio stream");
 
-            const audioContext = new AudioContext({ sampleRate: 48000 });
+            // The browser resamples the captured stream to the context's rate.
+            const compressed = audioFormatAcceptedRef.current;
+            const audioContext = new AudioContext({
+                sampleRate: compressed ? AUDIO_FORMAT.sample_rate : DEFAULT_SAMPLE_RATE,
+            });
             const source = audioContext.createMediaStreamSource(capturedStream);
             addLog(`Audio context sample rate: ${audioContext.sampleRate}Hz`);
 
@@ -125,7 +141,6 @@ const CallScreen = () => {
             processor.onaudioprocess = (e) => {
                 if (wsRef.current?.readyState === WebSocket.OPEN) {
                     const inputData = e.inputBuffer.getChannelData(0);
-                    const pcm16Data = new Int16Array(inputData.length);
 
                     // Calculate RMS sound level
                     let sum = 0;
@@ -135,6 +150,15 @@ const CallScreen = () => {
                     const rms = Math.sqrt(sum / inputData.length);
                     const soundLevel = (rms * 100).toFixed(2);
 
+                    if (compressed) {
+                        wsRef.current.send(
+                            createAudioFrame(parseFloat(soundLevel), encodeMulaw(inputData))
+                        );
+                        return;
+                    }
+
+                    const pcm16Data = new Int16Array(inputData.length);
+
                     // Convert to 16-bit PCM with dithering
                     for (let i = 0; i < inputData.length; i++) {
                         const dither = (Math.random() * 2 - 1) * 0.0001;
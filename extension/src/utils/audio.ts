@@ -78,3 +78,28 @@ export const createWavData = (
 export const encodeWavToBase64 = (wavData: Uint8Array<ArrayBuffer>) => {
     return btoa(String.fromCharCode.apply(null, Array.from(wavData)));
 };
+
+// G.711 µ-law encoding of [-1, 1] samples, one byte per sample.
+const MULAW_BIAS = 0x84;
+const MULAW_CLIP = 32635;
+
+export const encodeMulaw = (inputData: Float32Array<ArrayBufferLike>) => {
+    const encoded = new Uint8Array(inputData.length);
+    for (let i = 0; i < inputData.length; i++) {
+        let sample = Math.round(Math.max(-1, Math.min(1, inputData[i])) * 32767);
+        const sign = sample < 0 ? 0x80 : 0;
+        sample = Math.min(Math.abs(sample), MULAW_CLIP) + MULAW_BIAS;
+        const exponent = Math.floor(Math.log2(sample)) - 7;
+        const mantissa = (sample >> (exponent + 3)) & 0x0f;
+        encoded[i] = ~(sign | (exponent << 4) | mantissa) & 0xff;
+    }
+    return encoded;
+};
+
+// Binary audio frame for the backend: little-endian float32 sound level, then samples.
+export const createAudioFrame = (soundLevel: number, payload: Uint8Array<ArrayBuffer>) => {
+    const frame = new Uint8Array(4 + payload.byteLength);
+    new DataView(frame.buffer).setFloat32(0, soundLevel, true);
+    frame.set(payload, 4);
+    return frame;
+};